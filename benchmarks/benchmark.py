@@ -0,0 +1,353 @@
+"""Time Wallace's core model operations and network topologies.
+
+Each benchmark builds what it needs in a fresh database, then times a single
+operation (connecting nodes, transmitting, adding nodes to a network...)
+applied to every node of a network of the given size. The fastest of several
+repeats is kept. Results are written as json and can be compared against the
+results of an earlier run, which is how a performance change is justified and
+how a regression is caught.
+
+Usage::
+
+    python benchmarks/benchmark.py --database sqlite:////tmp/bench.db \\
+        --output benchmarks/sqlite.json
+    python benchmarks/benchmark.py --baseline benchmarks/sqlite.json
+
+"""
+
+import argparse
+from collections import OrderedDict
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+
+#: the benchmarks, by name. Each maps to the function that runs it and the
+#: largest size it is run at, as some grow quadratically with the size.
+BENCHMARKS = OrderedDict()
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+def benchmark(name, max_size=None):
+    """Register a benchmark under name."""
+    def decorator(func):
+        BENCHMARKS[name] = (func, max_size)
+        return func
+    return decorator
+
+
+class Timer(object):
+    """Accumulate the time spent inside ``with`` blocks."""
+
+    def __init__(self):
+        """Start at zero."""
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        """Start timing."""
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        """Stop timing."""
+        self.elapsed += time.time() - self.start
+
+
+def chain_of_agents(session, size, infos=False):
+    """A network of size agents, each connected to the next."""
+    from wallace import models, nodes
+
+    net = models.Network()
+    session.add(net)
+    session.commit()
+
+    agents = [nodes.Agent(network=net) for _ in range(size)]
+    session.add_all(agents)
+    session.commit()
+
+    for agent, other in zip(agents, agents[1:]):
+        agent.connect(whom=other)
+    if infos:
+        for agent in agents:
+            models.Info(origin=agent, contents="benchmark")
+    session.commit()
+    return agents
+
+
+@benchmark("connect")
+def bench_connect(session, size, timer):
+    """Connect each of size agents to the next."""
+    from wallace import models, nodes
+
+    net = models.Network()
+    session.add(net)
+    session.commit()
+    agents = [nodes.Agent(network=net) for _ in range(size)]
+    session.add_all(agents)
+    session.commit()
+
+    with timer:
+        for agent, other in zip(agents, agents[1:]):
+            agent.connect(whom=other)
+        session.commit()
+
+
+@benchmark("transmit")
+def bench_transmit(session, size, timer):
+    """Transmit along a chain of size agents."""
+    agents = chain_of_agents(session, size, infos=True)
+
+    with timer:
+        for agent in agents[:-1]:
+            agent.transmit()
+        session.commit()
+
+
+@benchmark("receive")
+def bench_receive(session, size, timer):
+    """Receive pending transmissions along a chain of size agents."""
+    agents = chain_of_agents(session, size, infos=True)
+    for agent in agents[:-1]:
+        agent.transmit()
+    session.commit()
+
+    with timer:
+        for agent in agents[1:]:
+            agent.receive()
+        session.commit()
+
+
+@benchmark("neighbors")
+def bench_neighbors(session, size, timer):
+    """Get the neighbors of every agent in a chain of size agents."""
+    agents = chain_of_agents(session, size)
+
+    with timer:
+        for agent in agents:
+            agent.neighbors()
+        session.commit()
+
+
+@benchmark("fail")
+def bench_fail(session, size, timer):
+    """Fail every agent in a chain of size agents that have transmitted."""
+    agents = chain_of_agents(session, size, infos=True)
+    for agent in agents[:-1]:
+        agent.transmit()
+    session.commit()
+
+    with timer:
+        for agent in agents:
+            agent.fail()
+        session.commit()
+
+
+def add_nodes(session, net, size, timer):
+    """Add size agents to net one at a time, as participants would."""
+    from wallace import nodes
+
+    with timer:
+        for _ in range(size):
+            net.add_node(nodes.Agent(network=net))
+            session.commit()
+
+
+def committed(session, obj):
+    """Add obj to the database and return it."""
+    session.add(obj)
+    session.commit()
+    return obj
+
+
+def topology(name, max_size=None):
+    """Register a benchmark of adding nodes to the network make creates."""
+    def decorator(make):
+        @benchmark("add_node." + name, max_size=max_size)
+        def bench_add_node(session, size, timer):
+            add_nodes(session, make(session, size), size, timer)
+        bench_add_node.__doc__ = "Add nodes to a {} network.".format(name)
+        return make
+    return decorator
+
+
+@topology("Chain")
+def make_chain(session, size):
+    from wallace import networks
+    return committed(session, networks.Chain())
+
+
+@topology("FullyConnected", max_size=100)
+def make_fully_connected(session, size):
+    from wallace import networks
+    return committed(session, networks.FullyConnected())
+
+
+@topology("Empty")
+def make_empty(session, size):
+    from wallace import networks
+    return committed(session, networks.Empty())
+
+
+@topology("Star")
+def make_star(session, size):
+    from wallace import networks
+    return committed(session, networks.Star())
+
+
+@topology("Burst")
+def make_burst(session, size):
+    from wallace import networks
+    return committed(session, networks.Burst())
+
+
+@topology("DiscreteGenerational")
+def make_discrete_generational(session, size):
+    from wallace import networks, nodes
+    # Later generations need agents with a generation column, which the
+    # generic Agent lacks, so everyone joins the seeded first generation.
+    net = committed(session, networks.DiscreteGenerational(
+        generations=1, generation_size=size, initial_source=True))
+    committed(session, nodes.RandomBinaryStringSource(network=net))
+    return net
+
+
+@topology("ScaleFree", max_size=100)
+def make_scale_free(session, size):
+    from wallace import networks
+    return committed(session, networks.ScaleFree(m0=4, m=2))
+
+
+@topology("SequentialMicrosociety")
+def make_sequential_microsociety(session, size):
+    from wallace import networks
+    return committed(session, networks.SequentialMicrosociety(n=3))
+
+
+def run(names, sizes, repeats):
+    """Run the named benchmarks, returning the best time of each by size."""
+    from wallace import db
+
+    results = OrderedDict()
+    for name in names:
+        func, max_size = BENCHMARKS[name]
+        results[name] = OrderedDict()
+        for size in sizes:
+            if max_size is not None and size > max_size:
+                continue
+            best = None
+            for _ in range(repeats):
+                session = db.init_db(drop_all=True)
+                random.seed(0)
+                timer = Timer()
+                func(session, size, timer)
+                session.remove()
+                if best is None or timer.elapsed < best:
+                    best = timer.elapsed
+            results[name][str(size)] = best
+            print "{:<36} {:>6} {:>10.4f}s".format(name, size, best)
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline, returning the regressions."""
+    regressions = []
+    print
+    print "{:<36} {:>6} {:>11} {:>11} {:>7}".format(
+        "benchmark", "size", "baseline", "current", "ratio")
+    for name, times in results.items():
+        for size, elapsed in times.items():
+            before = baseline.get(name, {}).get(size)
+            if not before:
+                continue
+            ratio = elapsed / before
+            slower = ratio > 1 + tolerance
+            if slower:
+                regressions.append((name, size))
+            print "{:<36} {:>6} {:>10.4f}s {:>10.4f}s {:>6.2f}x{}".format(
+                name, size, before, elapsed, ratio,
+                "  SLOWER" if slower else "")
+    return regressions
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--database", default=os.environ.get("DATABASE_URL"),
+        help="the database to run against, by default DATABASE_URL")
+    parser.add_argument(
+        "--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+        help="comma separated network sizes (default: %(default)s)")
+    parser.add_argument(
+        "--repeats", type=int, default=3,
+        help="how many times to run each benchmark (default: %(default)s)")
+    parser.add_argument(
+        "--only", default=None,
+        help="only run benchmarks whose name matches this pattern")
+    parser.add_argument(
+        "--output", default=None,
+        help="write the results as json to this file")
+    parser.add_argument(
+        "--baseline", default=None,
+        help="compare the results with those in this json file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25,
+        help="how much slower than the baseline counts as a regression "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS
+             if args.only is None or re.search(args.only, name)]
+    if args.list:
+        for name in names:
+            print name
+        return
+
+    # The database is chosen when wallace is first imported.
+    if args.database:
+        os.environ["DATABASE_URL"] = args.database
+    from wallace import db
+    from wallace.version import __version__
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run(names, sizes, args.repeats)
+
+    report = OrderedDict([
+        ("metadata", {
+            "database": db.engine.dialect.name,
+            "wallace": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": datetime.datetime.now().isoformat(),
+            "repeats": args.repeats,
+        }),
+        ("results", results),
+    ])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["metadata"]["database"] != report["metadata"]["database"]:
+            print "Warning: the baseline was run against {}.".format(
+                baseline["metadata"]["database"])
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print
+            print "{} benchmarks are slower than the baseline.".format(
+                len(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""Replay participant traffic against a locally launched experiment server.
+
+The experiment is set up as ``wallace debug`` would set it up, with the
+HotAirRecruiter in place of the real recruiter, and served against a
+throwaway local Redis with a worker processing notifications. Simulated
+participants then join and follow the same requests the experiment's own
+frontend makes, several at once. Throughput, p50 and p99 latencies and error
+rates are reported for each route.
+
+Usage::
+
+    python benchmarks/loadtest.py examples/rogers --participants 100 \\
+        --concurrency 20 --output rogers.json
+
+"""
+
+import argparse
+from collections import OrderedDict, defaultdict
+import ConfigParser
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+import requests
+
+#: the scripts participants follow, by the name of the example they are for.
+SCRIPTS = OrderedDict()
+
+#: the most nodes a participant will try to make before giving up.
+MAX_TRIALS = 100
+
+
+def script(name):
+    """Register the script participants in the named example follow."""
+    def decorator(func):
+        SCRIPTS[name] = func
+        return func
+    return decorator
+
+
+class Participant(object):
+    """A simulated participant, recording every request they make."""
+
+    def __init__(self, url, number, run, think=0):
+        """Create a participant with their own MTurk identity."""
+        self.url = url
+        self.worker_id = "loadtest-{}".format(number)
+        self.assignment_id = "loadtest-{}-{}".format(run, number)
+        self.hit_id = "loadtest-{}".format(run)
+        self.mode = "debug"
+        self.participant_id = None
+        self.think = think
+        self.session = requests.Session()
+        self.records = []
+
+    def request(self, method, route, expected=(200,), data=None,
+                params=None, **args):
+        """Request route, filling in its <arguments> from args.
+
+        Returns the json of the response if it was successful, and None
+        otherwise.
+        """
+        path = re.sub(r"<(\w+)>", lambda m: str(args[m.group(1)]), route)
+        start = time.time()
+        try:
+            response = self.session.request(
+                method, self.url + path, data=data, params=params, timeout=60)
+            status = response.status_code
+        except requests.RequestException:
+            response = status = None
+        elapsed = time.time() - start
+
+        self.records.append(
+            (method + " " + route, status, elapsed, status in expected))
+
+        if self.think:
+            time.sleep(random.uniform(0, 2 * self.think))
+
+        if status == 200:
+            try:
+                return response.json()
+            except ValueError:
+                return None
+
+    def notify(self, event_type):
+        """Send the notification MTurk would send about this assignment."""
+        self.request("POST", "/notifications", data={
+            "Event.1.EventType": event_type,
+            "Event.1.AssignmentId": self.assignment_id
+        })
+
+    def join(self):
+        """Create the participant, as the frontend does on arrival."""
+        resp = self.request(
+            "POST", "/participant/<worker_id>/<hit_id>/<assignment_id>/<mode>",
+            worker_id=self.worker_id,
+            hit_id=self.hit_id,
+            assignment_id=self.assignment_id,
+            mode=self.mode)
+        if resp is None:
+            return False
+        self.participant_id = resp["participant"]["id"]
+        self.notify("AssignmentAccepted")
+        return True
+
+    def create_node(self):
+        """Ask for a node, returning its id, or None once there are none."""
+        resp = self.request(
+            "POST", "/node/<participant_id>", expected=(200, 403),
+            participant_id=self.participant_id)
+        if resp is not None:
+            return resp["node"]["id"]
+
+    def finish(self):
+        """Answer the questionnaire and submit the assignment."""
+        for number, question in enumerate(["engagement", "difficulty"], 1):
+            self.request(
+                "POST", "/question/<participant_id>",
+                participant_id=self.participant_id,
+                data={
+                    "question": question,
+                    "number": number,
+                    "response": random.randint(1, 5)
+                })
+        self.request("GET", "/participant/<participant_id>",
+                     participant_id=self.participant_id)
+        self.request("GET", "/ad_address/<mode>/<hit_id>",
+                     mode=self.mode, hit_id=self.hit_id)
+        self.notify("AssignmentSubmitted")
+
+
+@script("bartlett1932")
+def bartlett1932(participant):
+    """Read a story and reproduce it until the chains are full."""
+    for _ in range(MAX_TRIALS):
+        node_id = participant.create_node()
+        if node_id is None:
+            break
+        participant.request("GET", "/node/<node_id>/received_infos",
+                            node_id=node_id)
+        participant.request("POST", "/info/<node_id>", node_id=node_id, data={
+            "contents": "A reproduction of the story.",
+            "info_type": "Info"
+        })
+
+
+@script("chatroom")
+def chatroom(participant, messages=5):
+    """Send messages and poll for those of the other participants."""
+    node_id = participant.create_node()
+    if node_id is None:
+        return
+    for message in range(messages):
+        participant.request("POST", "/info/<node_id>", node_id=node_id, data={
+            "contents": "Message {}.".format(message),
+            "info_type": "Info"
+        })
+        resp = participant.request(
+            "GET", "/node/<node_id>/transmissions", node_id=node_id,
+            params={"status": "pending"})
+        for transmission in (resp or {}).get("transmissions", []):
+            participant.request(
+                "GET", "/info/<node_id>/<info_id>",
+                node_id=node_id, info_id=transmission["info_id"])
+
+
+@script("rogers")
+def rogers(participant):
+    """Judge which color of dots there are more of until the trials end."""
+    for prop in ["practice_repeats", "experiment_repeats"]:
+        participant.request("GET", "/experiment_property/<prop>", prop=prop)
+    for _ in range(MAX_TRIALS):
+        node_id = participant.create_node()
+        if node_id is None:
+            break
+        participant.request("GET", "/node/<node_id>/infos", node_id=node_id,
+                            params={"info_type": "LearningGene"})
+        participant.request("GET", "/node/<node_id>/received_infos",
+                            node_id=node_id)
+        participant.request("POST", "/info/<node_id>", node_id=node_id, data={
+            "contents": random.choice(["blue", "yellow"]),
+            "info_type": "Meme"
+        })
+
+
+def simulate(url, follow, number, run, think):
+    """Take a single participant through the experiment."""
+    participant = Participant(url, number, run, think=think)
+    try:
+        if participant.join():
+            follow(participant)
+            participant.finish()
+    except Exception:
+        traceback.print_exc()
+        participant.records.append(("script", None, 0.0, False))
+    return participant.records
+
+
+def percentile(values, p):
+    """The pth percentile of values, by the nearest rank."""
+    values = sorted(values)
+    return values[max(int(round(p / 100.0 * len(values))) - 1, 0)]
+
+
+def summarize(records, duration):
+    """Throughput, latencies and error rates by route."""
+    by_route = defaultdict(list)
+    for route, status, elapsed, ok in records:
+        by_route[route].append((elapsed, ok))
+    by_route["all"] = [(elapsed, ok) for _, _, elapsed, ok in records]
+
+    summary = OrderedDict()
+    for route in sorted(by_route, key=lambda r: (r == "all", r)):
+        latencies = [elapsed * 1000 for elapsed, _ in by_route[route]]
+        errors = len([ok for _, ok in by_route[route] if not ok])
+        summary[route] = OrderedDict([
+            ("requests", len(latencies)),
+            ("throughput", len(latencies) / duration),
+            ("p50", percentile(latencies, 50)),
+            ("p99", percentile(latencies, 99)),
+            ("error_rate", float(errors) / len(latencies)),
+        ])
+    return summary
+
+
+def free_port():
+    """A port nothing is listening on."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(url, timeout=60):
+    """Wait for the server at url to start answering."""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            requests.get(url + "/robots.txt", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.5)
+    raise RuntimeError("The server at {} didn't start.".format(url))
+
+
+def launch(example, port, redis_url):
+    """Set up the example and start its server and worker.
+
+    Returns the directory the experiment runs in and the processes.
+    """
+    from wallace import db
+    from wallace.command_line import setup_experiment, use_hot_air_recruiter
+
+    cwd = os.getcwd()
+    os.chdir(example)
+    try:
+        (id, dst) = setup_experiment(debug=True)
+    finally:
+        os.chdir(cwd)
+
+    use_hot_air_recruiter(os.path.join(dst, "wallace_experiment.py"))
+
+    config = ConfigParser.SafeConfigParser()
+    config.read(os.path.join(dst, "config.txt"))
+    for section in ["Experiment Configuration", "Server Parameters"]:
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set("Experiment Configuration", "mode", "debug")
+    config.set("Server Parameters", "host", "127.0.0.1")
+    config.set("Server Parameters", "port", str(port))
+    config.set("Server Parameters", "logfile",
+               os.path.join(dst, "server.log"))
+    with open(os.path.join(dst, "config.txt"), "w") as f:
+        config.write(f)
+
+    db.init_db(drop_all=True)
+
+    env = dict(os.environ, REDISCLOUD_URL=redis_url)
+    processes = [
+        subprocess.Popen([sys.executable, "psiturkapp.py"], cwd=dst, env=env),
+        subprocess.Popen([sys.executable, "worker.py"], cwd=dst, env=env),
+    ]
+    return dst, processes
+
+
+def main():
+    """Run the load test from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "example", help="the directory of the experiment, whose name picks "
+                        "the script: " + ", ".join(SCRIPTS))
+    parser.add_argument(
+        "--participants", type=int, default=50,
+        help="how many participants to simulate (default: %(default)s)")
+    parser.add_argument(
+        "--concurrency", type=int, default=10,
+        help="how many participants take part at once "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--think", type=float, default=0,
+        help="the mean pause, in seconds, between a participant's requests "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--url", default=None,
+        help="test an already running server instead of launching one")
+    parser.add_argument(
+        "--redis", default=None,
+        help="the Redis to queue notifications in, by default a throwaway "
+             "redis-server")
+    parser.add_argument(
+        "--output", default=None,
+        help="write the results as json to this file")
+    args = parser.parse_args()
+
+    name = os.path.basename(os.path.normpath(args.example))
+    if name not in SCRIPTS:
+        parser.error("There is no script for {}.".format(name))
+
+    processes = []
+    dst = None
+    try:
+        url = args.url
+        if url is None:
+            redis_url = args.redis
+            if redis_url is None:
+                redis_port = free_port()
+                processes.append(subprocess.Popen(
+                    ["redis-server", "--port", str(redis_port),
+                     "--save", ""]))
+                redis_url = "redis://127.0.0.1:{}".format(redis_port)
+
+            port = free_port()
+            dst, started = launch(args.example, port, redis_url)
+            processes.extend(started)
+            url = "http://127.0.0.1:{}".format(port)
+            wait_for(url)
+            requests.post(url + "/launch").raise_for_status()
+
+        run = int(time.time())
+        pool = ThreadPool(args.concurrency)
+        start = time.time()
+        results = pool.map(
+            lambda number: simulate(url, SCRIPTS[name], number, run,
+                                    args.think),
+            range(args.participants))
+        duration = time.time() - start
+        pool.close()
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        if dst is not None:
+            shutil.rmtree(os.path.dirname(dst), ignore_errors=True)
+
+    records = [record for records in results for record in records]
+    summary = summarize(records, duration)
+
+    print
+    print "{} participants in {:.1f}s".format(args.participants, duration)
+    print "{:<60} {:>7} {:>8} {:>9} {:>9} {:>7}".format(
+        "route", "count", "req/s", "p50 ms", "p99 ms", "errors")
+    for route, stats in summary.items():
+        print "{:<60} {:>7} {:>8.1f} {:>9.1f} {:>9.1f} {:>6.1%}".format(
+            route, stats["requests"], stats["throughput"], stats["p50"],
+            stats["p99"], stats["error_rate"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(OrderedDict([
+                ("example", name),
+                ("participants", args.participants),
+                ("concurrency", args.concurrency),
+                ("duration", duration),
+                ("routes", summary),
+            ]), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,6 @@ from wallace.experiments import Experiment
 from wallace import db
 import random
 from flask import Blueprint, Response
-import json
 from sqlalchemy import Boolean
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql.expression import cast
@@ -93,6 +92,8 @@ class AnimalInfo(Info):
         "polymorphic_identity": "vector_info"
     }
 
+    json_contents = True
+
     @hybrid_property
     def chosen(self):
         """Use property1 to store whether an info was chosen."""
@@ -139,18 +140,18 @@ class AnimalInfo(Info):
             data = {}
             for prop, prop_range in self.properties.iteritems():
                 data[prop] = random.uniform(prop_range[0], prop_range[1])
-            self.contents = json.dumps(data)
+            self.contents = data
 
     def perturbed_contents(self):
         """Perturb the given animal."""
-        animal = json.loads(self.contents)
+        animal = dict(self.parsed_contents)
 
         for prop, prop_range in self.properties.iteritems():
             range = prop_range[1] - prop_range[0]
             jittered = animal[prop] + random.gauss(0, 0.1 * range)
             animal[prop] = max(min(jittered, prop_range[1]), prop_range[0])
 
-        return json.dumps(animal)
+        return animal
 
 
 class Perturbation(Transformation):
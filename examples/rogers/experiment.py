@@ -4,7 +4,7 @@ from wallace.experiments import Experiment
 from wallace.information import Gene, Meme, State
 from wallace.nodes import Source, Agent, Environment
 from wallace.networks import DiscreteGenerational
-from wallace.models import Node, Network, Participant
+from wallace.models import Node
 from wallace import transformations
 from sqlalchemy import Integer, Float
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -31,6 +31,7 @@ class RogersExperiment(Experiment):
         self.generation_size = 40
         self.bonus_payment = 1.0
         self.initial_recruitment_size = self.generation_size
+        self.recruitment_margin = 0.1
         self.known_classes["LearningGene"] = LearningGene
 
         if not self.networks():
@@ -83,8 +84,8 @@ class RogersExperiment(Experiment):
         """Run when a participant submits successfully."""
         key = participant.uniqueid[0:5]
 
-        finished_participants = Participant.query.filter_by(status=101).all()
-        num_finished_participants = len(finished_participants)
+        num_finished_participants = self.participant_status_counts()\
+            .get("approved", 0)
         current_generation = int((num_finished_participants - 1) /
                                  float(self.generation_size))
 
@@ -105,26 +106,14 @@ class RogersExperiment(Experiment):
 
     def recruit(self):
         """Recruit more participants."""
-        participants = Participant.query.\
-            with_entities(Participant.status).all()
-
         # if all networks are full, close recruitment,
         if not self.networks(full=False):
             print "All networks are full, closing recruitment."
             self.recruiter().close_recruitment()
 
-        # if anyone is still working, don't recruit
-        elif [p for p in participants if p.status < 100]:
-            print "People are still participating: not recruiting."
-
-        # we only need to recruit if the current generation is complete
-        elif (len([p for p in participants if p.status == 101]) %
-              self.generation_size) == 0:
-            print "Recruiting another generation."
-            self.recruiter().recruit_participants(n=self.generation_size)
-        # otherwise do nothing
+        # otherwise recruit for the open slots in the current generations
         else:
-            print "not recruiting."
+            self.schedule_recruitment()
 
     def bonus(self, participant=None):
         """Calculate a participants bonus."""
@@ -134,35 +123,27 @@ class RogersExperiment(Experiment):
         participant_id = participant.uniqueid
         key = participant_id[0:5]
 
-        nodes = Node.query.join(Node.network)\
-                    .filter(and_(Node.participant_id == participant_id,
-                                 Network.role == "experiment"))\
-                    .all()
+        average = participant.aggregate(
+            "score", type=RogersAgent, network_role="experiment")
 
-        if len(nodes) == 0:
+        if average is None:
             self.log("Participant has 0 nodes - cannot calculate bonus!", key)
             return 0
         self.log("calculating bonus...", key)
-        score = [node.score for node in nodes]
-        average = float(sum(score)) / float(len(score))
+        average = float(average)
         bonus = round(max(0.0, ((average - 0.5) * 2)) * self.bonus_payment, 2)
         self.log("bonus calculated, returning {}".format(bonus), key)
         return bonus
 
     def attention_check(self, participant=None):
         """Check a participant paid attention."""
-        participant_nodes = Node.query.join(Node.network)\
-            .filter(and_(Node.participant_id == participant.uniqueid,
-                         Network.role == "catch"))\
-            .all()
-        scores = [n.score for n in participant_nodes]
-
-        if participant_nodes:
-            avg = sum(scores) / float(len(scores))
-        else:
+        avg = participant.aggregate(
+            "score", type=RogersAgent, network_role="catch")
+
+        if avg is None:
             return True
 
-        is_passing = avg >= self.min_acceptable_performance
+        is_passing = float(avg) >= self.min_acceptable_performance
         return is_passing
 
     def data_check(self, participant):
@@ -0,0 +1,148 @@
+"""Test the batch route."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from flask import Flask
+from nose.tools import assert_raises
+from wallace import db, models
+
+
+class FakeRedis(object):
+
+    def set(self, key, value, nx=False, ex=None):
+        return True
+
+
+class FakeQueue(object):
+
+    def __init__(self):
+        self.connection = FakeRedis()
+        self.jobs = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def enqueue(self, func, *args):
+        self.jobs.append(args)
+
+
+class TestBatch(object):
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+
+        # The server runs the experiment from a copy of its directory.
+        example = os.path.join("examples", "bartlett1932")
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        for name in ["config.txt", "static", "templates"]:
+            path = os.path.join(example, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(self.tmp, name))
+            else:
+                shutil.copy(path, self.tmp)
+        shutil.copy(os.path.join(example, "experiment.py"),
+                    os.path.join(self.tmp, "wallace_experiment.py"))
+        shutil.copy(
+            os.path.join("wallace", "frontend", "templates",
+                         "error_wallace.html"),
+            os.path.join(self.tmp, "templates"))
+        os.chdir(self.tmp)
+        sys.path.insert(0, self.tmp)
+
+        from wallace import custom
+        self.custom = custom
+        custom.queue = FakeQueue()
+        app = Flask(__name__,
+                    static_folder=os.path.join(self.tmp, "static"),
+                    template_folder=os.path.join(self.tmp, "templates"))
+        app.register_blueprint(custom.custom_code)
+        self.app = app.test_client()
+
+    def teardown(self):
+        self.custom.queue = None
+        self.db.rollback()
+        self.db.close()
+        sys.path.remove(self.tmp)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def batch(self, operations):
+        response = self.app.post(
+            "/batch",
+            data=json.dumps({"operations": operations}),
+            content_type="application/json")
+        return json.loads(response.data)
+
+    def test_batch_info_with_json_contents(self):
+        participant = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="debug")
+        self.db.add(participant)
+        self.db.commit()
+
+        contents = json.dumps({"color": "blue", "sizes": [1, 2]})
+        results = self.batch([
+            {"method": "POST", "url": "/node/{}".format(participant.id)},
+            {"method": "POST", "url": "/info/{0.node.id}",
+             "data": {"contents": contents}},
+            {"method": "POST", "url": "/info/{0.node.id}",
+             "data": {"contents": "{0.node.id}",
+                      "property1": {"$ref": [1, "info", "id"]}}},
+        ])
+
+        assert results["status"] == "success"
+        node, first, second = results["results"]
+        assert first["info"]["contents"] == contents
+        assert first["info"]["origin_id"] == node["node"]["id"]
+        assert second["info"]["contents"] == "{0.node.id}"
+        assert second["info"]["property1"] == str(first["info"]["id"])
+
+    def test_batch_bad_reference(self):
+        results = self.batch([
+            {"method": "GET", "url": "/experiment_property/task",
+             "data": {"x": {"$ref": [3, "node"]}}},
+        ])
+        assert results["status"] == "error"
+        assert results["failed"] == 0
+
+    def test_batch_urls(self):
+        results = [{"node": {"id": 3, "failed": False}, "status": "success"}]
+        assert self.custom.batch_url("/node/{0.node.id}/infos", results) == \
+            "/node/3/infos"
+        assert self.custom.batch_url("/x/{0}/{y}", [7]) == "/x/7/{y}"
+        assert self.custom.batch_url("/x/{0.status", results) == \
+            "/x/{0.status"
+        for url in ["/x/{1.node}", "/x/{0.node.name}", "/x/{0.node}",
+                    "/x/{0.node.failed}", "/x/{0.status.upper}"]:
+            assert_raises((IndexError, KeyError, ValueError),
+                          self.custom.batch_url, url, results)
+
+    def test_failed_batch_queues_nothing(self):
+        self.custom.experiment(self.db)
+        self.db.commit()
+
+        first = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="debug")
+        second = models.Participant(
+            worker_id="2", hit_id="1", assignment_id="1", mode="debug")
+        self.db.add_all([first, second])
+        self.db.commit()
+        first_id = first.id
+
+        # creating the second participant's node abandons the first, as
+        # they have the same assignment
+        operations = [
+            {"method": "POST", "url": "/node/{}".format(second.id)},
+            {"method": "GET", "url": "/node/{0.node.id}/nothing"},
+        ]
+        assert self.batch(operations)["failed"] == 1
+        assert len(self.custom.queue) == 0
+
+        results = self.batch(operations[:1])
+        assert results["status"] == "success"
+        assert self.custom.queue.jobs == [
+            ("AssignmentAbandoned", None, first_id)]
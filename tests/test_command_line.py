@@ -20,3 +20,25 @@ class TestCommandLine(object):
     def test_wallace_help(self):
         output = subprocess.check_output("wallace", shell=True)
         assert("Usage: wallace [OPTIONS] COMMAND [ARGS]" in output)
+
+    def test_precompress(self):
+        import gzip
+        import shutil
+        import tempfile
+        from wallace.command_line import precompress
+
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "wallace.js")
+            with open(path, "w") as f:
+                f.write("var wallace = {};\n" * 100)
+            precompress(path)
+
+            assert gzip.open(path + ".gz").read() == open(path).read()
+            with open(path + ".gz", "rb") as f:
+                first = f.read()
+            precompress(path)
+            with open(path + ".gz", "rb") as f:
+                assert f.read() == first
+        finally:
+            shutil.rmtree(tmp)
@@ -0,0 +1,485 @@
+"""Test the data export helpers."""
+
+import csv
+from datetime import datetime
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from StringIO import StringIO
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises
+from sqlalchemy.orm import Session
+from wallace import data, db, models
+
+
+class FakePart(object):
+
+    def __init__(self, etag):
+        self.etag = '"{}"'.format(etag)
+
+
+class FakeUpload(object):
+
+    def __init__(self, bucket, key_name, metadata):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.metadata = metadata
+        self.parts = {}
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        chunk = fp.read(size)
+        self.parts[part_num] = chunk
+        return FakePart(hashlib.md5(chunk).hexdigest())
+
+    def complete_upload(self):
+        chunks = [self.parts[n] for n in sorted(self.parts)]
+        etag = data.multipart_etag([hashlib.md5(c).digest() for c in chunks])
+        self.bucket.objects[self.key_name] = (
+            "".join(chunks), etag, self.metadata)
+        return FakePart(etag)
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeKey(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        if name in bucket.objects:
+            contents, etag, self.metadata = bucket.objects[name]
+            self.size = len(contents)
+            self.etag = '"{}"'.format(etag)
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def get_contents_as_string(self, headers=None):
+        contents = self.bucket.objects[self.name][0]
+        if headers is None:
+            return contents
+        start, end = headers["Range"][len("bytes="):].split("-")
+        return contents[int(start):int(end) + 1]
+
+    def set_contents_from_string(self, contents, md5=None):
+        self.bucket.objects[self.name] = (
+            contents, hashlib.md5(contents).hexdigest(), {})
+
+
+class FakeBucket(object):
+    """Just enough of a boto bucket to stream objects in and out of."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+
+    def initiate_multipart_upload(self, key_name, metadata=None):
+        upload = FakeUpload(self, key_name, metadata or {})
+        self.uploads.append(upload)
+        return upload
+
+    def get_key(self, key_name):
+        if key_name in self.objects:
+            return FakeKey(self, key_name)
+
+    def new_key(self, key_name):
+        return FakeKey(self, key_name)
+
+
+class TestData(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "test-data.zip")
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_archive_round_trip(self):
+        rows = "id,contents\n" + "".join(
+            "{},{}\n".format(i, "ab" * i) for i in range(1000))
+        code = os.path.join(self.tmp, "code.zip")
+        with open(code, "wb") as file:
+            file.write("PK" + "".join(chr(i % 256) for i in range(5000)))
+
+        pipe = data.Pipe()
+        pipe.start()
+        for start in range(0, len(rows), 333):
+            pipe.write(rows[start:start + 333])
+        pipe.close()
+        pipe.finish()
+        assert pipe.tell() == len(rows)
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            archive.write(code, "test-code.zip", zipfile.ZIP_STORED)
+            archive.writestr("experiment_id.md", "test")
+            archive.write_entry("data/info.csv", pipe, pipe.deflater)
+            archive.writestr("data/question.csv", "")
+
+        with zipfile.ZipFile(self.path) as archive:
+            assert archive.testzip() is None
+            assert archive.namelist() == [
+                "test-code.zip", "experiment_id.md", "data/info.csv",
+                "data/question.csv"]
+            info = archive.getinfo("data/info.csv")
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.compress_size < info.file_size
+            assert archive.read("data/info.csv") == rows
+            assert (archive.getinfo("test-code.zip").compress_type ==
+                    zipfile.ZIP_STORED)
+            assert archive.read("test-code.zip") == open(code, "rb").read()
+            assert archive.read("data/question.csv") == ""
+
+    def test_archive_zip64(self):
+        limit = data.ZIP64_LIMIT
+        data.ZIP64_LIMIT = 100
+        try:
+            with open(self.path, "wb") as file, data.Archive(file) as archive:
+                archive.writestr("experiment_id.md", "test")
+                archive.writestr("data/node.csv", "x" * 1000)
+                archive.writestr("data/info.csv", "y" * 1000,
+                                 zipfile.ZIP_STORED)
+        finally:
+            data.ZIP64_LIMIT = limit
+
+        with zipfile.ZipFile(self.path) as archive:
+            assert archive.testzip() is None
+            assert archive.getinfo("data/info.csv").header_offset > 100
+            assert archive.read("experiment_id.md") == "test"
+            assert archive.read("data/node.csv") == "x" * 1000
+            assert archive.read("data/info.csv") == "y" * 1000
+
+    def test_failed_pipe(self):
+        pipe = data.Pipe()
+        pipe.start()
+        pipe.write("id,contents\n")
+        try:
+            raise RuntimeError("The connection was lost.")
+        except RuntimeError:
+            pipe.fail(sys.exc_info())
+        assert pipe.finished
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            assert_raises(RuntimeError, archive.write_entry,
+                          "data/info.csv", pipe, pipe.deflater)
+
+    def test_cancelled_pipe(self):
+        pipe = data.Pipe()
+        pipe.cancel()
+        assert_raises(data.Cancelled, pipe.write, "x" * data.CHUNK_SIZE)
+
+    def test_copy_tables_rejects_unknown_format(self):
+        assert_raises(ValueError, data.copy_tables, None, None, format="xls")
+
+    def test_changed_since(self):
+        assert data.changed_since("node") == "greatest(time_of_death)"
+        assert (data.changed_since("transmission") ==
+                "greatest(receive_time, time_of_death)")
+
+    def test_stream_round_trip(self):
+        bucket = FakeBucket()
+        contents = "".join(chr(i % 251) for i in range(10000))
+
+        data.upload_stream(StringIO(contents), bucket, "database.dump",
+                           part_size=1024, workers=2)
+        assert len(bucket.uploads[0].parts) == 10
+
+        downloaded = StringIO()
+        data.download_stream(bucket, "database.dump", downloaded, workers=2)
+        assert downloaded.getvalue() == contents
+
+    def test_download_checks_each_part(self):
+        bucket = FakeBucket()
+        data.upload_stream(StringIO("x" * 3000), bucket, "database.dump",
+                           part_size=1024)
+        assert "database.dump.parts" in bucket.objects
+
+        contents, etag, metadata = bucket.objects["database.dump"]
+        bucket.objects["database.dump"] = (
+            contents[:1500] + "y" + contents[1501:], etag, metadata)
+
+        # Nothing from the corrupted part reaches the stream.
+        downloaded = StringIO()
+        assert_raises(IOError, data.download_stream,
+                      bucket, "database.dump", downloaded, workers=1)
+        assert downloaded.getvalue() == "x" * 1024
+
+    def test_download_checks_the_parts(self):
+        bucket = FakeBucket()
+        data.upload_stream(StringIO("x" * 3000), bucket, "database.dump",
+                           part_size=1024)
+        bucket.new_key("database.dump.parts").set_contents_from_string(
+            "0" * 32 + "\n")
+
+        downloaded = StringIO()
+        assert_raises(IOError, data.download_stream,
+                      bucket, "database.dump", downloaded)
+        assert downloaded.getvalue() == ""
+
+    def test_download_detects_corruption(self):
+        bucket = FakeBucket()
+        data.upload_stream(StringIO("x" * 3000), bucket, "database.dump",
+                           part_size=1024)
+
+        # Without the MD5s of the parts only the whole object is checked.
+        del bucket.objects["database.dump.parts"]
+        contents, etag, metadata = bucket.objects["database.dump"]
+        bucket.objects["database.dump"] = ("y" + contents[1:], etag, metadata)
+
+        assert_raises(IOError, data.download_stream,
+                      bucket, "database.dump", StringIO())
+
+    def test_failed_check_cancels_upload(self):
+        bucket = FakeBucket()
+
+        def check():
+            raise RuntimeError("pg_dump failed")
+
+        assert_raises(RuntimeError, data.upload_stream,
+                      StringIO("x" * 3000), bucket, "database.dump",
+                      part_size=1024, check=check)
+        assert bucket.uploads[0].cancelled
+        assert "database.dump" not in bucket.objects
+
+
+class BlobInfo(models.Info):
+    """An info that stores its contents as a blob."""
+
+    __mapper_args__ = {"polymorphic_identity": "blob_info"}
+
+    blob_threshold = 10
+
+
+class TestCopyTables(object):
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "test-data.zip")
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def add_infos(self, count):
+        net = models.Network()
+        self.db.add(net)
+        self.db.commit()
+        node = models.Node(network=net)
+        self.db.add(node)
+        self.db.commit()
+        infos = [models.Info(origin=node, contents="info {}".format(i))
+                 for i in range(count)]
+        self.db.add_all(infos)
+        self.db.commit()
+        return net, node, infos
+
+    def read_csv(self, archive, name):
+        return list(csv.DictReader(StringIO(archive.read(name))))
+
+    def column(self, table, name):
+        return table.column(table.schema.names.index(name)).to_pylist()
+
+    def test_copy_tables(self):
+        net, node, infos = self.add_infos(5)
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            marks = data.copy_tables(db.db_url, archive, workers=2)
+
+        with zipfile.ZipFile(self.path) as archive:
+            assert archive.testzip() is None
+            assert (sorted(archive.namelist()) ==
+                    sorted("data/{}.csv".format(t) for t in data.TABLES))
+
+            rows = self.read_csv(archive, "data/info.csv")
+            assert len(rows) == 5
+            assert (sorted(r["contents"] for r in rows) ==
+                    ["info {}".format(i) for i in range(5)])
+            assert set(rows[0]) == set(models.Info.__table__.c.keys())
+
+            assert len(self.read_csv(archive, "data/node.csv")) == 1
+            assert self.read_csv(archive, "data/question.csv") == []
+
+        assert marks["info"]["id"] == infos[-1].id
+        assert marks["question"] == {
+            "id": 0, "pending": [], "changed": None, "recent": []}
+
+    def test_copy_tables_waits_for_the_archive(self):
+        net, node, infos = self.add_infos(200)
+
+        # Tables have to wait their turn once a few chunks are queued.
+        sizes = data.CHUNK_SIZE, data.PIPE_SIZE
+        data.CHUNK_SIZE, data.PIPE_SIZE = 64, 256
+        try:
+            with open(self.path, "wb") as file, data.Archive(file) as archive:
+                data.copy_tables(db.db_url, archive, workers=3,
+                                 joins=["info_origin"])
+        finally:
+            data.CHUNK_SIZE, data.PIPE_SIZE = sizes
+
+        with zipfile.ZipFile(self.path) as archive:
+            assert archive.testzip() is None
+            assert len(self.read_csv(archive, "data/info.csv")) == 200
+            assert len(self.read_csv(archive, "data/info_origin.csv")) == 200
+
+    def test_copy_tables_parquet(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SkipTest("pyarrow is not installed")
+
+        participant = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="test")
+        self.db.add(participant)
+        self.db.commit()
+        net, node, infos = self.add_infos(3)
+        node.participant_id = participant.id
+        self.db.commit()
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            data.copy_tables(db.db_url, archive, tables=["node", "info"],
+                             joins=["info_origin"], format="parquet")
+
+        with zipfile.ZipFile(self.path) as archive:
+            assert (sorted(archive.namelist()) ==
+                    ["data/info.parquet", "data/info_origin.parquet",
+                     "data/node.parquet"])
+            assert (archive.getinfo("data/info.parquet").compress_type ==
+                    zipfile.ZIP_STORED)
+
+            info = pq.read_table(StringIO(archive.read("data/info.parquet")))
+            assert info.num_rows == 3
+            assert info.schema.names == models.Info.__table__.c.keys()
+            assert (info.schema.field_by_name("creation_time").type ==
+                    pa.timestamp("us"))
+            assert info.schema.field_by_name("id").type == pa.int64()
+            assert (sorted(self.column(info, "contents")) ==
+                    ["info {}".format(i) for i in range(3)])
+            assert self.column(info, "origin_id") == [node.id] * 3
+
+            joined = pq.read_table(
+                StringIO(archive.read("data/info_origin.parquet")))
+            assert joined.num_rows == 3
+            assert joined.schema.names == (
+                models.Info.__table__.c.keys() +
+                ["node_" + c for c in models.Node.__table__.c.keys()] +
+                ["participant_" + c
+                 for c in models.Participant.__table__.c.keys()])
+            assert self.column(joined, "node_id") == [node.id] * 3
+            assert self.column(joined, "participant_worker_id") == ["1"] * 3
+
+    def test_copy_tables_since(self):
+        net, node, infos = self.add_infos(3)
+        finished = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="test")
+        working = models.Participant(
+            worker_id="2", hit_id="1", assignment_id="2", mode="test")
+        self.db.add_all([finished, working])
+        self.db.commit()
+        finished.status = "submitted"
+        finished.end_time = datetime.now()
+        self.db.commit()
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            marks = data.copy_tables(db.db_url, archive)
+
+        infos[0].fail()
+        self.db.add(models.Info(origin=node, contents="new"))
+        finished.status = "approved"
+        working.status = "submitted"
+        working.end_time = datetime.now()
+        self.db.commit()
+
+        path = os.path.join(self.tmp, "test-data-2.zip")
+        with open(path, "wb") as file, data.Archive(file) as archive:
+            data.copy_tables(db.db_url, archive, since=marks)
+
+        with zipfile.ZipFile(path) as archive:
+            rows = self.read_csv(archive, "data/info.csv")
+            assert (sorted(r["contents"] for r in rows) ==
+                    ["info 0", "new"])
+            assert [r["failed"] for r in rows if r["contents"] == "info 0"] \
+                == ["t"]
+
+            # The approval of a participant who had already finished isn't
+            # timestamped, so only a full export picks it up.
+            rows = self.read_csv(archive, "data/participant.csv")
+            assert [(r["worker_id"], r["status"]) for r in rows] == \
+                [("2", "submitted")]
+
+            assert self.read_csv(archive, "data/node.csv") == []
+            assert self.read_csv(archive, "data/network.csv") == []
+
+    def test_copy_tables_since_late_commits(self):
+        net, node, infos = self.add_infos(3)
+
+        # This transaction takes an id and fails an info, but only commits
+        # after the first export has taken its snapshot.
+        late = Session(bind=db.engine)
+        late.add(models.Info(origin=late.query(models.Node).get(node.id),
+                             contents="late"))
+        late.flush()
+        late.query(models.Info).get(infos[0].id).fail()
+        late.flush()
+
+        self.db.add(models.Info(origin=node, contents="early"))
+        infos[1].fail()
+        self.db.commit()
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            marks = data.copy_tables(db.db_url, archive, tables=["info"])
+
+        late.commit()
+        late.close()
+
+        path = os.path.join(self.tmp, "test-data-2.zip")
+        with open(path, "wb") as file, data.Archive(file) as archive:
+            data.copy_tables(db.db_url, archive, tables=["info"], since=marks)
+
+        with zipfile.ZipFile(path) as archive:
+            rows = self.read_csv(archive, "data/info.csv")
+        assert (sorted((r["contents"], r["failed"]) for r in rows) ==
+                [("info 0", "t"), ("late", "f")])
+
+    def test_copy_tables_decompresses_blobs(self):
+        net, node, infos = self.add_infos(0)
+        contents = "a long, repetitive payload " * 20
+        self.db.add_all([BlobInfo(origin=node, contents=contents),
+                         BlobInfo(origin=node, contents=contents)])
+        self.db.commit()
+
+        with open(self.path, "wb") as file, data.Archive(file) as archive:
+            data.copy_tables(db.db_url, archive, tables=["info", "blob"])
+
+        with zipfile.ZipFile(self.path) as archive:
+            infos = self.read_csv(archive, "data/info.csv")
+            blobs = self.read_csv(archive, "data/blob.csv")
+
+        assert len(infos) == 2
+        assert all(info["contents"] == "" for info in infos)
+        assert [(b["hash"], b["data"]) for b in blobs] == \
+            [(infos[0]["contents_hash"], contents)]
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            return
+
+        path = os.path.join(self.tmp, "test-data.parquet.zip")
+        with open(path, "wb") as file, data.Archive(file) as archive:
+            data.copy_tables(db.db_url, archive, tables=["blob"],
+                             format="parquet")
+
+        with zipfile.ZipFile(path) as archive:
+            blobs = pq.read_table(StringIO(archive.read("data/blob.parquet")))
+        assert blobs.schema.field_by_name("data").type == pa.string()
+        assert self.column(blobs, "data") == [contents]
@@ -0,0 +1,97 @@
+"""Test the database connection settings."""
+
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+from wallace import db, models
+
+VARIABLES = ["WALLACE_PROCESS", "DYNO", "DATABASE_POOL_SIZE",
+             "WORKER_DATABASE_POOL_SIZE", "DATABASE_POOLER"]
+
+
+class TestDb(object):
+
+    def setup(self):
+        self.environ = dict((var, os.environ.pop(var)) for var in VARIABLES
+                            if var in os.environ)
+
+    def teardown(self):
+        for var in VARIABLES:
+            os.environ.pop(var, None)
+        os.environ.update(self.environ)
+
+    def test_process_role(self):
+        assert db.process_role() == "web"
+
+        os.environ["DYNO"] = "worker.2"
+        assert db.process_role() == "worker"
+
+        os.environ["WALLACE_PROCESS"] = "clock"
+        assert db.process_role() == "clock"
+
+        os.environ["WALLACE_PROCESS"] = "release"
+        assert db.process_role() == "web"
+
+    def test_engine_options(self):
+        url = "postgresql://postgres@localhost/wallace"
+
+        assert db.engine_options(url, "web")["pool_size"] == 10
+        assert db.engine_options(url, "worker")["pool_size"] == 1
+
+        os.environ["DATABASE_POOL_SIZE"] = "5"
+        os.environ["WORKER_DATABASE_POOL_SIZE"] = "2"
+        assert db.engine_options(url, "web")["pool_size"] == 5
+        assert db.engine_options(url, "worker")["pool_size"] == 2
+
+        os.environ["DATABASE_POOLER"] = "true"
+        assert db.engine_options(url, "web") == {"poolclass": NullPool}
+
+        assert db.engine_options("sqlite:///wallace.db", "web") == {}
+
+    def test_pool_status(self):
+        status = db.pool_status()
+        assert status["role"] == db.role
+        assert status["pool"] == type(db.engine.pool).__name__
+
+    def test_replica_routing(self):
+        session = db.init_db(drop_all=True)
+        previous = db.replica_engine
+        db.replica_engine = create_engine("sqlite://")
+        try:
+            assert session().get_bind() is db.engine
+
+            db.use_replica()
+            assert session().get_bind() is db.replica_engine
+            with db.replica_reads(False):
+                assert session().get_bind() is db.engine
+            assert session().get_bind() is db.replica_engine
+
+            session.add(models.Network())
+            session.flush()
+            assert session().get_bind() is db.engine
+        finally:
+            db.replica_engine = previous
+            session.rollback()
+            session.remove()
+
+    def test_single_transaction(self):
+        session = db.init_db(drop_all=True)
+
+        with db.single_transaction():
+            session.add(models.Network())
+            session.commit()
+            session.add(models.Network())
+            session.commit()
+        session.remove()
+        assert models.Network.query.count() == 2
+
+        try:
+            with db.single_transaction():
+                session.add(models.Network())
+                session.commit()
+                raise ValueError()
+        except ValueError:
+            pass
+        assert models.Network.query.count() == 2
+        session.remove()
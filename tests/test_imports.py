@@ -0,0 +1,65 @@
+"""Test that Wallace is quick to import."""
+
+import subprocess
+import sys
+
+#: modules that are slow to import and that the command line tools only
+#: import when a command needs them.
+HEAVY_MODULES = ["sqlalchemy", "psycopg2", "boto", "psiturk", "pexpect",
+                 "requests", "rq"]
+
+
+def run(statement):
+    """Run statement in a fresh interpreter and return what it prints."""
+    return subprocess.check_output([sys.executable, "-c", statement]).strip()
+
+
+def import_time(module):
+    """The fewest seconds importing module took in three fresh interpreters."""
+    return min(float(run(
+        "import time; start = time.time(); import {}; "
+        "print time.time() - start".format(module))) for _ in range(3))
+
+
+class TestImports(object):
+
+    def test_import_wallace_imports_no_models(self):
+        assert run(
+            "import sys, wallace; print 'wallace.models' in sys.modules"
+        ) == "False"
+
+    def test_import_command_line_imports_no_heavy_modules(self):
+        imported = run(
+            "import sys, wallace.command_line; "
+            "print ' '.join(sorted(m for m in {} if m in sys.modules))"
+            .format(HEAVY_MODULES))
+        assert imported == ""
+
+    def test_import_budget(self):
+        # The budget is measured on this machine: the command line tools must
+        # take less time to import than SQLAlchemy alone does.
+        budget = import_time("sqlalchemy")
+        elapsed = import_time("wallace.command_line")
+        assert elapsed < budget, \
+            "Importing took {:.2f}s, more than the {:.2f}s budget".format(
+                elapsed, budget)
+
+    def test_models_load_lazily(self):
+        assert run(
+            "import wallace; print wallace.nodes.Agent.__name__") == "Agent"
+
+    def test_models_define_wallace_types(self):
+        # Rows can only be loaded as the types SQLAlchemy knows about.
+        assert run(
+            "from wallace import models; "
+            "from sqlalchemy.orm import configure_mappers; "
+            "configure_mappers(); "
+            "print 'agent' in models.Node.__mapper__.polymorphic_map, "
+            "'chain' in models.Network.__mapper__.polymorphic_map"
+        ) == "True True"
+
+    def test_preload_imports_models(self):
+        assert run(
+            "import sys, wallace; wallace.preload(); "
+            "print all('wallace.' + m in sys.modules for m in wallace.__all__)"
+        ) == "True"
@@ -0,0 +1,43 @@
+"""Test the request metrics."""
+
+from wallace import db, metrics, models
+
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+        metrics.routes.clear()
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def test_histogram(self):
+        histogram = metrics.Histogram([1, 10])
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+
+        json = histogram.__json__()
+        assert json["buckets"] == {"1": 2, "10": 1, "+Inf": 1}
+        assert json["count"] == 4
+        assert json["sum"] == 56.5
+
+    def test_request_metrics(self):
+        metrics.instrument(db.engine)
+
+        metrics.start_request()
+        self.db.add(models.Network())
+        self.db.commit()
+        models.Network.query.all()
+        metrics.finish_request("GET /networks", 200)
+
+        report = metrics.report()["GET /networks"]
+        assert report["queries"]["count"] == 1
+        assert report["queries"]["sum"] >= 2
+        assert report["rows"]["sum"] >= 1
+        assert report["total_time"]["sum"] >= report["db_time"]["sum"]
+
+        # statements outside a request are not counted
+        models.Network.query.all()
+        assert metrics.report()["GET /networks"]["queries"]["count"] == 1
@@ -3,6 +3,7 @@
 from __future__ import print_function
 import sys
 from datetime import datetime
+from sqlalchemy import event
 from wallace import models, db, nodes
 from nose.tools import raises, assert_raises
 from wallace.nodes import Agent, Source
@@ -10,6 +11,22 @@ from wallace.information import Gene
 from wallace.transformations import Mutation
 
 
+class BigInfo(models.Info):
+    """An info that stores its contents as a blob."""
+
+    __mapper_args__ = {"polymorphic_identity": "big_info"}
+
+    blob_threshold = 10
+
+
+class JSONInfo(models.Info):
+    """An info with JSON contents."""
+
+    __mapper_args__ = {"polymorphic_identity": "json_info"}
+
+    json_contents = True
+
+
 class TestModels(object):
 
     def setup(self):
@@ -587,3 +604,159 @@ class TestModels(object):
         node = models.Node(network=net)
         self.add(node)
         assert node.creation_time is not None
+
+    def test_participant_aggregate(self):
+        participant = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="test")
+        experiment = models.Network()
+        experiment.role = "experiment"
+        catch = models.Network()
+        catch.role = "catch"
+        self.add(participant, experiment, catch)
+
+        for fitness, net in [(1, experiment), (3, experiment), (10, catch)]:
+            agent = nodes.Agent(network=net, participant=participant)
+            agent.fitness = fitness
+        models.Node(network=experiment, participant=participant)
+        self.db.commit()
+
+        assert participant.aggregate(
+            "fitness", type=Agent, network_role="experiment") == 2
+        assert participant.aggregate("fitness", "max", type=Agent) == 10
+        assert participant.aggregate("fitness", "count", type=Agent) == 3
+        assert participant.aggregate("id", "count") == 4
+        assert participant.aggregate(
+            "fitness", type=Agent, network_role="practice") is None
+        assert_raises(ValueError, participant.aggregate, "id", "median")
+
+    def test_info_lineage(self):
+        net = models.Network()
+        self.db.add(net)
+        node = models.Node(network=net)
+        self.add(node)
+
+        chain = [models.Info(origin=node, contents=str(i)) for i in range(5)]
+        branch = models.Info(origin=node, contents="branch")
+        self.add(*(chain + [branch]))
+
+        for info_in, info_out in zip(chain, chain[1:]):
+            self.db.add(models.Transformation(info_in=info_in,
+                                              info_out=info_out))
+        self.add(models.Transformation(info_in=chain[1], info_out=branch))
+
+        assert chain[4].ancestors() == chain[3::-1]
+        assert chain[0].ancestors() == []
+        assert chain[1].descendants() == [chain[2], branch, chain[3],
+                                          chain[4]]
+        assert branch.ancestors() == [chain[1], chain[0]]
+
+        forest = net.lineage_forest()
+        assert forest.keys() == [i.id for i in chain[:2]] + [
+            chain[2].id, branch.id, chain[3].id, chain[4].id]
+        assert forest[chain[0].id] == []
+        assert forest[branch.id] == [chain[1].id]
+
+    def test_info_blob_contents(self):
+        net = models.Network()
+        self.db.add(net)
+        node = models.Node(network=net)
+        self.add(node)
+
+        contents = "a long story " * 100
+        info1 = BigInfo(origin=node, contents=contents)
+        info2 = BigInfo(origin=node, contents=contents)
+        short = BigInfo(origin=node, contents="short")
+        self.add(info1, info2, short)
+
+        assert len(models.Blob.query.all()) == 1
+        assert info1.contents_hash == info2.contents_hash
+        assert info1._contents is None
+        assert short.contents_hash is None
+
+        self.db.expire_all()
+        assert info1.contents == contents
+        assert info2.contents == contents
+        assert short.contents == "short"
+        assert_raises(ValueError, setattr, info1, "contents", "new")
+        assert_raises(ValueError, models.Blob.load, "0" * 64)
+
+    def test_info_contents_deferred(self):
+        net = models.Network()
+        self.db.add(net)
+        node = models.Node(network=net)
+        self.add(node)
+        self.add(models.Info(origin=node, contents="foo"))
+        self.db.expire_all()
+
+        info = node.infos()[0]
+        assert "_contents" not in info.__dict__
+        assert info.contents == "foo"
+        assert "contents" not in info.__json__(contents=False)
+        self.db.expire_all()
+
+        info = net.infos(load_contents=True)[0]
+        assert info.__dict__["_contents"] == "foo"
+
+    def test_info_json_contents(self):
+        net = models.Network()
+        self.db.add(net)
+        node = models.Node(network=net)
+        self.add(node)
+
+        info = JSONInfo(origin=node, contents={"size": 3, "color": "red"})
+        self.add(info, JSONInfo(origin=node, contents={"size": 5}))
+        self.db.expire_all()
+
+        info = JSONInfo.query.get(info.id)
+        assert info.contents == '{"color": "red", "size": 3}'
+        assert info.parsed_contents == {"color": "red", "size": 3}
+        assert info.parsed_contents is info.parsed_contents
+        assert_raises(AttributeError, getattr,
+                      models.Info(origin=node), "parsed_contents")
+
+        red = JSONInfo.query\
+            .filter(JSONInfo.json_field("color") == "red").all()
+        assert red == [info]
+
+        # infos without JSON contents are skipped rather than parsed
+        self.add(models.Info(origin=node, contents="not json"),
+                 BigInfo(origin=node, contents="not json either"))
+        red = models.Info.query\
+            .filter(JSONInfo.json_field("color") == "red").all()
+        assert red == [info]
+        assert_raises(ValueError, BigInfo.json_field, "color")
+
+    def test_accessors_memoized(self):
+        net = models.Network()
+        self.add(net)
+        node = models.Node(network=net)
+        self.add(node)
+
+        statements = []
+        counting = [True]
+
+        def count(conn, cursor, statement, *args):
+            if counting[0] and "FROM node" in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            assert net.nodes() == [node]
+            assert net.nodes() == [node]
+            assert len(statements) == 1
+
+            # changes are seen, even before they are flushed
+            other = models.Node(network=net)
+            assert len(net.nodes()) == 2
+            other.fail()
+            assert net.nodes() == [node]
+
+            # the cache does not outlive the transaction
+            self.db.commit()
+            del statements[:]
+            net.nodes()
+            net.nodes()
+            assert len(statements) == 1
+        finally:
+            # listeners cannot be removed from engines in SQLAlchemy 0.8
+            counting[0] = False
@@ -106,6 +106,46 @@ class TestNetworks(object):
         assert net.vectors()[0].origin == agent1
         assert net.vectors()[0].destination == agent2
 
+    def test_network_snapshot(self):
+        net = networks.Network()
+        self.db.add(net)
+        self.db.commit()
+
+        agent1 = nodes.Agent(network=net)
+        agent2 = nodes.Agent(network=net)
+        agent1.connect(whom=agent2)
+        self.db.commit()
+        version = net.version()
+
+        info = models.Info(origin=agent1, contents="hello")
+        agent1.transmit(what=info, to_whom=agent2)
+        self.db.commit()
+        assert net.version() != version
+        version = net.version()
+
+        snapshot = net.snapshot()
+        assert snapshot["nodes"]["id"] == [agent1.id, agent2.id]
+        assert snapshot["nodes"]["type"] == ["agent", "agent"]
+        assert snapshot["vectors"]["origin_id"] == [agent1.id]
+        assert snapshot["vectors"]["destination_id"] == [agent2.id]
+        assert snapshot["infos"]["id"] == [info.id]
+        assert "contents" not in snapshot["infos"]
+        assert snapshot["transmissions"]["status"] == ["pending"]
+        assert net.snapshot(load_contents=True)["infos"]["contents"] == \
+            ["hello"]
+        assert net.version() == version
+
+        agent2.receive()
+        self.db.commit()
+        assert net.version() != version
+        version = net.version()
+
+        agent2.fail()
+        self.db.commit()
+        assert net.version() != version
+        assert net.snapshot()["nodes"]["id"] == [agent1.id]
+        assert len(net.snapshot(failed="all")["nodes"]["id"]) == 2
+
     def test_network_degrees(self):
         net = networks.Network()
         self.db.add(net)
@@ -363,6 +403,42 @@ class TestNetworks(object):
         assert agent3.is_connected(direction="to", whom=agent5)
         assert not agent3.is_connected(direction="to", whom=agent6)
 
+    def test_network_open_slots(self):
+        net = networks.Network()
+        net.max_size = 3
+        self.db.add(net)
+        self.db.commit()
+
+        assert net.open_slots() == 3
+        nodes.Agent(network=net)
+        assert net.open_slots() == 2
+
+        net.full = True
+        assert net.open_slots() == 0
+
+    def test_discrete_generational_open_slots(self):
+        net = networks.DiscreteGenerational(
+            generations=2, generation_size=2, initial_source=False)
+        self.db.add(net)
+        self.db.commit()
+
+        participant = models.Participant(
+            worker_id="1", assignment_id="1", hit_id="1", mode="test")
+        self.db.add(participant)
+        self.db.commit()
+
+        assert net.open_slots() == 2
+        nodes.Agent(network=net)
+        assert net.open_slots() == 1
+
+        # the next generation waits for the current one to finish
+        nodes.Agent(network=net, participant=participant)
+        assert net.open_slots() == 0
+
+        participant.status = "approved"
+        self.db.commit()
+        assert net.open_slots() == 2
+
     # def test_discrete_generational(self):
     #     n_gens = 4
     #     gen_size = 4
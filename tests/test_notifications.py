@@ -0,0 +1,154 @@
+"""Test how notifications are queued and processed."""
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import assert_raises
+from wallace import db, models
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    def delete(self, key):
+        self.keys.pop(key, None)
+
+
+class FakeQueue(object):
+
+    def __init__(self):
+        self.connection = FakeRedis()
+        self.jobs = []
+        self.job_ids = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def enqueue(self, func, *args):
+        self.jobs.append(args)
+
+
+class TestNotifications(object):
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+
+        # The worker runs the experiment from a copy of its directory.
+        example = os.path.join("examples", "bartlett1932")
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        shutil.copy(os.path.join(example, "config.txt"), self.tmp)
+        shutil.copy(os.path.join(example, "experiment.py"),
+                    os.path.join(self.tmp, "wallace_experiment.py"))
+        os.chdir(self.tmp)
+        sys.path.insert(0, self.tmp)
+
+        from wallace import custom
+        self.custom = custom
+        self.experiment = custom.experiment
+        custom.queue = FakeQueue()
+
+    def teardown(self):
+        self.custom.queue = None
+        self.custom.experiment = self.experiment
+        self.db.rollback()
+        self.db.close()
+        sys.path.remove(self.tmp)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def add_participant(self, assignment_id="A"):
+        participant = models.Participant(
+            worker_id="1", hit_id="1", assignment_id=assignment_id,
+            mode="debug")
+        self.db.add(participant)
+        self.db.commit()
+        return participant.id
+
+    def status(self, participant_id):
+        self.db.expire_all()
+        return models.Participant.query.get(participant_id).status
+
+    def test_enqueue_notification_until_processed(self):
+        enqueue = self.custom.enqueue_notification
+        first = self.add_participant()
+
+        assert enqueue("AssignmentReturned", assignment_id="A")
+        assert not enqueue("AssignmentReturned", assignment_id="A")
+        assert len(self.custom.queue) == 1
+
+        self.custom.worker_function("AssignmentReturned", "A", None)
+        assert self.status(first) == "returned"
+
+        # once processed it can be queued again, and is then ignored
+        assert enqueue("AssignmentReturned", assignment_id="A")
+        self.custom.worker_function("AssignmentReturned", "A", None)
+        assert self.status(first) == "returned"
+        assert models.Notification.query.count() == 1
+
+    def test_processed_notification_is_ignored_cheaply(self):
+        participant = self.add_participant()
+        self.custom.worker_function("AssignmentReturned", "A", None)
+        assert self.status(participant) == "returned"
+
+        class Unbuildable(self.experiment):
+            def __init__(self, session):
+                raise RuntimeError("The experiment was built.")
+
+        # repeats neither build the experiment nor save a notification
+        self.custom.experiment = Unbuildable
+        self.custom.worker_function("AssignmentReturned", "A", None)
+        self.custom.worker_function("AssignmentReturned", None, participant)
+        assert models.Notification.query.count() == 1
+        assert_raises(RuntimeError, self.custom.worker_function,
+                      "AssignmentAbandoned", "A", None)
+
+    def test_notification_index(self):
+        [index] = [i for i in models.Notification.__table__.indexes
+                   if i.name == "notification_assignment_id_event_type"]
+        assert [c.name for c in index.columns] == \
+            ["assignment_id", "event_type"]
+        assert not index.unique
+
+    def test_reused_assignment(self):
+        first = self.add_participant()
+        self.custom.worker_function("AssignmentReturned", "A", None)
+        assert self.status(first) == "returned"
+
+        # MTurk gives a returned assignment to the next worker
+        second = self.add_participant()
+        self.custom.worker_function("AssignmentReturned", "A", None)
+        assert self.status(first) == "returned"
+        assert self.status(second) == "returned"
+
+    def test_failed_notification_can_be_retried(self):
+        participant = self.add_participant()
+
+        class Failing(self.experiment):
+            def assignment_abandoned(self, participant):
+                raise RuntimeError("The experiment failed.")
+
+        self.custom.experiment = Failing
+        assert self.custom.enqueue_notification(
+            "AssignmentAbandoned", assignment_id="A")
+        assert_raises(RuntimeError, self.custom.worker_function,
+                      "AssignmentAbandoned", "A", None)
+        assert self.status(participant) == "working"
+        assert models.Notification.query.count() == 0
+
+        self.custom.experiment = self.experiment
+        assert self.custom.enqueue_notification(
+            "AssignmentAbandoned", assignment_id="A")
+        self.custom.worker_function("AssignmentAbandoned", "A", None)
+        assert self.status(participant) == "abandoned"
+        assert models.Notification.query.count() == 1
@@ -1,4 +1,4 @@
-from wallace import db
+from wallace import db, models
 import os
 
 
@@ -29,3 +29,70 @@ class TestRecruiters(object):
     def test_recruiter_simulated(self):
         from wallace.recruiters import SimulatedRecruiter
         assert SimulatedRecruiter()
+
+    def test_schedule_recruitment(self):
+        from wallace.experiments import Experiment
+
+        class FakeRecruiter(object):
+            def __init__(self, outstanding):
+                self.places = outstanding
+                self.recruited = 0
+                self.cancelled = 0
+
+            def outstanding(self):
+                return self.places
+
+            def recruit_participants(self, n=1):
+                self.recruited += n
+
+            def cancel_recruitment(self, n=1):
+                self.cancelled += n
+
+        exp = Experiment(self.db)
+        exp.verbose = False
+        net = models.Network(max_size=3)
+        arriving = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="test")
+        self.add(net, arriving)
+
+        # the participant without a node will take one of the slots
+        recruiter = FakeRecruiter(outstanding=0)
+        exp.recruiter = lambda: recruiter
+        assert exp.arriving_participants() == 1
+        assert exp.schedule_recruitment() == 2
+        assert recruiter.recruited == 2
+
+        models.Node(network=net, participant=arriving)
+        self.db.commit()
+        assert exp.arriving_participants() == 0
+
+        recruiter = FakeRecruiter(outstanding=5)
+        exp.recruiter = lambda: recruiter
+        assert exp.schedule_recruitment() == -3
+        assert recruiter.cancelled == 3
+
+    def test_surplus_arrivals_are_turned_away(self):
+        from wallace.experiments import Experiment
+        from wallace.networks import DiscreteGenerational
+        from wallace.nodes import Agent
+
+        exp = Experiment(self.db)
+        exp.verbose = False
+        net = DiscreteGenerational(
+            generations=2, generation_size=1, initial_source=False)
+        first = models.Participant(
+            worker_id="1", hit_id="1", assignment_id="1", mode="test")
+        second = models.Participant(
+            worker_id="2", hit_id="1", assignment_id="2", mode="test")
+        self.add(net, first, second)
+
+        assert exp.get_network_for_participant(first) == net
+        Agent(network=net, participant=first)
+        self.db.commit()
+
+        # the next generation waits for the first participant to finish
+        assert exp.get_network_for_participant(second) is None
+
+        first.status = "approved"
+        self.db.commit()
+        assert exp.get_network_for_participant(second) == net
@@ -0,0 +1,17 @@
+"""Test the Heroku worker."""
+
+from nose.tools import assert_raises
+from rq import SimpleWorker, Worker
+from wallace.heroku import worker
+
+
+class TestWorker(object):
+
+    def test_get_worker_class(self):
+        assert worker.get_worker_class("fork") is Worker
+        assert worker.get_worker_class("simple") is SimpleWorker
+
+    def test_get_worker_class_unknown(self):
+        with assert_raises(ValueError) as cm:
+            worker.get_worker_class("threaded")
+        assert '"fork", "simple"' in str(cm.exception)
@@ -1,14 +1,8 @@
 """This is Wallace, a platform for simulating evolution with people."""
 
-from . import (
-    models,
-    information,
-    nodes,
-    networks,
-    processes,
-    transformations,
-    experiments
-)
+import importlib
+import sys
+import types
 
 __all__ = (
     "models",
@@ -19,3 +13,45 @@ __all__ = (
     "transformations",
     "experiments"
 )
+
+
+class _Wallace(types.ModuleType):
+    """The wallace package, which imports its modules when they are used.
+
+    Importing the models means importing SQLAlchemy, which takes a while, so
+    importing wallace does not. The command line tools, which mostly don't
+    touch the database, start quickly, and ``wallace.models`` still works.
+    """
+
+    def __getattr__(self, name):
+        """Import the module called name."""
+        if name not in __all__:
+            raise AttributeError(
+                "module 'wallace' has no attribute '{}'".format(name))
+        return importlib.import_module("." + name, __name__)
+
+    def __dir__(self):
+        """List the modules as well as what has been imported."""
+        return sorted(set(self.__dict__) | set(__all__))
+
+
+def preload():
+    """Import all of Wallace's models and set up their mappers.
+
+    Processes that fork, like the RQ worker, call this first so that each
+    child starts with everything already imported rather than importing it
+    again itself.
+    """
+    from sqlalchemy.orm import configure_mappers
+
+    for name in __all__:
+        importlib.import_module("." + name, __name__)
+    configure_mappers()
+
+
+# Python 2 empties the namespace of a module once it is no longer referenced,
+# so keep the original module alive inside its replacement.
+_package = _Wallace(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -4,23 +4,20 @@
 """The Wallace command-line utility."""
 
 import click
+import gzip
 import time
 import uuid
-from psiturk.psiturk_config import PsiturkConfig
 import os
 import subprocess
 import shutil
-import pexpect
 import tempfile
 import inspect
 import imp
-import pkg_resources
 import re
-import psycopg2
-from wallace import db
+from wallace import data
 from wallace.version import __version__
-import requests
-import boto
+import json
+from urlparse import urlparse
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -50,6 +47,7 @@ def log(msg, delay=0.5, chevrons=True, verbose=True):
 
 def ensure_heroku_logged_in():
     """Ensure that the user is logged in to Heroku."""
+    import pexpect
     p = pexpect.spawn("heroku auth:whoami")
     p.interact()
     click.echo("")
@@ -92,6 +90,7 @@ def setup_experiment(debug=True, verbose=False, app=None):
             "Fix the errors and then try running 'wallace verify'.")
 
     # Verify that the Postgres server is running.
+    import psycopg2
     try:
         psycopg2.connect(database="x", user="postgres", password="nada")
     except psycopg2.OperationalError, e:
@@ -99,6 +98,7 @@ def setup_experiment(debug=True, verbose=False, app=None):
             raise RuntimeError("The Postgres server isn't running.")
 
     # Load psiTurk configuration.
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -109,6 +109,7 @@ def setup_experiment(debug=True, verbose=False, app=None):
     except:
         dependencies = []
 
+    import pkg_resources
     pkg_resources.require(dependencies)
 
     # Generate a unique id for this experiment.
@@ -212,6 +213,11 @@ def setup_experiment(debug=True, verbose=False, app=None):
             filename)
         shutil.copy(src, os.path.join(dst, filename))
 
+    for filename in frontend_files:
+        if filename.startswith("static/") and filename.endswith((".js",
+                                                                ".css")):
+            precompress(os.path.join(dst, filename))
+
     time.sleep(0.25)
 
     os.chdir(cwd)
@@ -219,10 +225,53 @@ def setup_experiment(debug=True, verbose=False, app=None):
     return (id, dst)
 
 
+def precompress(path):
+    """Write compressed copies of a static file for the server to send.
+
+    A gzipped copy is always written, and a brotli one too if the brotli
+    package is installed, so browsers that accept either get a smaller file
+    without the server compressing it on every request.
+    """
+    with open(path, "rb") as f:
+        contents = f.read()
+
+    # Leave the time out of the gzip header so the copy is reproducible.
+    with open(path + ".gz", "wb") as f:
+        gz = gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=0,
+                           compresslevel=9)
+        gz.write(contents)
+        gz.close()
+
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + ".br", "wb") as f:
+        f.write(brotli.compress(contents))
+
+
+def use_hot_air_recruiter(path="wallace_experiment.py"):
+    """Make the experiment at path recruit with the HotAirRecruiter."""
+    tmp = path + ".tmp"
+    os.rename(path, tmp)
+    with open(tmp, "r+") as f:
+        with open(path, "w+") as f2:
+            f2.write("from wallace.recruiters import HotAirRecruiter\n")
+            for idx, line in enumerate(f):
+                if re.search("\s*self.recruiter = (.*)", line):
+                    p = line.partition("self.recruiter =")
+                    f2.write(p[0] + p[1] + ' HotAirRecruiter\n')
+                else:
+                    f2.write(line)
+
+    os.remove(tmp)
+
+
 @wallace.command()
 @click.option('--app', default=None, help='ID of the deployed experiment')
 def summary(app):
     """Print a summary of a deployed app's status."""
+    import requests
     r = requests.get('https://{}.herokuapp.com/summary'.format(app))
     summary = r.json()['summary']
     click.echo("\nstatus \t| count")
@@ -242,6 +291,7 @@ def debug(verbose):
     (id, tmp) = setup_experiment(debug=True, verbose=verbose)
 
     # Drop all the tables from the database.
+    from wallace import db
     db.init_db(drop_all=True)
 
     # Switch to the temporary directory.
@@ -249,6 +299,7 @@ def debug(verbose):
     os.chdir(tmp)
 
     # Load psiTurk configuration.
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -261,18 +312,7 @@ def debug(verbose):
         os.path.join(cwd, config.get("Server Parameters", "logfile")))
 
     # Swap in the HotAirRecruiter
-    os.rename("wallace_experiment.py", "wallace_experiment_tmp.py")
-    with open("wallace_experiment_tmp.py", "r+") as f:
-        with open("wallace_experiment.py", "w+") as f2:
-            f2.write("from wallace.recruiters import HotAirRecruiter\n")
-            for idx, line in enumerate(f):
-                if re.search("\s*self.recruiter = (.*)", line):
-                    p = line.partition("self.recruiter =")
-                    f2.write(p[0] + p[1] + ' HotAirRecruiter\n')
-                else:
-                    f2.write(line)
-
-    os.remove("wallace_experiment_tmp.py")
+    use_hot_air_recruiter()
 
     # Set environment variables.
     aws_vars = ['aws_access_key_id', 'aws_secret_access_key', 'aws_region']
@@ -292,6 +332,7 @@ def debug(verbose):
     log("Starting up the server...")
 
     # Try opening the psiTurk shell.
+    import pexpect
     try:
         p = pexpect.spawn("psiturk")
         p.expect_exact("]$")
@@ -321,6 +362,7 @@ def debug(verbose):
 def scale_up_dynos(id):
     """Scale up the Heroku dynos."""
     # Load psiTurk configuration.
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -370,6 +412,7 @@ def deploy_sandbox_shared_setup(verbose=True, app=None, web_procs=1):
         time.sleep(0.5)
 
     # Load psiTurk configuration.
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -493,6 +536,7 @@ def deploy_sandbox_shared_setup(verbose=True, app=None, web_procs=1):
 def sandbox(verbose, app):
     """Deploy app using Heroku to the MTurk Sandbox."""
     # Load psiTurk configuration.
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -513,6 +557,7 @@ def sandbox(verbose, app):
 def deploy(verbose, app):
     """Deploy app using Heroku to MTurk."""
     # Load psiTurk configuration.
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -535,6 +580,7 @@ def qualify(qualification, value, worker):
     """Assign a qualification to a worker."""
     # create connection to AWS
     from boto.mturk.connection import MTurkConnection
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
     aws_access_key_id = config.get('AWS Access', 'aws_access_key_id')
@@ -619,26 +665,82 @@ def dump_database(id):
     return dump_path
 
 
+def s3_connection(config):
+    """Connect to S3.
+
+    If an ``s3_endpoint`` such as ``http://localhost:9000`` is given in the
+    AWS Access section of the config, connect to that S3-compatible service
+    instead.
+
+    """
+    kwargs = {}
+    if config.has_option('AWS Access', 's3_endpoint'):
+        from boto.s3.connection import OrdinaryCallingFormat
+        endpoint = urlparse(config.get('AWS Access', 's3_endpoint'))
+        kwargs = dict(
+            host=endpoint.hostname,
+            port=endpoint.port,
+            is_secure=(endpoint.scheme == "https"),
+            calling_format=OrdinaryCallingFormat())
+
+    import boto
+    return boto.connect_s3(
+        config.get('AWS Access', 'aws_access_key_id'),
+        config.get('AWS Access', 'aws_secret_access_key'),
+        **kwargs)
+
+
+def heroku_database_url(app, replica=False):
+    """Get the URL of an app's database from Heroku.
+
+    With replica, get the URL of its replica if it has one.
+    """
+    if replica:
+        url = subprocess.check_output(
+            "heroku config:get DATABASE_REPLICA_URL --app " + app,
+            shell=True).rstrip()
+        if url:
+            return url
+    return subprocess.check_output(
+        "heroku config:get DATABASE_URL --app " + app, shell=True).rstrip()
+
+
 def backup(app):
-    """Dump the database."""
-    dump_path = dump_database(app)
+    """Dump the database to S3.
 
+    The output of pg_dump is streamed to S3 as it is produced, so the dump
+    never touches the disk.
+
+    """
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
-    conn = boto.connect_s3(
-        config.get('AWS Access', 'aws_access_key_id'),
-        config.get('AWS Access', 'aws_secret_access_key'),
-    )
+    from boto.s3.connection import Location
+    conn = s3_connection(config)
 
     bucket = conn.create_bucket(
         app,
-        location=boto.s3.connection.Location.DEFAULT
+        location=Location.DEFAULT
     )
 
-    k = boto.s3.key.Key(bucket)
-    k.key = 'database.dump'
-    k.set_contents_from_filename(dump_path)
+    log("Streaming a backup of the database to S3...")
+    dump = subprocess.Popen(
+        ["pg_dump", "--format=custom", "--no-owner", "--no-acl",
+         heroku_database_url(app)],
+        stdout=subprocess.PIPE)
+
+    def check_dump():
+        if dump.wait() != 0:
+            raise RuntimeError("pg_dump failed, the backup was not saved.")
+
+    try:
+        data.upload_stream(dump.stdout, bucket, 'database.dump',
+                           check=check_dump)
+    finally:
+        dump.stdout.close()
+
+    k = bucket.get_key('database.dump')
     url = k.generate_url(expires_in=0, query_auth=False)
 
     log("The database backup URL is...")
@@ -678,6 +780,7 @@ def hibernate(app):
 @click.option('--databaseurl', default=None, help='URL of the database')
 def awaken(app, databaseurl):
     """Restore the database from a given url."""
+    from psiturk.psiturk_config import PsiturkConfig
     config = PsiturkConfig()
     config.load_config()
 
@@ -691,23 +794,29 @@ def awaken(app, databaseurl):
 
     subprocess.call("heroku pg:wait --app {}".format(app), shell=True)
 
-    conn = boto.connect_s3(
-        config.get('AWS Access', 'aws_access_key_id'),
-        config.get('AWS Access', 'aws_secret_access_key'),
-    )
-
+    conn = s3_connection(config)
     bucket = conn.get_bucket(app)
-    key = bucket.lookup('database.dump')
-    url = key.generate_url(expires_in=300)
 
-    cmd = "heroku pg:backups restore"
-    subprocess.call(
-        "{} '{}' DATABASE_URL --app {} --confirm {}".format(
-            cmd,
-            url,
-            app,
-            app),
-        shell=True)
+    # The backup is streamed from S3 into pg_restore as it is downloaded,
+    # and each part is checked before pg_restore gets it.
+    log("Restoring the database from S3...")
+    restore = subprocess.Popen(
+        ["pg_restore", "--no-owner", "--no-acl",
+         "-d", heroku_database_url(app)],
+        stdin=subprocess.PIPE)
+
+    try:
+        data.download_stream(bucket, 'database.dump', restore.stdin)
+        restore.stdin.close()
+    except:
+        restore.kill()
+        restore.wait()
+        log("The download failed, so the restore was stopped and the "
+            "database is incomplete.")
+        raise
+
+    if restore.wait() != 0:
+        log("pg_restore reported errors, please check the database.")
 
     subprocess.call(
         "heroku addons:create rediscloud:250 --app {}".format(app),
@@ -721,7 +830,16 @@ def awaken(app, databaseurl):
 @click.option('--app', default=None, help='ID of the deployed experiment')
 @click.option('--local', is_flag=True, flag_value=True,
               help='Export local data')
-def export(app, local):
+@click.option('--workers', default=4, help='Number of tables to copy at once')
+@click.option('--format', default="csv", type=click.Choice(data.FORMATS),
+              help='Format of the exported tables')
+@click.option('--joined', is_flag=True, flag_value=True,
+              help='Also export pre-joined tables')
+@click.option('--incremental', is_flag=True, flag_value=True,
+              help='Export only what has changed since the last export')
+@click.option('--replica', is_flag=True, flag_value=True,
+              help='Read incremental exports from the database replica')
+def export(app, local, workers, format, joined, incremental, replica):
     """Export the data."""
     print_header()
 
@@ -729,74 +847,76 @@ def export(app, local):
 
     id = str(app)
 
-    subdata_path = os.path.join("data", id, "data")
+    if not os.path.exists("data"):
+        os.makedirs("data")
 
-    # Create the data package
-    os.makedirs(subdata_path)
+    # The watermarks of the latest export are kept alongside the packages.
+    watermarks_path = os.path.join("data", id + "-watermarks.json")
+    since = None
 
-    # Copy the experiment code into a code/ subdirectory
-    try:
-        shutil.copyfile(
-            os.path.join("snapshots", id + "-code.zip"),
-            os.path.join("data", id, id + "-code.zip")
-        )
+    if incremental:
+        archive_path = os.path.join(
+            "data", "{}-data-{}.zip".format(id, time.strftime("%Y%m%d%H%M%S")))
+        if os.path.exists(watermarks_path):
+            with open(watermarks_path, "r") as file:
+                since = json.load(file)
+    else:
+        archive_path = os.path.join("data", id + "-data.zip")
 
-    except:
-        pass
+    # The data package is compressed straight into the archive, without
+    # first creating its contents on disk.
+    with open(archive_path, "wb") as file, data.Archive(file) as archive:
 
-    # Copy in the DATA readme.
-    # open(os.path.join(id, "README.txt"), "a").close()
+        # Copy the experiment code into the package.
+        code_path = os.path.join("snapshots", id + "-code.zip")
+        if os.path.exists(code_path):
+            archive.write(code_path, id + "-code.zip")
 
-    # Save the experiment id.
-    with open(os.path.join("data", id, "experiment_id.md"), "a+") as file:
-        file.write(id)
+        # Save the experiment id.
+        archive.writestr("experiment_id.md", id)
 
-    if not local:
-        # Export the logs
-        subprocess.call(
-            "heroku logs " +
-            "-n 10000 > " + os.path.join("data", id, "server_logs.md") +
-            " --app " + id,
-            shell=True)
+        from wallace import db
+        db_url = db.db_url
 
-        dump_path = dump_database(id)
+        if not local:
+            # Export the logs
+            logs = subprocess.check_output(
+                "heroku logs -n 10000 --app " + id, shell=True)
+            archive.writestr("server_logs.md", logs)
 
-        subprocess.call(
-            "pg_restore --verbose --clean -d wallace " +
-            os.path.join("data", id) + "/data.dump",
-            shell=True)
+            if incremental:
+                # Read the changes straight from the live database, rather
+                # than backing it up and restoring it locally.
+                db_url = heroku_database_url(id, replica=replica)
+            else:
+                dump_path = dump_database(id)
 
-    all_tables = [
-        "node",
-        "network",
-        "vector",
-        "info",
-        "transformation",
-        "transmission",
-        "participant",
-        "notification",
-        "question"
-    ]
+                subprocess.call(
+                    "pg_restore --verbose --clean -d wallace " + dump_path,
+                    shell=True)
 
-    for table in all_tables:
-        subprocess.call(
-            "psql -d wallace --command=\"\\copy " + table + " to \'" +
-            os.path.join(subdata_path, table) + ".csv\' csv header\"",
-            shell=True)
+        if since:
+            log("Exporting changes since the last export...")
+        else:
+            log("Exporting the tables...")
 
-    if not local:
-        os.remove(dump_path)
+        watermarks = data.copy_tables(
+            db_url,
+            archive,
+            joins=sorted(data.JOINS) if joined else None,
+            workers=workers,
+            format=format,
+            since=since)
 
-    log("Zipping up the package...")
-    shutil.make_archive(
-        os.path.join("data", id + "-data"),
-        "zip",
-        os.path.join("data", id)
-    )
+        archive.writestr("watermarks.json", json.dumps(watermarks))
+
+    with open(watermarks_path, "w") as file:
+        json.dump(watermarks, file)
 
-    shutil.rmtree(os.path.join("data", id))
+    if not local and not incremental:
+        shutil.rmtree(os.path.join("data", id))
 
-    log("Done. Data available in " + str(id) + ".zip")
+    log("Done. Data available in " + archive_path)
 
 
 @wallace.command()
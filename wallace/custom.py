@@ -2,32 +2,39 @@
 
 from flask import (
     Blueprint,
+    current_app,
+    g,
     request,
     Response,
+    send_file,
     send_from_directory,
-    render_template
+    render_template,
+    safe_join,
+    url_for
 )
+from jinja2 import meta
 
 from psiturk.psiturk_config import PsiturkConfig
 from psiturk.user_utils import PsiTurkAuthorization
 from psiturk.db import init_db
 from psiturk.db import db_session as session_psiturk
 
-from wallace import db, models
+from wallace import db, metrics, models
 
+import hashlib
 import imp
 import inspect
 import logging
+import mimetypes
 from operator import attrgetter
-from json import dumps
+from json import dumps, loads
 import os
+import re
 import requests
+import time
 import traceback
 from datetime import datetime
 
-from rq import Queue, get_current_job
-from worker import conn
-
 from sqlalchemy.orm.exc import NoResultFound
 
 # Load the configuration options.
@@ -45,17 +52,23 @@ LOG_LEVELS = [
 ]
 LOG_LEVEL = LOG_LEVELS[config.getint('Server Parameters', 'loglevel')]
 
-db.logger.setLevel(LOG_LEVEL)
+for logger in [db.logger, metrics.logger]:
+    logger.setLevel(LOG_LEVEL)
 
-if len(db.logger.handlers) == 0:
-    ch = logging.StreamHandler()
-    ch.setLevel(LOG_LEVEL)
-    ch.setFormatter(
-        logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    if len(logger.handlers) == 0:
+        ch = logging.StreamHandler()
+        ch.setLevel(LOG_LEVEL)
+        ch.setFormatter(
+            logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            )
         )
-    )
-    db.logger.addHandler(ch)
+        logger.addHandler(ch)
+
+# Count the queries each request makes.
+metrics.instrument(db.engine)
+if db.replica_engine is not None:
+    metrics.instrument(db.replica_engine)
 
 # Explore the Blueprint.
 custom_code = Blueprint(
@@ -66,8 +79,61 @@ custom_code = Blueprint(
 # Initialize the Wallace database.
 session = db.session
 
-# Connect to the Redis queue for notifications.
-q = Queue(connection=conn)
+#: how long, in seconds, browsers may keep static files whose url has a
+#: version, see :func:`static_url`.
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+#: how long, in seconds, browsers and crawlers may keep robots.txt.
+ROBOTS_MAX_AGE = 24 * 3600
+
+#: the encodings static files may have been compressed with in advance, best
+#: first, with the suffixes of the compressed files.
+PRECOMPRESSED = [("br", ".br"), ("gzip", ".gz")]
+
+#: the modification time and version of static files, by path.
+static_versions = {}
+
+#: the endpoints of routes that only read, which can read from a replica.
+read_only_routes = set()
+
+#: how many seconds after writing a participant's reads stay on the primary,
+#: so they see their own writes even if the replica lags behind.
+REPLICA_DELAY = float(os.environ.get("DATABASE_REPLICA_DELAY", 2))
+
+
+def read_only(func):
+    """Let a route read from the replica of the database."""
+    read_only_routes.add("{}.{}".format(custom_code.name, func.__name__))
+    return func
+
+
+#: the endpoints of routes that can be run as part of a batch.
+batch_routes = set()
+
+
+def batchable(func):
+    """Let a route be run as an operation of a batch."""
+    batch_routes.add("{}.{}".format(custom_code.name, func.__name__))
+    return func
+
+
+#: the Redis queue notifications are processed from, see get_queue().
+queue = None
+
+#: the longest, in seconds, a notification is remembered as queued, in case
+#: its job is lost without finishing. See enqueue_notification().
+NOTIFICATION_TTL = 3600
+
+
+def get_queue():
+    """The queue for notifications, connecting to Redis when first used."""
+    global queue
+    if queue is None:
+        from rq import Queue
+        from worker import conn
+        queue = Queue(connection=conn)
+    return queue
+
 
 # Load the experiment.
 try:
@@ -83,6 +149,14 @@ except ImportError:
     print "Error: Could not import experiment."
 
 
+def get_experiment():
+    """The experiment, which the operations of a batch share."""
+    exp = getattr(g, "batch_experiment", None)
+    if exp is None:
+        exp = experiment(session)
+    return exp
+
+
 """Define some canned response types."""
 
 
@@ -117,6 +191,51 @@ def error_response(error_type="Internal server error",
     return Response(dumps(data), status=status, mimetype='application/json')
 
 
+#: the variables that can differ between requests for the same page. The
+#: output of pages that use none of them is reused.
+REQUEST_VARIABLES = frozenset([
+    "hit_id", "assignment_id", "worker_id", "mode", "participant_id",
+    "request", "session", "g", "get_flashed_messages"])
+
+#: the pages rendered so far, by name. Each maps to the template, whether
+#: its output depends on the request and, if not, the output.
+page_cache = {}
+
+
+def page_variables(page):
+    """The variables a template, and those it includes or extends, use."""
+    env = current_app.jinja_env
+    tree = env.parse(env.loader.get_source(env, page)[0])
+    variables = meta.find_undeclared_variables(tree)
+    for other in meta.find_referenced_templates(tree):
+        if other is None:
+            # Which template is included is only known when rendering.
+            return REQUEST_VARIABLES
+        variables |= page_variables(other)
+    return variables
+
+
+def render_page(page, **context):
+    """Render a template, reusing its output if it ignores the request.
+
+    Many participants load the same ad, consent and instruction pages in
+    the first minutes of a HIT, and most of these don't use the request's
+    arguments. The output is rendered again if the template changes.
+    """
+    cached = page_cache.get(page)
+    if cached is None or not cached[0].is_up_to_date:
+        cached = page_cache[page] = [
+            current_app.jinja_env.get_template(page),
+            bool(page_variables(page) & REQUEST_VARIABLES),
+            None]
+    template, dynamic, output = cached
+    if dynamic or output is None:
+        output = render_template(page, **context)
+        if not dynamic:
+            cached[2] = output
+    return output
+
+
 def return_page(page):
     """Return a rendered template."""
     try:
@@ -124,7 +243,7 @@ def return_page(page):
         assignment_id = request.args['assignment_id']
         worker_id = request.args['worker_id']
         mode = request.args['mode']
-        return render_template(
+        return render_page(
             page,
             hit_id=hit_id,
             assignment_id=assignment_id,
@@ -134,7 +253,7 @@ def return_page(page):
     except:
         try:
             participant_id = request.args['participant_id']
-            return render_template(page, participant_id=participant_id)
+            return render_page(page, participant_id=participant_id)
         except:
             return error_response(error_type="{} args missing".format(page))
 
@@ -180,17 +299,117 @@ def error_page(participant=None, error_text=None, compensate=True,
 @custom_code.teardown_request
 def shutdown_session(_=None):
     """Rollback and close session at end of a request."""
+    # The operations of a batch share the session of the batch's request.
+    if getattr(g, "batch_experiment", None) is not None:
+        return
     session.remove()
     db.logger.debug('Closing Wallace DB session at flask request end')
 
 
+@custom_code.before_app_request
+def start_metrics():
+    """Start recording the cost of a request."""
+    metrics.start_request()
+
+
+@custom_code.before_app_request
+def choose_database():
+    """Read from the replica in read only routes.
+
+    Unless the participant wrote something in the last few seconds, which the
+    replica may not have yet.
+    """
+    if db.replica_engine is None or request.endpoint not in read_only_routes:
+        return
+    try:
+        last_write = float(request.cookies.get("wallace_wrote", 0))
+    except ValueError:
+        last_write = 0
+    if time.time() - last_write > REPLICA_DELAY:
+        db.use_replica()
+
+
+@custom_code.after_app_request
+def remember_writes(response):
+    """Note when a participant last wrote, so they can read their writes."""
+    if db.replica_engine is not None and session().wrote:
+        response.set_cookie("wallace_wrote", str(time.time()))
+    return response
+
+
+@custom_code.before_app_request
+def serve_precompressed():
+    """Send the compressed copy of a static file, if there is one.
+
+    Wallace compresses its frontend files when the experiment is packaged,
+    see :func:`~wallace.command_line.precompress`.
+    """
+    if request.endpoint != "static":
+        return None
+    path = safe_join(current_app.static_folder, request.view_args["filename"])
+    for encoding, suffix in PRECOMPRESSED:
+        if (request.accept_encodings[encoding] and
+                os.path.isfile(path + suffix)):
+            response = send_file(
+                path + suffix,
+                mimetype=mimetypes.guess_type(path)[0] or
+                "application/octet-stream",
+                conditional=True)
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            return response
+
+
+@custom_code.after_app_request
+def cache_static(response):
+    """Let browsers keep static files whose url has a version for long."""
+    if (request.endpoint == "static" and "v" in request.args and
+            response.status_code in [200, 304]):
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+    return response
+
+
+@custom_code.app_template_global()
+def static_url(filename):
+    """The url of a static file, with a version that changes with the file.
+
+    Use it in templates, as in ``{{ static_url("scripts/wallace.js") }}``, so
+    that browsers keep the file until it changes rather than checking it is
+    still current on every page. Files that don't exist get a plain url.
+    """
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return url_for("static", filename=filename)
+    version = static_versions.get(path)
+    if version is None or version[0] != modified:
+        with open(path, "rb") as f:
+            version = static_versions[path] = (
+                modified, hashlib.md5(f.read()).hexdigest()[:12])
+    return url_for("static", filename=filename, v=version[1])
+
+
+@custom_code.after_app_request
+def record_metrics(response):
+    """Record the cost of a request against its route."""
+    rule = request.url_rule.rule if request.url_rule else "<unknown>"
+    metrics.finish_request("{} {}".format(request.method, rule),
+                           response.status_code)
+    return response
+
+
 """Define routes for managing an experiment and the participants."""
 
 
 @custom_code.route('/robots.txt')
 def static_from_root():
     """"Serve robots.txt from static file."""
-    return send_from_directory('static', request.path[1:])
+    response = send_from_directory('static', request.path[1:],
+                                   cache_timeout=ROBOTS_MAX_AGE)
+    response.cache_control.public = True
+    return response
 
 
 @custom_code.route('/launch', methods=['POST'])
@@ -216,18 +435,36 @@ def compute_bonus():
 
 
 @custom_code.route('/summary', methods=['GET'])
+@read_only
 def summary():
     """Summarize the participants' status codes."""
-    exp = experiment(session)
+    exp = get_experiment()
     return success_response(field="summary",
                             data=exp.log_summary(),
                             request_type="summary")
 
 
+@custom_code.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Report what requests to each route have cost and the pool's state.
+
+    Only available from the same machine or with the psiTurk login.
+    """
+    def report():
+        return success_response(field="metrics",
+                                data={"routes": metrics.report(),
+                                      "pool": db.pool_status()},
+                                request_type="metrics")
+
+    if request.remote_addr in ["127.0.0.1", "::1"]:
+        return report()
+    return myauth.requires_auth(report)()
+
+
 @custom_code.route('/quitter', methods=['POST'])
 def quitter():
     """Overide the psiTurk quitter route."""
-    exp = experiment(session)
+    exp = get_experiment()
     exp.log("Quitter route was hit.")
 
     return Response(
@@ -237,9 +474,11 @@ def quitter():
 
 
 @custom_code.route('/experiment_property/<prop>', methods=['GET'])
+@read_only
+@batchable
 def experiment_property(prop):
     """Get a property of the experiment by name."""
-    exp = experiment(session)
+    exp = get_experiment()
     p = getattr(exp, prop)
     return success_response(field=prop, data=p, request_type=prop)
 
@@ -310,7 +549,7 @@ def request_parameter(parameter, parameter_type=None, default=None,
     or if the parameter is found but is of the wrong type
     then a Response object is returned
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameter
     try:
@@ -380,6 +619,7 @@ def assign_properties(thing):
 
 @custom_code.route("/participant/<worker_id>/<hit_id>/<assignment_id>/<mode>",
                    methods=["POST"])
+@batchable
 def create_participant(worker_id, hit_id, assignment_id, mode):
     """Create a participant.
 
@@ -402,12 +642,15 @@ def create_participant(worker_id, hit_id, assignment_id, mode):
     session.commit()
 
     # make a psiturk participant too, for now
-    from psiturk.models import Participant as PsiturkParticipant
-    psiturk_participant = PsiturkParticipant(workerid=worker_id,
-                                             assignmentid=assignment_id,
-                                             hitid=hit_id)
-    session_psiturk.add(psiturk_participant)
-    session_psiturk.commit()
+    def create_psiturk_participant():
+        from psiturk.models import Participant as PsiturkParticipant
+        psiturk_participant = PsiturkParticipant(workerid=worker_id,
+                                                 assignmentid=assignment_id,
+                                                 hitid=hit_id)
+        session_psiturk.add(psiturk_participant)
+        session_psiturk.commit()
+
+    db.after_commit(create_psiturk_participant)
 
     # return the data
     return success_response(field="participant",
@@ -416,6 +659,8 @@ def create_participant(worker_id, hit_id, assignment_id, mode):
 
 
 @custom_code.route("/participant/<participant_id>", methods=["GET"])
+@read_only
+@batchable
 def get_participant(participant_id):
     """Get the participant with the given id."""
     try:
@@ -432,6 +677,8 @@ def get_participant(participant_id):
 
 
 @custom_code.route("/network/<network_id>", methods=["GET"])
+@read_only
+@batchable
 def get_network(network_id):
     """Get the network with the given id."""
     try:
@@ -447,7 +694,45 @@ def get_network(network_id):
                             request_type="network get")
 
 
+@custom_code.route("/network/<network_id>/snapshot", methods=["GET"])
+@read_only
+@batchable
+def network_snapshot(network_id):
+    """Get the nodes, vectors, infos and transmissions of a network.
+
+    They are returned as columns, see Network.snapshot(). You can pass
+    failed (True/False) and contents=True to include the contents of the
+    infos. The response has an ETag, and if the network has not changed since
+    the ETag passed as If-None-Match the snapshot is not sent again.
+    """
+    failed = request_parameter(parameter="failed",
+                               parameter_type="bool", default=False)
+    contents = request_parameter(parameter="contents",
+                                 parameter_type="bool", default=False)
+    for x in [failed, contents]:
+        if type(x) == Response:
+            return x
+
+    net = models.Network.query.get(network_id)
+    if net is None:
+        return error_response(
+            error_type="/network/snapshot GET: no network found",
+            status=403)
+
+    etag = "{}-{:d}{:d}".format(net.version(), failed, contents)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = success_response(
+            field="snapshot",
+            data=net.snapshot(failed=failed, load_contents=contents),
+            request_type="network snapshot")
+    response.set_etag(etag)
+    return response
+
+
 @custom_code.route("/question/<participant_id>", methods=["POST"])
+@batchable
 def create_question(participant_id):
     """Send a POST request to the question table.
 
@@ -491,6 +776,8 @@ def create_question(participant_id):
 
 
 @custom_code.route("/node/<int:node_id>/neighbors", methods=["GET"])
+@read_only
+@batchable
 def node_neighbors(node_id):
     """Send a GET request to the node table.
 
@@ -503,7 +790,7 @@ def node_neighbors(node_id):
     After getting the neighbours it also calls
     exp.node_get_request()
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     node_type = request_parameter(parameter="node_type",
@@ -546,6 +833,7 @@ def node_neighbors(node_id):
 
 
 @custom_code.route("/node/<participant_id>", methods=["POST"])
+@batchable
 def create_node(participant_id):
     """Send a POST request to the node table.
 
@@ -555,7 +843,7 @@ def create_node(participant_id):
         3. exp.add_node_to_network
         4. exp.node_post_request
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # Get the participant.
     try:
@@ -608,6 +896,8 @@ def create_node(participant_id):
 
 
 @custom_code.route("/node/<int:node_id>/vectors", methods=["GET"])
+@read_only
+@batchable
 def node_vectors(node_id):
     """Get the vectors of a node.
 
@@ -615,7 +905,7 @@ def node_vectors(node_id):
     You can pass direction (incoming/outgoing/all) and failed
     (True/False/all).
     """
-    exp = experiment(session)
+    exp = get_experiment()
     # get the parameters
     direction = request_parameter(parameter="direction", default="all")
     failed = request_parameter(parameter="failed",
@@ -646,13 +936,14 @@ def node_vectors(node_id):
 
 @custom_code.route("/node/<int:node_id>/connect/<int:other_node_id>",
                    methods=["POST"])
+@batchable
 def connect(node_id, other_node_id):
     """Connect to another node.
 
     The ids of both nodes must be speficied in the url.
     You can also pass direction (to/from/both) as an argument.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     direction = request_parameter(parameter="direction", default="to")
@@ -693,12 +984,22 @@ def connect(node_id, other_node_id):
 
 
 @custom_code.route("/info/<int:node_id>/<int:info_id>", methods=["GET"])
+@read_only
+@batchable
 def get_info(node_id, info_id):
     """Get a specific info.
 
     Both the node and info id must be specified in the url.
+    You can also pass contents=False to leave out the contents.
     """
-    exp = experiment(session)
+    exp = get_experiment()
+
+    # get the parameters
+    contents = request_parameter(parameter="contents",
+                                 parameter_type="bool",
+                                 default=True)
+    if type(contents) == Response:
+        return contents
 
     # check the node exists
     node = models.Node.query.get(node_id)
@@ -729,18 +1030,21 @@ def get_info(node_id, info_id):
 
     # return the data
     return success_response(field="info",
-                            data=info.__json__(),
+                            data=info.__json__(contents=contents),
                             request_type="info get")
 
 
 @custom_code.route("/node/<int:node_id>/infos", methods=["GET"])
+@read_only
+@batchable
 def node_infos(node_id):
     """Get all the infos of a node.
 
     The node id must be specified in the url.
-    You can also pass info_type.
+    You can also pass info_type, and contents=False to leave out the
+    contents of the infos.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     info_type = request_parameter(parameter="info_type",
@@ -749,6 +1053,12 @@ def node_infos(node_id):
     if type(info_type) == Response:
         return info_type
 
+    contents = request_parameter(parameter="contents",
+                                 parameter_type="bool",
+                                 default=True)
+    if type(contents) == Response:
+        return contents
+
     # check the node exists
     node = models.Node.query.get(node_id)
     if node is None:
@@ -756,7 +1066,7 @@ def node_infos(node_id):
 
     try:
         # execute the request:
-        infos = node.infos(type=info_type)
+        infos = node.infos(type=info_type, load_contents=contents)
 
         # ping the experiment
         exp.info_get_request(
@@ -770,18 +1080,22 @@ def node_infos(node_id):
                               participant=node.participant)
 
     return success_response(field="infos",
-                            data=[i.__json__() for i in infos],
+                            data=[i.__json__(contents=contents)
+                                  for i in infos],
                             request_type="infos")
 
 
 @custom_code.route("/node/<int:node_id>/received_infos", methods=["GET"])
+@read_only
+@batchable
 def node_received_infos(node_id):
     """Get all the infos a node has been sent and has received.
 
     You must specify the node id in the url.
-    You can also pass the info type.
+    You can also pass the info type, and contents=False to leave out the
+    contents of the infos.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     info_type = request_parameter(parameter="info_type",
@@ -790,13 +1104,19 @@ def node_received_infos(node_id):
     if type(info_type) == Response:
         return info_type
 
+    contents = request_parameter(parameter="contents",
+                                 parameter_type="bool",
+                                 default=True)
+    if type(contents) == Response:
+        return contents
+
     # check the node exists
     node = models.Node.query.get(node_id)
     if node is None:
         return error_response(error_type="/node/infos, node does not exist")
 
     # execute the request:
-    infos = node.received_infos(type=info_type)
+    infos = node.received_infos(type=info_type, load_contents=contents)
 
     try:
         # ping the experiment
@@ -811,11 +1131,13 @@ def node_received_infos(node_id):
                               participant=node.participant)
 
     return success_response(field="infos",
-                            data=[i.__json__() for i in infos],
+                            data=[i.__json__(contents=contents)
+                                  for i in infos],
                             request_type="received infos")
 
 
 @custom_code.route("/info/<int:node_id>", methods=["POST"])
+@batchable
 def info_post(node_id):
     """Create an info.
 
@@ -826,7 +1148,7 @@ def info_post(node_id):
     If info_type is a custom subclass of Info it must be
     added to the known_classes of the experiment class.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     info_type = request_parameter(parameter="info_type",
@@ -865,6 +1187,7 @@ def info_post(node_id):
 
 
 @custom_code.route("/node/<int:node_id>/transmissions", methods=["GET"])
+@batchable
 def node_transmissions(node_id):
     """Get all the transmissions of a node.
 
@@ -872,7 +1195,7 @@ def node_transmissions(node_id):
     You can also pass direction (to/from/all) or status (all/pending/received)
     as arguments.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     direction = request_parameter(parameter="direction", default="incoming")
@@ -910,6 +1233,7 @@ def node_transmissions(node_id):
 
 
 @custom_code.route("/node/<int:node_id>/transmit", methods=["POST"])
+@batchable
 def node_transmit(node_id):
     """Transmit to another node.
 
@@ -941,7 +1265,7 @@ def node_transmit(node_id):
         },
     });
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     what = request_parameter(parameter="what", optional=True)
     to_whom = request_parameter(parameter="to_whom", optional=True)
@@ -1007,6 +1331,8 @@ def node_transmit(node_id):
 
 
 @custom_code.route("/node/<int:node_id>/transformations", methods=["GET"])
+@read_only
+@batchable
 def transformation_get(node_id):
     """Get all the transformations of a node.
 
@@ -1014,7 +1340,7 @@ def transformation_get(node_id):
 
     You can also pass transformation_type.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # get the parameters
     transformation_type = request_parameter(parameter="transformation_type",
@@ -1050,13 +1376,14 @@ def transformation_get(node_id):
 @custom_code.route(
     "/transformation/<int:node_id>/<int:info_in_id>/<int:info_out_id>",
     methods=["POST"])
+@batchable
 def transformation_post(node_id, info_in_id, info_out_id):
     """Transform an info.
 
     The ids of the node, info in and info out must all be in the url.
     You can also pass transformation_type.
     """
-    exp = experiment(session)
+    exp = get_experiment()
 
     # Get the parameters.
     transformation_type = request_parameter(parameter="transformation_type",
@@ -1104,6 +1431,129 @@ def transformation_post(node_id, info_in_id, info_out_id):
                             request_type="transformation post")
 
 
+class BatchFailed(Exception):
+    """An operation of a batch failed."""
+
+    def __init__(self, index, response):
+        """Record which operation failed and its response."""
+        super(BatchFailed, self).__init__(index)
+        self.index = index
+        self.response = response
+
+
+def batch_url(url, results):
+    """Fill in the references to earlier responses in a batch operation's url.
+
+    ``{index.key.key}`` is replaced by that part of the response of the
+    operation at that index, which must be a number or a string. Anything
+    else in the url is used as it is.
+    """
+    def resolve(match):
+        path = match.group(1).split(".")
+        resolved = results[int(path[0])]
+        for key in path[1:]:
+            if not isinstance(resolved, dict):
+                raise KeyError(key)
+            resolved = resolved[key]
+        if not isinstance(resolved, (int, long, basestring)) or \
+                isinstance(resolved, bool):
+            raise ValueError("{} is not a number or a string."
+                             .format(match.group(1)))
+        return unicode(resolved)
+
+    return re.sub(r"\{(\d+(?:\.[^{}.]+)*)\}", resolve, url)
+
+
+def batch_reference(value, results):
+    """Resolve a value of a batch operation's data.
+
+    ``{"$ref": [index, key, ...]}`` is replaced by that part of the response
+    of the operation at that index. Anything else is used as it is.
+    """
+    if not isinstance(value, dict) or "$ref" not in value:
+        return value
+    path = value["$ref"]
+    resolved = results[path[0]]
+    for key in path[1:]:
+        resolved = resolved[key]
+    return resolved
+
+
+def batch_operation(operation, results):
+    """Run an operation of a batch, returning its response."""
+    try:
+        method = operation["method"].upper()
+        url = batch_url(operation["url"], results)
+        data = dict(
+            (key, batch_reference(value, results))
+            for key, value in operation.get("data", {}).items())
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return error_response(error_type="/batch, malformed operation")
+
+    if method == "GET":
+        context = current_app.test_request_context(
+            url, method=method, query_string=data)
+    else:
+        context = current_app.test_request_context(
+            url, method=method, data=data)
+
+    with context:
+        if (request.url_rule is None or
+                request.url_rule.endpoint not in batch_routes):
+            return error_response(
+                error_type="/batch, {} {} can't be batched".format(
+                    method, url))
+        view = current_app.view_functions[request.url_rule.endpoint]
+        return current_app.make_response(view(**request.view_args))
+
+
+@custom_code.route("/batch", methods=["POST"])
+def batch():
+    """Run several requests in a single transaction.
+
+    ``operations`` is a json list of requests, each with a ``method``, a
+    ``url`` and, optionally, ``data``. They are run in order, sharing one
+    experiment, and the responses of them all are returned as ``results``.
+    The url of an operation can use the responses of earlier ones, as in
+    ``/node/{0.node.id}/received_infos``, and so can its data, with values
+    like ``{"$ref": [0, "node", "id"]}``. If any operation fails
+    nothing is saved and its response is returned, with its index as
+    ``failed``, and nothing queued by the operations is sent.
+    """
+    body = request.get_json(silent=True)
+    if body is None:
+        try:
+            body = {"operations": loads(request.values["operations"])}
+        except (KeyError, ValueError):
+            body = None
+    if not isinstance(body, dict) or \
+            not isinstance(body.get("operations"), list):
+        return error_response(error_type="/batch, no operations")
+
+    results = []
+    g.batch_experiment = experiment(session)
+    try:
+        with db.single_transaction():
+            for index, operation in enumerate(body["operations"]):
+                if not isinstance(operation, dict):
+                    operation = {}
+                response = batch_operation(operation, results)
+                if response.status_code != 200:
+                    raise BatchFailed(index, response)
+                results.append(loads(response.data))
+    except BatchFailed as e:
+        data = loads(e.response.data)
+        data["failed"] = e.index
+        return Response(dumps(data), status=e.response.status_code,
+                        mimetype='application/json')
+    finally:
+        g.batch_experiment = None
+
+    return success_response(field="results",
+                            data=results,
+                            request_type="batch")
+
+
 @custom_code.route("/notifications", methods=["POST", "GET"])
 def api_notifications():
     """Receive MTurk REST notifications."""
@@ -1113,13 +1563,42 @@ def api_notifications():
     # Add the notification to the queue.
     db.logger.debug('rq: Queueing %s with id: %s for worker_function',
                     event_type, assignment_id)
-    q.enqueue(worker_function, event_type, assignment_id, None)
-    db.logger.debug('rq: Submitted Queue Length: %d (%s)', len(q),
-                    ', '.join(q.job_ids))
+    if not enqueue_notification(event_type, assignment_id=assignment_id):
+        db.logger.debug('rq: %s for %s is already queued',
+                        event_type, assignment_id)
+    # Listing the queue's jobs reads the whole queue from Redis.
+    elif db.logger.isEnabledFor(logging.DEBUG):
+        q = get_queue()
+        db.logger.debug('rq: Submitted Queue Length: %d (%s)', len(q),
+                        ', '.join(q.job_ids))
 
     return success_response(request_type="notification")
 
 
+def notification_key(event_type, assignment_id, participant_id):
+    """The Redis key marking a notification as queued."""
+    return "wallace:notification:{}:{}:{}".format(
+        event_type, assignment_id, participant_id)
+
+
+def enqueue_notification(event_type, assignment_id=None, participant_id=None):
+    """Queue a notification for the worker unless it already is.
+
+    MTurk, the clock and check_for_duplicate_assignments can all send the
+    same notification more than once. A notification is not queued again
+    while it is waiting or being processed; once its job finishes, whether
+    or not it succeeds, it can be queued again, and the worker ignores it
+    if the participant is no longer working. Returns whether the
+    notification was queued.
+    """
+    q = get_queue()
+    key = notification_key(event_type, assignment_id, participant_id)
+    if not q.connection.set(key, 1, nx=True, ex=NOTIFICATION_TTL):
+        return False
+    q.enqueue(worker_function, event_type, assignment_id, participant_id)
+    return True
+
+
 def check_for_duplicate_assignments(participant):
     """Check that the assignment_id of the participant is unique.
 
@@ -1130,16 +1609,75 @@ def check_for_duplicate_assignments(participant):
     duplicates = [p for p in participants if (p.id != participant.id and
                                               p.status == "working")]
     for d in duplicates:
-        q.enqueue(worker_function, "AssignmentAbandoned", None, d.id)
+        db.after_commit(
+            enqueue_notification, "AssignmentAbandoned", participant_id=d.id)
 
 
 @db.scoped_session_decorator
 def worker_function(event_type, assignment_id, participant_id):
     """Process the notification."""
-    db.logger.debug("rq: worker_function working on job id: %s",
-                    get_current_job().id)
-    db.logger.debug('rq: Received Queue Length: %d (%s)', len(q),
-                    ', '.join(q.job_ids))
+    try:
+        process_notification(event_type, assignment_id, participant_id)
+    finally:
+        get_queue().connection.delete(
+            notification_key(event_type, assignment_id, participant_id))
+
+
+#: the notifications that only change participants who are still working.
+STATUS_EVENTS = ["AssignmentAbandoned", "AssignmentReturned",
+                 "AssignmentSubmitted", "NotificationMissing"]
+
+
+def already_processed(event_type, assignment_id, participant_id):
+    """Whether a notification has been processed already.
+
+    A notification that changes a participant's status has been processed
+    once it has been saved and nobody it could be about is still working.
+    This is checked without taking any locks, so that repeats are dropped
+    before the experiment is built.
+    """
+    if event_type not in STATUS_EVENTS:
+        return False
+    working = models.Participant.query.filter_by(status="working")
+    if assignment_id is not None:
+        seen = models.Notification.query.filter_by(
+            assignment_id=assignment_id, event_type=event_type)
+        if not db.session.query(seen.exists()).scalar():
+            return False
+        working = working.filter_by(assignment_id=assignment_id)
+    else:
+        working = working.filter_by(id=participant_id)
+    return not db.session.query(working.exists()).scalar()
+
+
+def process_notification(event_type, assignment_id, participant_id):
+    """Update the participant a notification is about.
+
+    Notifications that have already been processed are ignored, and not
+    saved. Otherwise the participant's row is locked until the notification
+    is saved, so if the same notification is processed twice at once the
+    second waits, then finds the participant is no longer working and leaves
+    them alone.
+    """
+    if assignment_id is None and participant_id is None:
+        raise ValueError(
+            "Error: worker_function needs either an assignment_id or a "
+            "participant_id, they cannot both be None")
+
+    if already_processed(event_type, assignment_id, participant_id):
+        db.logger.debug("rq: %s for assignment %s, participant %s has "
+                        "already been processed", event_type, assignment_id,
+                        participant_id)
+        return
+
+    if db.logger.isEnabledFor(logging.DEBUG):
+        from rq import get_current_job
+        q = get_queue()
+        job = get_current_job()
+        db.logger.debug("rq: worker_function working on job id: %s",
+                        job.id if job is not None else None)
+        db.logger.debug('rq: Received Queue Length: %d (%s)', len(q),
+                        ', '.join(q.job_ids))
 
     exp = experiment(session)
     key = "-----"
@@ -1153,11 +1691,11 @@ def worker_function(event_type, assignment_id, participant_id):
             assignment_id=assignment_id,
             event_type=event_type)
         session.add(notif)
-        session.commit()
 
         # try to identify the participant
         participants = models.Participant.query\
             .filter_by(assignment_id=assignment_id)\
+            .with_lockmode("update")\
             .all()
 
         # if there are multiple participants select the most recent
@@ -1169,6 +1707,7 @@ def worker_function(event_type, assignment_id, participant_id):
                     participant = min(participants,
                                       key=attrgetter('creation_time'))
                 else:
+                    session.commit()
                     return None
             else:
                 participant = max(participants,
@@ -1178,19 +1717,18 @@ def worker_function(event_type, assignment_id, participant_id):
         elif len(participants) == 0:
             exp.log("Warning: No participants associated with this "
                     "assignment_id. Notification will not be processed.", key)
+            session.commit()
             return None
 
         # if theres only one participant (this is good) select them
         else:
             participant = participants[0]
 
-    elif participant_id is not None:
-        participant = models.Participant.query\
-            .filter_by(id=participant_id).all()[0]
     else:
-        raise ValueError(
-            "Error: worker_function needs either an assignment_id or a "
-            "participant_id, they cannot both be None")
+        participant = models.Participant.query\
+            .filter_by(id=participant_id)\
+            .with_lockmode("update")\
+            .all()[0]
 
     participant_id = participant.id
 
@@ -0,0 +1,898 @@
+"""Export experiment data from the database."""
+
+import base64
+import binascii
+from collections import deque
+import csv
+import hashlib
+from multiprocessing.pool import ThreadPool
+import Queue
+from StringIO import StringIO
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
+
+#: the tables that make up a Wallace data package.
+TABLES = [
+    "node",
+    "network",
+    "vector",
+    "info",
+    "blob",
+    "transformation",
+    "transmission",
+    "participant",
+    "notification",
+    "question"
+]
+
+#: columns, besides ``time_of_death``, that are set when a row changes after
+#: it was created, by table.
+CHANGE_COLUMNS = {
+    "participant": ["end_time"],
+    "transmission": ["receive_time"],
+}
+
+#: tables whose rows never change once they are written.
+APPEND_ONLY = ["blob"]
+
+#: columns that are stored compressed with zlib, by table. They are
+#: decompressed as they are exported.
+COMPRESSED_COLUMNS = {
+    "blob": ["data"],
+}
+
+#: how many of the highest ids of each table an incremental export checks
+#: for rows that were still being written when the previous export ran.
+PENDING_IDS = 10000
+
+#: how far back, in seconds, before the latest change seen by the previous
+#: export an incremental export looks for changes that were committed late.
+OVERLAP = 3600
+
+#: the formats tables can be exported in.
+FORMATS = ["csv", "parquet"]
+
+#: the number of rows written to each parquet row group. Only this many rows
+#: are held in memory at once.
+ROW_GROUP_SIZE = 100000
+
+#: the size of each part of a multipart transfer to or from S3. Parts are held
+#: in memory while they are in flight, and an upload can have at most 10,000.
+PART_SIZE = 16 * 1024 * 1024
+
+#: the size of the chunks compressed data are passed to the archive in.
+CHUNK_SIZE = 64 * 1024
+
+#: the most compressed data held in memory for a table that is waiting for
+#: its turn to be written into the archive. Once this much is waiting, the
+#: table is read no further until the archive catches up.
+PIPE_SIZE = 8 * 1024 * 1024
+
+#: sizes and offsets larger than this need the zip64 extensions.
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+class Deflater(object):
+    """Compress data for an entry in a zip archive.
+
+    Also keeps the checksum and size of the uncompressed data, which the
+    archive needs once the entry is finished.
+
+    """
+
+    def __init__(self, compress_type=zipfile.ZIP_DEFLATED):
+        """Create a deflater for the given zipfile compression constant."""
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        elif compress_type == zipfile.ZIP_STORED:
+            self.compressor = None
+        else:
+            raise ValueError("{} is not a supported compression type."
+                             .format(compress_type))
+        self.compress_type = compress_type
+        self.crc = 0
+        self.size = 0
+
+    def compress(self, data):
+        """Compress a chunk of data, returning whatever is ready."""
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.compressor is None:
+            return data
+        return self.compressor.compress(data)
+
+    def flush(self):
+        """Return the rest of the compressed data."""
+        if self.compressor is None:
+            return ""
+        return self.compressor.flush()
+
+
+def zip64(value):
+    """A size or offset as it is stored where zip64 allows for larger ones.
+
+    Values too large for the field are stored in a zip64 record instead,
+    and the field is set to 0xffffffff.
+
+    """
+    return 0xffffffff if value > ZIP64_LIMIT else value
+
+
+class Archive(object):
+    """A zip archive written to a file in a single pass.
+
+    Each entry is compressed as it is written and its checksum and sizes
+    follow it in a data descriptor, so entries of any size can be streamed
+    into the archive without being held in memory or written anywhere
+    first. The file is only ever appended to, so it needn't be seekable.
+
+    """
+
+    def __init__(self, file):
+        """Start an archive in a file opened for writing."""
+        self.file = file
+        self.offset = 0
+        self.entries = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+
+    def write_entry(self, arcname, chunks, deflater):
+        """Add an entry made of chunks of data compressed by ``deflater``.
+
+        ``chunks`` can be any iterable, and is only read as the entry is
+        written; the deflater must have compressed everything in it by the
+        time it is exhausted.
+
+        """
+        if self.closed:
+            raise ValueError("The archive is closed.")
+
+        if isinstance(arcname, unicode):
+            arcname = arcname.encode("utf-8")
+            flags = 0x808
+        else:
+            flags = 0x08
+
+        now = time.localtime()
+        entry = {
+            "name": arcname,
+            "flags": flags,
+            "compress_type": deflater.compress_type,
+            "time": now[3] << 11 | now[4] << 5 | now[5] // 2,
+            "date": (now[0] - 1980) << 9 | now[1] << 5 | now[2],
+            "offset": self.offset,
+        }
+
+        self._write(struct.pack(
+            "<4s5H3L2H", "PK\003\004", 20, flags, entry["compress_type"],
+            entry["time"], entry["date"], 0, 0, 0, len(arcname), 0))
+        self._write(arcname)
+
+        start = self.offset
+        for chunk in chunks:
+            self._write(chunk)
+        self._write(deflater.flush())
+
+        entry["crc"] = deflater.crc & 0xffffffff
+        entry["compress_size"] = self.offset - start
+        entry["file_size"] = deflater.size
+        if max(entry["compress_size"], entry["file_size"]) > ZIP64_LIMIT:
+            self._write(struct.pack(
+                "<4sL2Q", "PK\007\010", entry["crc"],
+                entry["compress_size"], entry["file_size"]))
+        else:
+            self._write(struct.pack(
+                "<4s3L", "PK\007\010", entry["crc"],
+                entry["compress_size"], entry["file_size"]))
+        self.entries.append(entry)
+
+    def writestr(self, arcname, data, compress_type=zipfile.ZIP_DEFLATED):
+        """Add an entry with the given contents."""
+        deflater = Deflater(compress_type)
+        self.write_entry(arcname, [deflater.compress(data)], deflater)
+
+    def write(self, filename, arcname, compress_type=zipfile.ZIP_DEFLATED):
+        """Add the file at ``filename`` as an entry, a chunk at a time."""
+        deflater = Deflater(compress_type)
+
+        def chunks():
+            with open(filename, "rb") as file:
+                while True:
+                    data = file.read(CHUNK_SIZE)
+                    if not data:
+                        return
+                    yield deflater.compress(data)
+
+        self.write_entry(arcname, chunks(), deflater)
+
+    def close(self):
+        """Write the central directory. The file itself is left open."""
+        if self.closed:
+            return
+        self.closed = True
+
+        start = self.offset
+        for entry in self.entries:
+            extra = [entry[field] for field in
+                     ("file_size", "compress_size", "offset")
+                     if entry[field] > ZIP64_LIMIT]
+            if extra:
+                extra = struct.pack(
+                    "<2H{}Q".format(len(extra)), 1, 8 * len(extra), *extra)
+                version = 45
+            else:
+                extra = ""
+                version = 20
+            self._write(struct.pack(
+                "<4s4B4H3L5H2L", "PK\001\002", version, 3, version, 0,
+                entry["flags"], entry["compress_type"], entry["time"],
+                entry["date"], entry["crc"],
+                zip64(entry["compress_size"]), zip64(entry["file_size"]),
+                len(entry["name"]), len(extra), 0, 0, 0, 0o100644 << 16,
+                zip64(entry["offset"])))
+            self._write(entry["name"])
+            self._write(extra)
+
+        count = len(self.entries)
+        size = self.offset - start
+        if max(start, size) > ZIP64_LIMIT or count > 0xffff:
+            end = self.offset
+            self._write(struct.pack(
+                "<4sQ2H2L4Q", "PK\006\006", 44, 45, 45, 0, 0,
+                count, count, size, start))
+            self._write(struct.pack("<4sLQL", "PK\006\007", 0, end, 1))
+        self._write(struct.pack(
+            "<4s4H2LH", "PK\005\006", 0, 0, min(count, 0xffff),
+            min(count, 0xffff), zip64(size), zip64(start), 0))
+
+
+class Cancelled(Exception):
+    """The archive stopped waiting for the rest of a pipe."""
+
+
+class Pipe(object):
+    """A write-only file that hands a table to the archive as it is written.
+
+    What is written is compressed straight away and queued up in chunks for
+    :meth:`Archive.write_entry`, which reads them by iterating over the pipe.
+    Several tables can be read at once, but only one can be written into the
+    archive at a time, so at most :data:`PIPE_SIZE` bytes of compressed data
+    are queued before writing blocks.
+
+    Whoever writes to the pipe calls :meth:`start` when they begin, and then
+    :meth:`finish` or :meth:`fail`. Each of these notifies ``ready``, a
+    condition shared by all the pipes of an export.
+
+    """
+
+    def __init__(self, compress_type=zipfile.ZIP_DEFLATED, ready=None):
+        """Create an empty pipe."""
+        self.deflater = Deflater(compress_type)
+        self.ready = ready or threading.Condition()
+        self.chunks = Queue.Queue(max(1, PIPE_SIZE // CHUNK_SIZE))
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.closed = False
+        self.started = False
+        self.finished = False
+        self.cancelled = False
+
+    def _notify(self, **state):
+        with self.ready:
+            for name, value in state.items():
+                setattr(self, name, value)
+            self.ready.notify_all()
+
+    def _put(self, item):
+        while True:
+            if self.cancelled:
+                raise Cancelled()
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _send(self):
+        self._put("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def start(self):
+        """Mark the pipe as being written to."""
+        self._notify(started=True)
+
+    def write(self, data):
+        """Compress a chunk of data and queue it for the archive."""
+        if self.cancelled:
+            raise Cancelled()
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.size += len(data)
+        data = self.deflater.compress(data)
+        if data:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= CHUNK_SIZE:
+                self._send()
+
+    def tell(self):
+        """The number of bytes written so far."""
+        return self.size
+
+    def flush(self):
+        """Do nothing, data are queued as they are compressed."""
+        pass
+
+    def close(self):
+        """Stop writing. The entry is only complete once finished."""
+        self.closed = True
+
+    def finish(self):
+        """Queue the end of the data, completing the entry."""
+        self._send()
+        self._put(None)
+        self._notify(finished=True)
+
+    def fail(self, exc_info):
+        """Hand an error raised while writing to the archive instead."""
+        try:
+            self._put(exc_info)
+        except Cancelled:
+            pass
+        self._notify(finished=True)
+
+    def cancel(self):
+        """Stop the pipe, so that writing to it raises :class:`Cancelled`."""
+        self.cancelled = True
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def __iter__(self):
+        """Yield the compressed chunks as they are queued."""
+        while True:
+            item = self.chunks.get()
+            if item is None:
+                return
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item
+
+
+def snapshot_connection(dsn, snapshot=None):
+    """Open a read-only, repeatable-read connection to the database.
+
+    If ``snapshot`` is given the connection adopts that exported snapshot, so
+    that several connections see exactly the same data.
+
+    """
+    import psycopg2
+    from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+
+    conn = psycopg2.connect(dsn)
+    conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ,
+                     readonly=True)
+    if snapshot is not None:
+        conn.cursor().execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+    return conn
+
+
+def joined_infos():
+    """SQL for infos joined with their origin node and its participant.
+
+    Node columns are prefixed with ``node_`` and participant columns with
+    ``participant_``.
+
+    """
+    from sqlalchemy import select
+    from sqlalchemy.dialects import postgresql
+    from wallace.models import Info, Node, Participant
+
+    info = Info.__table__
+    node = Node.__table__
+    participant = Participant.__table__
+
+    query = select(
+        list(info.c) +
+        [c.label("node_" + c.name) for c in node.c] +
+        [c.label("participant_" + c.name) for c in participant.c]
+    ).select_from(
+        info
+        .outerjoin(node, info.c.origin_id == node.c.id)
+        .outerjoin(participant, node.c.participant_id == participant.c.id))
+
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+#: pre-joined tables that can be exported alongside the raw tables, by name.
+JOINS = {
+    "info_origin": joined_infos,
+}
+
+
+def decompressor(description, compressed):
+    """A function that decompresses the given columns of a row.
+
+    ``description`` is the description of the cursor the rows come from and
+    ``compressed`` the names of the columns to decompress.
+
+    """
+    indexes = [i for i, column in enumerate(description)
+               if column[0] in compressed]
+
+    def decompress(row):
+        row = list(row)
+        for i in indexes:
+            if row[i] is not None:
+                row[i] = zlib.decompress(row[i])
+        return row
+
+    return decompress
+
+
+def copy_csv(conn, sql, pipe, compressed=None):
+    """Stream the results of a query out of the database as csv.
+
+    Columns named in ``compressed`` are decompressed on the way, which means
+    reading the rows into Python rather than having the database write the
+    csv itself.
+
+    """
+    if not compressed:
+        conn.cursor().copy_expert(
+            "COPY ({}) TO STDOUT WITH CSV HEADER".format(sql), pipe)
+        return
+
+    cur = conn.cursor(name="wallace_export")
+    cur.itersize = ROW_GROUP_SIZE
+    cur.execute(sql)
+
+    rows = cur.fetchmany(ROW_GROUP_SIZE)
+    decompress = decompressor(cur.description, compressed)
+    writer = csv.writer(pipe, lineterminator="\n")
+    writer.writerow([column[0] for column in cur.description])
+    while rows:
+        writer.writerows(decompress(row) for row in rows)
+        rows = cur.fetchmany(ROW_GROUP_SIZE)
+    cur.close()
+
+
+def parquet_type(type_code):
+    """The arrow type used to store a postgres column of the given oid."""
+    import pyarrow as pa
+
+    return {
+        16: pa.bool_(),
+        17: pa.binary(),
+        20: pa.int64(),
+        21: pa.int64(),
+        23: pa.int64(),
+        700: pa.float64(),
+        701: pa.float64(),
+        1082: pa.date32(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="UTC"),
+    }.get(type_code, pa.string())
+
+
+def arrow_values(values, type):
+    """Convert a column of values from psycopg2 for arrow."""
+    import pyarrow as pa
+
+    if type == pa.binary():
+        # psycopg2 returns bytea as buffers.
+        return [None if v is None else str(v) for v in values]
+    return list(values)
+
+
+def copy_parquet(conn, sql, pipe, compressed=None):
+    """Stream the results of a query out of the database as parquet.
+
+    Rows are read through a server-side cursor and written one row group of
+    :data:`ROW_GROUP_SIZE` rows at a time, so memory use does not grow with
+    the size of the table. Columns are typed, so timestamps, numbers and
+    booleans do not need to be parsed again when the data are loaded.
+    Columns named in ``compressed`` are decompressed and stored as text.
+
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "Exporting to parquet requires pyarrow: pip install pyarrow")
+
+    cur = conn.cursor(name="wallace_export")
+    cur.itersize = ROW_GROUP_SIZE
+    cur.execute(sql)
+
+    rows = cur.fetchmany(ROW_GROUP_SIZE)
+    decompress = decompressor(cur.description, compressed or [])
+    schema = pa.schema([
+        pa.field(column[0],
+                 pa.string() if column[0] in (compressed or [])
+                 else parquet_type(column[1]))
+        for column in cur.description
+    ])
+
+    writer = pq.ParquetWriter(pipe, schema, compression="snappy")
+    try:
+        while True:
+            columns = (zip(*[decompress(row) for row in rows]) if rows
+                       else [[] for _ in schema])
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(arrow_values(values, field.type), type=field.type)
+                 for values, field in zip(columns, schema)],
+                schema=schema))
+            rows = cur.fetchmany(ROW_GROUP_SIZE)
+            if not rows:
+                break
+    finally:
+        writer.close()
+    cur.close()
+
+
+def copy_query(dsn, snapshot, name, sql, format, pipe):
+    """Export the results of a query into a pipe in the given format."""
+    if pipe.cancelled:
+        return
+    pipe.start()
+    copy = {"csv": copy_csv, "parquet": copy_parquet}[format]
+    try:
+        conn = snapshot_connection(dsn, snapshot)
+        try:
+            copy(conn, sql, pipe, COMPRESSED_COLUMNS.get(name))
+        finally:
+            conn.close()
+        pipe.finish()
+    except Cancelled:
+        pass
+    except Exception:
+        pipe.fail(sys.exc_info())
+
+
+def changed_since(table):
+    """SQL for the latest time at which rows of a table were changed.
+
+    New rows are found by id, but rows can also change after they are
+    created: anything can fail, participants finish and transmissions are
+    received. Changes that are not timestamped, such as a finished
+    participant's status changing from submitted to approved or edits to
+    the property columns, are only picked up by a full export.
+
+    """
+    columns = CHANGE_COLUMNS.get(table, []) + ["time_of_death"]
+    return "greatest({})".format(", ".join(columns))
+
+
+def watermarks(cur, tables):
+    """The watermarks of each table, as of now.
+
+    Ids and timestamps are handed out before a transaction commits, so when
+    the snapshot is taken a row can still be on its way with a lower id or
+    an earlier change time than those already exported. So besides the
+    highest id and change time, each watermark keeps the ``pending`` ids
+    among the last :data:`PENDING_IDS` that are not in the table yet, and
+    the ``recent`` ids and change times of rows changed within
+    :data:`OVERLAP` seconds of the latest change. :func:`delta_query` reads
+    the pending ids again, and the changes in the overlap window except for
+    those already exported.
+
+    """
+    marks = {}
+    for table in tables:
+        if table in APPEND_ONLY:
+            changed = "NULL::timestamp"
+        else:
+            changed = changed_since(table)
+        cur.execute("SELECT max(id), max({}) FROM {}".format(changed, table))
+        max_id, changed = cur.fetchone()
+        max_id = max_id or 0
+
+        cur.execute(
+            "SELECT g FROM generate_series(%s, %s) AS g WHERE NOT EXISTS "
+            "(SELECT 1 FROM {} WHERE id = g) ORDER BY g".format(table),
+            (max(1, max_id - PENDING_IDS + 1), max_id))
+        pending = [row[0] for row in cur.fetchall()]
+
+        recent = []
+        if changed is not None:
+            cur.execute(
+                "SELECT id, {0} FROM {1} WHERE {0} > "
+                "%s - %s * interval '1 second' ORDER BY id".format(
+                    changed_since(table), table),
+                (changed, OVERLAP))
+            recent = [[i, c.isoformat()] for i, c in cur.fetchall()]
+
+        marks[table] = {
+            "id": max_id,
+            "pending": pending,
+            "changed": changed.isoformat() if changed else None,
+            "recent": recent,
+        }
+    return marks
+
+
+def delta_query(cur, table, mark):
+    """SQL for the rows of a table added or changed since a watermark."""
+    changed = changed_since(table)
+    new = "id > %s OR id = ANY(%s::int[])"
+    params = [mark["id"], mark.get("pending", [])]
+
+    if table in APPEND_ONLY:
+        sql = "SELECT * FROM {} WHERE {}".format(table, new)
+    elif mark["changed"] is None:
+        # Nothing had changed yet, so any change is new.
+        sql = "SELECT * FROM {} WHERE {} OR {} IS NOT NULL".format(
+            table, new, changed)
+    else:
+        # Changes in the overlap window that were already exported are
+        # left out.
+        sql = ("SELECT * FROM {0} WHERE ({1} OR "
+               "{2} > %s::timestamp - %s * interval '1 second') "
+               "AND NOT EXISTS (SELECT 1 FROM unnest(%s::int[], "
+               "%s::timestamp[]) AS seen (id, changed) "
+               "WHERE seen.id = {0}.id AND seen.changed = {2})"
+               .format(table, new, changed))
+        recent = mark.get("recent", [])
+        params.extend([mark["changed"], OVERLAP,
+                       [r[0] for r in recent], [r[1] for r in recent]])
+    return cur.mogrify(sql, params)
+
+
+def copy_tables(dsn, archive, tables=None, joins=None, directory="data",
+                workers=4, format="csv", since=None):
+    """Export tables from the database into an :class:`Archive`.
+
+    Every table is compressed as it is streamed out of the database and
+    written straight into the archive. Up to ``workers`` tables are read at
+    once: one is written into the archive while the others wait in their
+    :class:`Pipe`. They all share a single exported snapshot, so the package
+    is consistent even when the database is live. ``format`` can be "csv"
+    (the default) or "parquet", and each table is stored as
+    ``<directory>/<table>.<format>``. ``joins`` is a list of names from
+    :data:`JOINS` to export as well as the raw tables.
+
+    Return the watermarks of the exported tables. Pass these back in as
+    ``since`` to export only the rows that have been added or changed since
+    (see :func:`changed_since` for what counts as a change). Joins are
+    always exported in full.
+
+    """
+    if format not in FORMATS:
+        raise ValueError("{} is not a valid export format.".format(format))
+
+    if tables is None:
+        tables = TABLES
+
+    # Parquet files are already compressed.
+    if format == "parquet":
+        compress_type = zipfile.ZIP_STORED
+    else:
+        compress_type = zipfile.ZIP_DEFLATED
+
+    # The coordinating transaction must stay open until every worker has
+    # adopted its snapshot.
+    coordinator = snapshot_connection(dsn)
+    try:
+        cur = coordinator.cursor()
+        cur.execute("SELECT pg_export_snapshot()")
+        snapshot = cur.fetchone()[0]
+
+        marks = watermarks(cur, tables)
+
+        queries = []
+        for table in tables:
+            if since and table in since:
+                queries.append((table, delta_query(cur, table, since[table])))
+            else:
+                queries.append((table, "SELECT * FROM {}".format(table)))
+        queries.extend((j, JOINS[j]()) for j in (joins or []))
+
+        ready = threading.Condition()
+        pipes = [(name, Pipe(compress_type, ready)) for name, _ in queries]
+
+        pool = ThreadPool(max(1, min(workers, len(queries))))
+        try:
+            for (name, sql), (_, pipe) in zip(queries, pipes):
+                pool.apply_async(
+                    copy_query, (dsn, snapshot, name, sql, format, pipe))
+
+            waiting = list(pipes)
+            while waiting:
+                # Archive the tables that have been read in full first, then
+                # those being read; a table that has not been started yet
+                # may be waiting for a worker to free up.
+                with ready:
+                    while True:
+                        found = ([p for p in waiting if p[1].finished] or
+                                 [p for p in waiting if p[1].started])
+                        if found:
+                            break
+                        ready.wait(1)
+                name, pipe = found[0]
+                waiting.remove(found[0])
+                archive.write_entry(
+                    "{}/{}.{}".format(directory, name, format),
+                    pipe, pipe.deflater)
+        finally:
+            for _, pipe in pipes:
+                pipe.cancel()
+            pool.close()
+            pool.join()
+    finally:
+        coordinator.close()
+
+    return marks
+
+
+def multipart_etag(digests):
+    """The ETag S3 gives an object uploaded in parts with the given MD5s."""
+    return "{}-{}".format(
+        hashlib.md5("".join(digests)).hexdigest(), len(digests))
+
+
+def parts_key_name(key_name):
+    """The name of the object listing the MD5s of another's parts."""
+    return key_name + ".parts"
+
+
+def upload_stream(stream, bucket, key_name, part_size=PART_SIZE, workers=4,
+                  check=None):
+    """Upload a stream to S3 as a multipart upload.
+
+    The stream is read ``part_size`` bytes at a time and up to ``workers``
+    parts are uploaded at once, so nothing is written to disk and at most
+    twice that many parts are held in memory. Every part is sent with its MD5,
+    so S3 rejects any part that is corrupted on the way, and the ETag of the
+    finished object is checked against them. ``check`` is called once the
+    stream is exhausted; if it raises, the upload is cancelled instead of
+    completed. The part size is stored in the object's metadata and the MD5
+    of each part in a second object (see :func:`parts_key_name`), so that
+    :func:`download_stream` can verify each part as it is downloaded.
+
+    """
+    upload = bucket.initiate_multipart_upload(
+        key_name, metadata={"part-size": str(part_size)})
+
+    def send(part_num, chunk):
+        md5 = hashlib.md5(chunk)
+        part = upload.upload_part_from_file(
+            StringIO(chunk),
+            part_num,
+            md5=(md5.hexdigest(), base64.b64encode(md5.digest())),
+            size=len(chunk))
+        if part.etag.strip('"') != md5.hexdigest():
+            raise IOError("Part {} of {} was corrupted during upload."
+                          .format(part_num, key_name))
+        return md5.digest()
+
+    pool = ThreadPool(workers)
+    try:
+        in_flight = deque()
+        digests = []
+        part_num = 1
+        chunk = stream.read(part_size)
+        while True:
+            in_flight.append(pool.apply_async(send, (part_num, chunk)))
+            if len(in_flight) >= 2 * workers:
+                digests.append(in_flight.popleft().get())
+            chunk = stream.read(part_size)
+            if not chunk:
+                break
+            part_num += 1
+        while in_flight:
+            digests.append(in_flight.popleft().get())
+
+        if check is not None:
+            check()
+
+        completed = upload.complete_upload()
+    except:
+        upload.cancel_upload()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    if completed.etag.strip('"') != multipart_etag(digests):
+        raise IOError("{} does not match what was uploaded.".format(key_name))
+
+    parts = "".join(binascii.hexlify(digest) + "\n" for digest in digests)
+    md5 = hashlib.md5(parts)
+    bucket.new_key(parts_key_name(key_name)).set_contents_from_string(
+        parts, md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+    return completed.etag
+
+
+def download_stream(bucket, key_name, stream, workers=4):
+    """Download an object from S3 into a stream.
+
+    The object is fetched in ranges, up to ``workers`` at once, and written to
+    the stream in order. Objects uploaded with :func:`upload_stream` are
+    fetched in the same parts they were uploaded in, and each part is checked
+    against its MD5 before it is written, so an IOError is raised before any
+    corrupted data reach the stream. The list of MD5s is itself checked
+    against the object's ETag first. Other objects can only be checked
+    against their ETag once everything has been written, so don't use what
+    is in the stream until this returns. The stream is not closed.
+
+    """
+    key = bucket.get_key(key_name)
+    if key is None:
+        raise IOError("{} does not exist.".format(key_name))
+
+    etag = key.etag.strip('"')
+    stored_part_size = key.get_metadata("part-size")
+    part_size = int(stored_part_size or PART_SIZE)
+    ranges = [(start, min(start + part_size, key.size) - 1)
+              for start in xrange(0, key.size, part_size)]
+
+    expected = None
+    parts = bucket.get_key(parts_key_name(key_name))
+    if parts is not None and stored_part_size and "-" in etag:
+        expected = [binascii.unhexlify(line) for line in
+                    parts.get_contents_as_string().split()]
+        if (len(expected) != len(ranges) or
+                multipart_etag(expected) != etag):
+            raise IOError("The parts of {} do not match its ETag."
+                          .format(key_name))
+
+    def fetch(byte_range):
+        return bucket.new_key(key_name).get_contents_as_string(
+            headers={"Range": "bytes={}-{}".format(*byte_range)})
+
+    whole = hashlib.md5()
+    digests = []
+
+    def write(chunk):
+        digest = hashlib.md5(chunk).digest()
+        if expected is not None and digest != expected[len(digests)]:
+            raise IOError("Part {} of {} was corrupted during download."
+                          .format(len(digests) + 1, key_name))
+        whole.update(chunk)
+        digests.append(digest)
+        stream.write(chunk)
+
+    pool = ThreadPool(workers)
+    try:
+        in_flight = deque()
+        for byte_range in ranges:
+            in_flight.append(pool.apply_async(fetch, (byte_range,)))
+            if len(in_flight) >= 2 * workers:
+                write(in_flight.popleft().get())
+        while in_flight:
+            write(in_flight.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+    # The ETag of an object uploaded in parts can only be checked if we know
+    # what size the parts were.
+    if "-" not in etag:
+        matches = etag == whole.hexdigest()
+    elif stored_part_size:
+        matches = etag == multipart_etag(digests)
+    else:
+        matches = True
+
+    if not matches:
+        raise IOError("{} was corrupted during download.".format(key_name))
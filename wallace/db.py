@@ -1,26 +1,303 @@
 """Create a connection to the database."""
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import (
+    sessionmaker, scoped_session, object_session, Session)
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
 from functools import wraps
+from itertools import chain
 import logging
 import os
+import weakref
 
 logger = logging.getLogger('wallace.db')
 
 db_url_default = "postgresql://postgres@localhost/wallace"
 db_url = os.environ.get("DATABASE_URL", db_url_default)
-engine = create_engine(db_url, pool_size=1000)
+
+#: the default size of the connection pool of each kind of process. Web
+#: processes serve requests on several threads at once, while workers and
+#: the clock only use a connection at a time.
+POOL_DEFAULTS = {
+    "web": {"pool_size": 10, "max_overflow": 10},
+    "worker": {"pool_size": 1, "max_overflow": 2},
+    "clock": {"pool_size": 1, "max_overflow": 2},
+}
+
+
+def process_role():
+    """The kind of process this is: web, worker or clock.
+
+    Taken from WALLACE_PROCESS if it is set, and otherwise from the name of
+    the Heroku dyno.
+    """
+    role = os.environ.get("WALLACE_PROCESS",
+                          os.environ.get("DYNO", "web").split(".")[0])
+    return role if role in POOL_DEFAULTS else "web"
+
+
+def _boolean(value):
+    return value.lower() in ["1", "true", "yes", "on"]
+
+
+def setting(name, default, role, convert=int):
+    """A database setting from the environment.
+
+    ``<ROLE>_DATABASE_<NAME>``, e.g. WORKER_DATABASE_POOL_SIZE, overrides
+    ``DATABASE_<NAME>`` for processes of that role.
+    """
+    for var in [role.upper() + "_DATABASE_" + name, "DATABASE_" + name]:
+        if var in os.environ:
+            return convert(os.environ[var])
+    return default
+
+
+def engine_options(url, role):
+    """The options to create an engine connecting to url with."""
+    if url.startswith("sqlite"):
+        # sqlite connections are not pooled, so there is no pool to size.
+        return {}
+
+    if setting("POOLER", False, role, _boolean):
+        # An external pooler, such as PgBouncer in transaction mode, lends
+        # out a server connection per transaction, so hold none between them.
+        return {"poolclass": NullPool}
+
+    defaults = POOL_DEFAULTS[role]
+    return {
+        "pool_size": setting("POOL_SIZE", defaults["pool_size"], role),
+        "max_overflow": setting(
+            "MAX_OVERFLOW", defaults["max_overflow"], role),
+        "pool_timeout": setting("POOL_TIMEOUT", 30, role),
+        "pool_recycle": setting("POOL_RECYCLE", 1800, role),
+    }
+
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    """Replace connections the database has closed before they are used."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except:
+        raise exc.DisconnectionError()
+    cursor.close()
+
+
+def connect(url, role):
+    """Create an engine connecting to url, configured for the role."""
+    options = engine_options(url, role)
+    new_engine = create_engine(url, **options)
+    if "pool_size" in options and setting("POOL_PRE_PING", True, role,
+                                          _boolean):
+        event.listen(new_engine.pool, "checkout", _ping)
+    return new_engine
+
+
+role = process_role()
+engine = connect(db_url, role)
+
+#: a replica of the database, such as a Heroku follower, that reads can be
+#: sent to. None unless DATABASE_REPLICA_URL is set.
+replica_url = os.environ.get("DATABASE_REPLICA_URL")
+replica_engine = connect(replica_url, role) if replica_url else None
+
+
+class RoutingSession(Session):
+    """A session that can read from the replica of the database.
+
+    Once :func:`use_replica` has been called, queries go to the replica, if
+    there is one, until the session writes something. From then on
+    everything goes to the primary, so the session reads its own writes.
+
+    """
+
+    use_replica = False
+    wrote = False
+
+    #: whether commits only flush, as inside :func:`single_transaction`.
+    hold_commits = False
+
+    #: calls waiting for the transaction to be committed, see
+    #: :func:`after_commit`.
+    deferred = None
+
+    def get_bind(self, mapper=None, clause=None):
+        """Choose the engine to run a query on."""
+        if (replica_engine is not None and self.use_replica and
+                not self.wrote and not self._flushing):
+            return replica_engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def commit(self):
+        """Commit the transaction, or just flush while commits are held."""
+        if self.hold_commits:
+            self.flush()
+        else:
+            super(RoutingSession, self).commit()
+
+
 session = scoped_session(sessionmaker(autocommit=False,
                                       autoflush=True,
-                                      bind=engine))
+                                      bind=engine,
+                                      class_=RoutingSession))
 
 Base = declarative_base()
 Base.query = session.query_property()
 
 
+#: the results of memoized accessors, by session. Each maps the accessor,
+#: object id and arguments to the tables the result depends on and the result.
+_caches = weakref.WeakKeyDictionary()
+
+
+def memoized(*tables):
+    """Remember what a read accessor returns until the tables change.
+
+    Decorates methods of models that query ``tables``. Within a transaction,
+    calling the method again with the same arguments returns the same result
+    without querying the database, until an object in one of the tables is
+    flushed. Pending changes are flushed before the cache is used, just as
+    they would be before a query. The cache is emptied when the transaction
+    ends, so it lasts at most one request. Changes the session does not know
+    about, such as SQL run with ``session.execute``, need
+    :func:`clear_cache`.
+
+    """
+    tables = frozenset(tables)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            sess = object_session(self)
+            if sess is None or sess._flushing:
+                return func(self, *args, **kwargs)
+
+            if sess.autoflush and (sess.new or sess.deleted or sess.dirty):
+                sess.flush()
+
+            try:
+                key = (func, self.id, args, frozenset(kwargs.items()))
+                hash(key)
+            except TypeError:
+                return func(self, *args, **kwargs)
+
+            cache = _caches.setdefault(sess, {})
+            if key not in cache:
+                cache[key] = (tables, func(self, *args, **kwargs))
+            result = cache[key][1]
+            if isinstance(result, list):
+                return list(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def clear_cache(sess=None):
+    """Forget the results of memoized accessors."""
+    if sess is None:
+        sess = session()
+    _caches.pop(sess, None)
+
+
+@event.listens_for(session, "after_flush")
+def _invalidate_cache(sess, flush_context):
+    """Forget results that depend on the tables that were just flushed."""
+    cache = _caches.get(sess)
+    if not cache:
+        return
+    flushed = set(obj.__table__.name
+                  for obj in chain(sess.new, sess.dirty, sess.deleted)
+                  if hasattr(obj, "__table__"))
+    for key, (tables, _) in cache.items():
+        if tables & flushed:
+            del cache[key]
+
+
+def use_replica(use=True):
+    """Send the reads of this thread's session to the replica, if any.
+
+    The reads go to the replica until the session writes. Changes the session
+    does not know about, such as SQL run with ``session.execute``, do not
+    count as writes.
+    """
+    sess = session()
+    sess.use_replica = use
+    sess.wrote = False
+
+
+@contextmanager
+def replica_reads(use=True):
+    """Read from the replica, if there is one, inside the block.
+
+    ``replica_reads(False)`` reads from the primary inside the block instead,
+    for reads that decide what to write.
+    """
+    sess = session()
+    previous = sess.use_replica
+    sess.use_replica = use
+    if use:
+        sess.wrote = False
+    try:
+        yield
+    finally:
+        sess.use_replica = previous
+
+
+@contextmanager
+def single_transaction():
+    """Make everything inside the block a single transaction.
+
+    Commits inside the block only flush. The transaction is committed at the
+    end of the block, or rolled back if the block raises an exception.
+    """
+    sess = session()
+    sess.hold_commits = True
+    sess.deferred = []
+    try:
+        yield sess
+    except:
+        sess.hold_commits = False
+        sess.deferred = None
+        sess.rollback()
+        raise
+    sess.hold_commits = False
+    deferred, sess.deferred = sess.deferred, None
+    sess.commit()
+    for func, args, kwargs in deferred:
+        func(*args, **kwargs)
+
+
+def after_commit(func, *args, **kwargs):
+    """Call a function once the current transaction is committed.
+
+    For side effects that can't be undone, like queueing a job. Inside
+    :func:`single_transaction` the call waits until the end of the block, and
+    is dropped if the block fails; anywhere else it is made straight away.
+    """
+    sess = session()
+    if sess.deferred is None:
+        func(*args, **kwargs)
+    else:
+        sess.deferred.append((func, args, kwargs))
+
+
+@event.listens_for(session, "after_flush")
+def _stick_to_primary(sess, flush_context):
+    """Read from the primary once the session has written."""
+    sess.wrote = True
+
+
+@event.listens_for(session, "after_commit")
+@event.listens_for(session, "after_soft_rollback")
+@event.listens_for(session, "after_bulk_update")
+@event.listens_for(session, "after_bulk_delete")
+def _clear_cache(sess, *args):
+    """Forget every result once the transaction ends or rows change in bulk."""
+    _caches.pop(sess, None)
+
+
 @contextmanager
 def sessions_scope(local_session, commit=False):
     """Provide a transactional scope around a series of operations."""
@@ -62,8 +339,33 @@ def scoped_session_decorator(func):
     return wrapper
 
 
+def _pool_status(pool):
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            # the count starts below zero until the pool itself is full
+            "overflow": max(pool.overflow(), 0)
+        })
+    return status
+
+
+def pool_status():
+    """How many connections the pool holds, lends out and has added."""
+    status = _pool_status(engine.pool)
+    status["role"] = role
+    if replica_engine is not None:
+        status["replica"] = _pool_status(replica_engine.pool)
+    return status
+
+
 def init_db(drop_all=False):
     """Initialize the database, optionally dropping existing tables."""
+    from wallace import preload
+    preload()
+
     if drop_all:
         Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
@@ -1,14 +1,15 @@
 """The base experiment class."""
 
+from wallace import db
 from wallace.models import Network, Node, Info, Transformation, Participant
 from wallace.information import Gene, Meme, State
 from wallace.nodes import Agent, Source, Environment
 from wallace.transformations import Compression, Response
 from wallace.transformations import Mutation, Replication
-from sqlalchemy import and_
+from sqlalchemy import and_, func
+import math
 import random
 import sys
-from collections import Counter
 from operator import itemgetter
 
 
@@ -46,6 +47,14 @@ class Experiment(object):
         #: requested when the experiment first starts. Default is 1.
         self.initial_recruitment_size = 1
 
+        #: float, how many participants to recruit beyond the open slots, as
+        #: a proportion of them. Over-recruiting means participants who drop
+        #: out are replaced without waiting for new recruits; any surplus is
+        #: cancelled once the slots fill. Used by
+        #: :func:`~wallace.experiments.Experiment.schedule_recruitment`.
+        #: Default is 0.
+        self.recruitment_margin = 0
+
         #: dictionary, the classes Wallace can make in response
         #: to front-end requests. Experiments can add new classes to this
         #: dictionary.
@@ -67,7 +76,9 @@ class Experiment(object):
 
     def setup(self):
         """Create the networks if they don't already exist."""
-        if not self.networks():
+        with db.replica_reads(False):
+            exists = bool(self.networks())
+        if not exists:
             for _ in range(self.practice_repeats):
                 network = self.create_network()
                 network.role = "practice"
@@ -112,11 +123,17 @@ class Experiment(object):
         If no networks are available, None will be returned. By default
         participants can participate only once in each network and participants
         first complete networks with `role="practice"` before doing all other
-        networks in a random order.
+        networks in a random order. Only networks with an open slot (see
+        :func:`~wallace.models.Network.open_slots`) are available, so
+        participants recruited beyond what is needed, for instance because
+        the recruiter could not cancel their places, are turned away.
 
         """
         key = participant.id
-        networks_with_space = Network.query.filter_by(full=False).all()
+        networks_with_space = [
+            net for net in Network.query.filter_by(full=False).all()
+            if net.open_slots()
+        ]
         networks_participated_in = [
             node.network_id for node in
             Node.query.with_entities(Node.network_id)
@@ -227,17 +244,84 @@ class Experiment(object):
             self.log("All networks full: closing recruitment", "-----")
             self.recruiter().close_recruitment()
 
+    def open_slots(self):
+        """The number of participants each network can take right now.
+
+        Returns a dictionary of network id: open slots, see
+        :func:`~wallace.models.Network.open_slots`.
+
+        """
+        return dict((net.id, net.open_slots())
+                    for net in self.networks(full=False))
+
+    def arriving_participants(self):
+        """The number of working participants who don't have a node yet.
+
+        They have accepted the HIT but not yet joined a network, so they
+        will take up open slots shortly.
+
+        """
+        return Participant.query\
+            .filter(Participant.status == "working",
+                    ~Participant.all_nodes.any())\
+            .count()
+
+    def schedule_recruitment(self):
+        """Recruit just enough participants to fill the open slots.
+
+        Participants who are working but don't have a node yet (see
+        :func:`~wallace.experiments.Experiment.arriving_participants`) fill
+        open slots first. The number wanted is the number of slots left,
+        plus :attr:`~wallace.experiments.Experiment.recruitment_margin` of
+        them. Places that have been recruited but not yet taken up count
+        towards this, so only the shortfall is recruited, and if there are
+        more of them than are wanted (for instance, because a generation has
+        just filled) the surplus is cancelled. Experiments can call this from
+        :func:`~wallace.experiments.Experiment.recruit`.
+
+        """
+        slots = max(sum(self.open_slots().values()) -
+                    self.arriving_participants(), 0)
+        wanted = int(math.ceil(slots * (1 + self.recruitment_margin)))
+
+        recruiter = self.recruiter()
+        outstanding = recruiter.outstanding()
+
+        if wanted > outstanding:
+            self.log("{} open slots, {} places outstanding: recruiting {}"
+                     .format(slots, outstanding, wanted - outstanding),
+                     "-----")
+            recruiter.recruit_participants(n=wanted - outstanding)
+        elif wanted < outstanding:
+            self.log("{} open slots, {} places outstanding: cancelling {}"
+                     .format(slots, outstanding, outstanding - wanted),
+                     "-----")
+            recruiter.cancel_recruitment(n=outstanding - wanted)
+        return wanted - outstanding
+
     def log(self, text, key="?????", force=False):
         """Print a string to the logs."""
         if force or self.verbose:
             print ">>>> {} {}".format(key, text)
             sys.stdout.flush()
 
+    def participant_status_counts(self):
+        """Count the participants with each status.
+
+        Returns a dictionary of status: count. Statuses that no participant
+        has are left out. The counting is done by the database, so this is
+        cheap however many participants there are.
+
+        """
+        return dict(Participant.query
+                    .with_entities(Participant.status,
+                                   func.count(Participant.id))
+                    .group_by(Participant.status)
+                    .all())
+
     def log_summary(self):
         """Log a summary of all the participants' status codes."""
-        participants = Participant.query\
-            .with_entities(Participant.status).all()
-        counts = Counter([p.status for p in participants])
+        counts = self.participant_status_counts()
         sorted_counts = sorted(counts.items(), key=itemgetter(0))
         self.log("Status summary: {}".format(str(sorted_counts)))
         return sorted_counts
@@ -6,7 +6,9 @@ import os
 import imp
 import inspect
 from wallace.models import Participant
-from datetime import datetime
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import threading
 from psiturk.psiturk_config import PsiturkConfig
 from boto.mturk.connection import MTurkConnection
 import requests
@@ -34,83 +36,145 @@ session = db.session
 
 scheduler = BlockingScheduler()
 
+#: how long to wait before asking AWS about the same participant again.
+RECHECK_INTERVAL = timedelta(minutes=5)
+
+#: how many assignments to ask AWS about at once.
+MTURK_WORKERS = 8
+
+#: the time at which each overdue participant was last checked, by id.
+recently_checked = {}
+
+_local = threading.local()
+
+
+def mturk_connection():
+    """Get this thread's connection to MTurk, creating it if needed.
+
+    Connections are kept for the life of the process rather than opened on
+    every sweep; boto connections are not thread safe, so each thread has its
+    own.
+
+    """
+    if not hasattr(_local, "conn"):
+        kwargs = {
+            "aws_access_key_id": os.environ['aws_access_key_id'],
+            "aws_secret_access_key": os.environ['aws_secret_access_key'],
+        }
+        if config.getboolean('Shell Parameters', 'launch_in_sandbox_mode'):
+            kwargs["host"] = 'mechanicalturk.sandbox.amazonaws.com'
+        _local.conn = MTurkConnection(**kwargs)
+    return _local.conn
+
+
+#: the status of an assignment whose status amazon could not tell us.
+UNKNOWN = object()
+
+
+def assignment_status(assignment_id):
+    """Ask amazon for the status of an assignment.
+
+    Returns UNKNOWN if amazon can't be asked, so that it isn't mistaken for
+    an assignment that was never submitted.
+
+    """
+    try:
+        return mturk_connection().get_assignment(
+            assignment_id)[0].AssignmentStatus
+    except Exception as e:
+        print "Error: could not get the status of assignment {}: {}".format(
+            assignment_id, e)
+        return UNKNOWN
+
+
+pool = ThreadPool(MTURK_WORKERS)
+
+
+def overdue_participants(cutoff, now):
+    """Get working participants created before the cutoff.
+
+    Participants that were checked less than RECHECK_INTERVAL ago are
+    skipped.
+
+    """
+    for p_id, checked in recently_checked.items():
+        if now - checked > RECHECK_INTERVAL:
+            del recently_checked[p_id]
+
+    participants = Participant.query\
+        .filter(Participant.status == "working")\
+        .filter(Participant.creation_time < cutoff)\
+        .order_by(Participant.creation_time)\
+        .all()
+    return [p for p in participants if p.id not in recently_checked]
+
 
 @scheduler.scheduled_job('interval', minutes=0.5)
 def check_db_for_missing_notifications():
     """Check the database for missing notifications."""
-    aws_access_key_id = os.environ['aws_access_key_id']
-    aws_secret_access_key = os.environ['aws_secret_access_key']
-    if config.getboolean('Shell Parameters', 'launch_in_sandbox_mode'):
-        conn = MTurkConnection(
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            host='mechanicalturk.sandbox.amazonaws.com')
-    else:
-        conn = MTurkConnection(
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key)
-
-    # get all participants with status < 100
-    participants = Participant.query.filter_by(status="working").all()
-
     # get current time
     current_time = datetime.now()
 
     # get experiment duration in seconds
     duration = float(config.get('HIT Configuration', 'duration')) * 60 * 60
 
-    # for each participant, if current_time - start_time > duration + 5 mins
-    for p in participants:
+    # get working participants that started more than duration + 2 mins ago
+    # These are read from the primary, as their statuses are written below.
+    cutoff = current_time - timedelta(seconds=duration + 120)
+    participants = overdue_participants(cutoff, current_time)
+
+    # ask amazon for the status of their assignments, a few at a time
+    statuses = pool.map(
+        assignment_status, [p.assignment_id for p in participants])
+
+    for p, status in zip(participants, statuses):
+        # Try again at the next sweep.
+        if status is UNKNOWN:
+            continue
+
+        recently_checked[p.id] = current_time
         p_time = (current_time - p.creation_time).total_seconds()
 
-        if p_time > (duration + 120):
-            print ("Error: participant {} with status {} has been playing for too "
-                   "long and no notification has arrived - "
-                   "running emergency code".format(p.id, p.status))
-
-            # get their assignment
-            assignment_id = p.assignment_id
-
-            # ask amazon for the status of the assignment
-            try:
-                assignment = conn.get_assignment(assignment_id)[0]
-                status = assignment.AssignmentStatus
-            except:
-                status = None
-            print "assignment status from AWS is {}".format(status)
-            hit_id = p.hit_id
-
-            # general email settings:
-            username = os.getenv('wallace_email_username')
-            fromaddr = username + "@gmail.com"
-            email_password = os.getenv("wallace_email_key")
-            toaddr = config.get('HIT Configuration', 'contact_email_on_error')
-            whimsical = os.getenv("whimsical")
-
-            if status == "Approved":
-                # if its been approved, set the status accordingly
-                print "status set to approved"
-                p.status = "approved"
-                session.commit()
-            elif status == "Rejected":
-                print "status set to rejected"
-                # if its been rejected, set the status accordingly
-                p.status = "rejected"
-                session.commit()
-            elif status == "Submitted":
-                # if it has been submitted then resend a submitted notification
-                args = {
-                    'Event.1.EventType': 'AssignmentSubmitted',
-                    'Event.1.AssignmentId': assignment_id
-                }
-                requests.post(
-                    "http://" + os.environ['HOST'] + '/notifications',
-                    data=args)
-
-                # send the researcher an email to let them know
-                if whimsical:
-                    msg = MIMEText(
-                        """Dearest Friend,\n\nI am writing to let you know that at
+        print ("Error: participant {} with status {} has been playing for too "
+               "long and no notification has arrived - "
+               "running emergency code".format(p.id, p.status))
+
+        # get their assignment
+        assignment_id = p.assignment_id
+        print "assignment status from AWS is {}".format(status)
+        hit_id = p.hit_id
+
+        # general email settings:
+        username = os.getenv('wallace_email_username')
+        fromaddr = username + "@gmail.com"
+        email_password = os.getenv("wallace_email_key")
+        toaddr = config.get('HIT Configuration', 'contact_email_on_error')
+        whimsical = os.getenv("whimsical")
+
+        if status == "Approved":
+            # if its been approved, set the status accordingly
+            print "status set to approved"
+            p.status = "approved"
+            session.commit()
+        elif status == "Rejected":
+            print "status set to rejected"
+            # if its been rejected, set the status accordingly
+            p.status = "rejected"
+            session.commit()
+        elif status == "Submitted":
+            # if it has been submitted then resend a submitted notification
+            args = {
+                'Event.1.EventType': 'AssignmentSubmitted',
+                'Event.1.AssignmentId': assignment_id
+            }
+            requests.post(
+                "http://" + os.environ['HOST'] + '/notifications',
+                data=args)
+
+            # send the researcher an email to let them know
+            if whimsical:
+                msg = MIMEText(
+                    """Dearest Friend,\n\nI am writing to let you know that at
  {}, during my regular (and thoroughly enjoyable) perousal of the most charming
   participant data table, I happened to notice that assignment {} has been
  taking longer than we were expecting. I recall you had suggested {} minutes as
@@ -125,15 +189,15 @@ def check_db_for_missing_notifications():
  at your earliest convenience.\n\nI remain your faithful and obedient servant,
 \nAlfred R. Wallace\n\n P.S. Please do not respond to this message, I am busy
  with other matters.""".format(
-                        datetime.now(),
-                        assignment_id,
-                        round(duration/60),
-                        round(p_time/60),
-                        round((p_time-duration)/60)))
-                    msg['Subject'] = "A matter of minor concern."
-                else:
-                    msg = MIMEText(
-                        """Dear experimenter,\n\nThis is an automated email from
+                    datetime.now(),
+                    assignment_id,
+                    round(duration/60),
+                    round(p_time/60),
+                    round((p_time-duration)/60)))
+                msg['Subject'] = "A matter of minor concern."
+            else:
+                msg = MIMEText(
+                    """Dear experimenter,\n\nThis is an automated email from
  Wallace. You are receiving this email because the Wallace platform has
  discovered evidence that a notification from Amazon Web Services failed to
  arrive at the server. Wallace has automatically contacted AWS and has
@@ -142,46 +206,46 @@ def check_db_for_missing_notifications():
  Wallace has auto-corrected the problem. Nonetheless you may wish to check the
  database.\n\nBest,\nThe Wallace dev. team.\n\n Error details:\nAssignment: {}
 \nAllowed time: {}\nTime since participant started: {}""").format(
-                        assignment_id,
-                        round(duration/60),
-                        round(p_time/60))
-                    msg['Subject'] = "Wallace automated email - minor error."
-
-                # This method commented out as gmail now blocks emails from
-                # new locations
-                # server = smtplib.SMTP('smtp.gmail.com:587')
-                # server.starttls()
-                # server.login(username, email_password)
-                # server.sendmail(fromaddr, toaddr, msg.as_string())
-                # server.quit()
-                print ("Error - submitted notification for participant {} missed. "
-                       "Database automatically corrected, but proceed with caution."
-                       .format(p.id))
-            else:
-                # if it has not been submitted shut everything down
-                # first turn off autorecruit
-                host = os.environ['HOST']
-                host = host[:-len(".herokuapp.com")]
-                args = json.dumps({"auto_recruit": "false"})
-                headers = {
-                    "Accept": "application/vnd.heroku+json; version=3",
-                    "Content-Type": "application/json"
-                }
-                heroku_email_address = os.getenv('heroku_email_address')
-                heroku_password = os.getenv('heroku_password')
-                requests.patch(
-                    "https://api.heroku.com/apps/{}/config-vars".format(host),
-                    data=args,
-                    auth=(heroku_email_address, heroku_password),
-                    headers=headers)
-
-                # then force expire the hit via boto
-                conn.expire_hit(hit_id)
-
-                # send the researcher an email to let them know
-                if whimsical:
-                    msg = MIMEText(
-                        """Dearest Friend,\n\nI am afraid I write to you with most
+                    assignment_id,
+                    round(duration/60),
+                    round(p_time/60))
+                msg['Subject'] = "Wallace automated email - minor error."
+
+            # This method commented out as gmail now blocks emails from
+            # new locations
+            # server = smtplib.SMTP('smtp.gmail.com:587')
+            # server.starttls()
+            # server.login(username, email_password)
+            # server.sendmail(fromaddr, toaddr, msg.as_string())
+            # server.quit()
+            print ("Error - submitted notification for participant {} missed. "
+                   "Database automatically corrected, but proceed with caution."
+                   .format(p.id))
+        else:
+            # if it has not been submitted shut everything down
+            # first turn off autorecruit
+            host = os.environ['HOST']
+            host = host[:-len(".herokuapp.com")]
+            args = json.dumps({"auto_recruit": "false"})
+            headers = {
+                "Accept": "application/vnd.heroku+json; version=3",
+                "Content-Type": "application/json"
+            }
+            heroku_email_address = os.getenv('heroku_email_address')
+            heroku_password = os.getenv('heroku_password')
+            requests.patch(
+                "https://api.heroku.com/apps/{}/config-vars".format(host),
+                data=args,
+                auth=(heroku_email_address, heroku_password),
+                headers=headers)
+
+            # then force expire the hit via boto
+            mturk_connection().expire_hit(hit_id)
+
+            # send the researcher an email to let them know
+            if whimsical:
+                msg = MIMEText(
+                    """Dearest Friend,\n\nI am afraid I write to you with most
  grave tidings. At {}, during a routine check of the usually most delightful
  participant data table, I happened to notice that assignment {} has been
  taking longer than we were expecting. I recall you had suggested {} minutes as
@@ -203,15 +267,15 @@ def check_db_for_missing_notifications():
  and intelligence for which I know you so well.\n\nI remain your faithful and
  obedient servant,\nAlfred R. Wallace\n\nP.S. Please do not respond to this
  message, I am busy with other matters.""".format(
-                        datetime.now(),
-                        assignment_id,
-                        round(duration/60),
-                        round(p_time/60),
-                        round((p_time-duration)/60)))
-                    msg['Subject'] = "Most troubling news."
-                else:
-                    msg = MIMEText(
-                        """Dear experimenter,\n\nThis is an automated email from
+                    datetime.now(),
+                    assignment_id,
+                    round(duration/60),
+                    round(p_time/60),
+                    round((p_time-duration)/60)))
+                msg['Subject'] = "Most troubling news."
+            else:
+                msg = MIMEText(
+                    """Dear experimenter,\n\nThis is an automated email from
  Wallace. You are receiving this email because the Wallace platform has
  discovered evidence that a notification from Amazon Web Services failed to
  arrive at the server. Wallace has automatically contacted AWS and has
@@ -226,31 +290,31 @@ def check_db_for_missing_notifications():
  emails this suggests something is wrong with your experiment code.\n\nBest,
 \nThe Wallace dev. team.\n\n Error details:\nAssignment: {}
 \nAllowed time: {}\nTime since participant started: {}""").format(
-                        assignment_id,
-                        round(duration/60),
-                        round(p_time/60))
-                    msg['Subject'] = "Wallace automated email - major error."
-
-                # This method commented out as gmail now blocks emails from
-                # new locations
-                # server = smtplib.SMTP('smtp.gmail.com:587')
-                # server.starttls()
-                # server.login(username, email_password)
-                # server.sendmail(fromaddr, toaddr, msg.as_string())
-                # server.quit()
-
-                # send a notificationmissing notification
-                args = {
-                    'Event.1.EventType': 'NotificationMissing',
-                    'Event.1.AssignmentId': assignment_id
-                }
-                requests.post(
-                    "http://" + os.environ['HOST'] + '/notifications',
-                    data=args)
-
-                print ("Error - abandoned/returned notification for participant {} missed. "
-                       "Experiment shut down. Please check database and then manually "
-                       "resume experiment."
-                       .format(p.id))
+                    assignment_id,
+                    round(duration/60),
+                    round(p_time/60))
+                msg['Subject'] = "Wallace automated email - major error."
+
+            # This method commented out as gmail now blocks emails from
+            # new locations
+            # server = smtplib.SMTP('smtp.gmail.com:587')
+            # server.starttls()
+            # server.login(username, email_password)
+            # server.sendmail(fromaddr, toaddr, msg.as_string())
+            # server.quit()
+
+            # send a notificationmissing notification
+            args = {
+                'Event.1.EventType': 'NotificationMissing',
+                'Event.1.AssignmentId': assignment_id
+            }
+            requests.post(
+                "http://" + os.environ['HOST'] + '/notifications',
+                data=args)
+
+            print ("Error - abandoned/returned notification for participant {} missed. "
+                   "Experiment shut down. Please check database and then manually "
+                   "resume experiment."
+                   .format(p.id))
 
 scheduler.start()
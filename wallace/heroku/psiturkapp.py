@@ -1,4 +1,42 @@
 """Launch the experiment server."""
 
 import psiturk.experiment_server as exp
-exp.launch()
+from psiturk.psiturk_config import PsiturkConfig
+
+config = PsiturkConfig()
+config.load_config()
+
+
+def patch_psycopg(server, worker):
+    """Let psycopg2 switch to other requests while it waits on Postgres."""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+class ExperimentServer(exp.ExperimentServer):
+    """The psiTurk experiment server, optionally with gevent workers.
+
+    With ``worker_class = gevent`` in the server parameters, each worker
+    process serves up to ``worker_connections`` requests at once, switching
+    between them whenever one waits on the database, Redis or the network.
+    Participants polling the server then no longer need a process each.
+    """
+
+    def load_user_config(self):
+        """Add the worker class to psiTurk's options."""
+        exp.ExperimentServer.load_user_config(self)
+
+        section = "Server Parameters"
+        if (config.has_option(section, "worker_class") and
+                config.get(section, "worker_class") == "gevent"):
+            connections = 1000
+            if config.has_option(section, "worker_connections"):
+                connections = config.getint(section, "worker_connections")
+            self.user_options.update({
+                "worker_class": "gevent",
+                "worker_connections": connections,
+                "post_fork": patch_psycopg,
+            })
+
+
+ExperimentServer().run()
@@ -2,9 +2,10 @@
 
 from future.builtins import map
 
+from multiprocessing import Process
 import os
 import redis
-from rq import Worker, Queue, Connection
+from rq import Worker, SimpleWorker, Queue, Connection
 
 listen = ['high', 'default', 'low']
 
@@ -12,7 +13,64 @@ redis_url = os.getenv('REDISCLOUD_URL', 'redis://localhost:6379')
 
 conn = redis.from_url(redis_url)
 
-if __name__ == '__main__':
+#: how many workers take jobs from the queues at once.
+concurrency = int(os.getenv('WORKER_CONCURRENCY', 1))
+
+#: the kinds of worker, by name. "fork" runs each job in a child forked from
+#: the worker, so a job that crashes can't take the worker down. "simple"
+#: runs jobs in the worker itself, keeping its database connections between
+#: jobs.
+WORKER_CLASSES = {
+    "fork": Worker,
+    "simple": SimpleWorker,
+}
+
+
+def get_worker_class(name):
+    """The kind of worker called name, see :data:`WORKER_CLASSES`."""
+    try:
+        return WORKER_CLASSES[name]
+    except KeyError:
+        raise ValueError("WORKER_CLASS must be one of {}, not '{}'.".format(
+            ", ".join('"{}"'.format(n) for n in sorted(WORKER_CLASSES)),
+            name))
+
+
+worker_class = get_worker_class(os.getenv('WORKER_CLASS', 'fork'))
+
+
+def preload():
+    """Import the experiment and the models the jobs use.
+
+    Without this, the child forked for each job imports them again itself.
+    """
+    import custom  # noqa, loads the experiment.
+    import wallace
+    from wallace import db
+
+    wallace.preload()
+
+    # Each child must open its own connections to the database.
+    db.engine.dispose()
+    if db.replica_engine is not None:
+        db.replica_engine.dispose()
+
+
+def work():
+    """Take jobs from the queues until stopped."""
     with Connection(conn):
-        worker = Worker(list(map(Queue, listen)))
+        worker = worker_class(list(map(Queue, listen)))
         worker.work()
+
+
+if __name__ == '__main__':
+    preload()
+
+    if concurrency == 1:
+        work()
+    else:
+        workers = [Process(target=work) for _ in range(concurrency)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
@@ -0,0 +1,144 @@
+"""Record what each request to the server costs.
+
+The number of SQL statements, the rows they return, the time spent in the
+database and the total time of every request are recorded in histograms,
+one set per route, and logged. The histograms are kept per process.
+
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+import logging
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+
+logger = logging.getLogger("wallace.metrics")
+
+#: the upper bounds, in milliseconds, of the buckets of time histograms.
+TIME_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+#: the upper bounds of the buckets of query and row count histograms.
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000]
+
+
+class Histogram(object):
+    """Counts of observations falling into fixed buckets."""
+
+    def __init__(self, buckets):
+        """Create an empty histogram with the given bucket upper bounds."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Add an observation."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def __json__(self):
+        """The json representation of a histogram.
+
+        Each bucket is labelled with its upper bound; the last is "+Inf".
+        """
+        return {
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"],
+                                self.counts)),
+            "count": self.count,
+            "sum": self.sum
+        }
+
+
+class RouteMetrics(object):
+    """The histograms of a single route."""
+
+    def __init__(self):
+        """Create empty histograms."""
+        self.queries = Histogram(COUNT_BUCKETS)
+        self.rows = Histogram(COUNT_BUCKETS)
+        self.db_time = Histogram(TIME_BUCKETS)
+        self.total_time = Histogram(TIME_BUCKETS)
+
+    def __json__(self):
+        """The json representation of the route's histograms."""
+        return {
+            "queries": self.queries.__json__(),
+            "rows": self.rows.__json__(),
+            "db_time": self.db_time.__json__(),
+            "total_time": self.total_time.__json__()
+        }
+
+
+#: the metrics of every route that has been requested, by route.
+routes = defaultdict(RouteMetrics)
+
+_lock = threading.Lock()
+_local = threading.local()
+_instrumented = weakref.WeakSet()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("wallace_query_start", []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info["wallace_query_start"].pop()
+    current = getattr(_local, "current", None)
+    if current is not None:
+        current["queries"] += 1
+        current["rows"] += max(cursor.rowcount, 0)
+        current["db_time"] += time.time() - start
+
+
+def instrument(engine):
+    """Start counting the statements the engine runs."""
+    if engine in _instrumented:
+        return
+    _instrumented.add(engine)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def start_request():
+    """Start recording a request in this thread."""
+    _local.current = {
+        "queries": 0,
+        "rows": 0,
+        "db_time": 0.0,
+        "start": time.time()
+    }
+
+
+def finish_request(route, status=None):
+    """Record the request this thread has been working on under route."""
+    current = getattr(_local, "current", None)
+    if current is None:
+        return
+    _local.current = None
+
+    total_time = (time.time() - current["start"]) * 1000
+    db_time = current["db_time"] * 1000
+
+    with _lock:
+        metrics = routes[route]
+        metrics.queries.observe(current["queries"])
+        metrics.rows.observe(current["rows"])
+        metrics.db_time.observe(db_time)
+        metrics.total_time.observe(total_time)
+
+    logger.info("%s %s: %d queries, %d rows, %.1fms in db, %.1fms total",
+                route, status, current["queries"], current["rows"],
+                db_time, total_time)
+
+
+def report():
+    """The metrics of every route, as json."""
+    with _lock:
+        return dict((route, metrics.__json__())
+                    for route, metrics in routes.items())
@@ -1,24 +1,104 @@
 """Define Wallace's core models."""
 
+from collections import defaultdict, OrderedDict
 from datetime import datetime
+import hashlib
+import importlib
+import json
+import zlib
 
-from .db import Base
+from .db import Base, memoized
 
-from sqlalchemy import ForeignKey, or_, and_
+from sqlalchemy import ForeignKey, or_, and_, func, select, literal, event
 from sqlalchemy import (Column, String, Text, Enum, Integer, Boolean, DateTime,
-                        Float)
-from sqlalchemy.orm import relationship, validates
+                        Float, Index, LargeBinary)
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.sql.expression import case, cast
+from sqlalchemy.types import UserDefinedType
+from sqlalchemy.orm import relationship, validates, deferred, undefer, mapper
 
 import inspect
 
 DATETIME_FMT = "%Y-%m-%dT%H:%M:%S.%f"
 
+#: the SQL aggregates that :func:`~wallace.models.Participant.aggregate` can
+#: compute.
+AGGREGATES = {
+    "mean": func.avg,
+    "min": func.min,
+    "max": func.max,
+    "sum": func.sum,
+    "count": func.count,
+}
+
+#: the columns :func:`~wallace.models.Network.snapshot` returns, by the table
+#: they are in.
+SNAPSHOT_COLUMNS = OrderedDict([
+    ("nodes", ("node", ["id", "type", "participant_id", "failed",
+                        "creation_time", "time_of_death"])),
+    ("vectors", ("vector", ["id", "origin_id", "destination_id", "failed",
+                            "creation_time", "time_of_death"])),
+    ("infos", ("info", ["id", "type", "origin_id", "failed",
+                        "creation_time", "time_of_death"])),
+    ("transmissions", ("transmission", ["id", "vector_id", "info_id",
+                                        "origin_id", "destination_id",
+                                        "status", "failed", "creation_time",
+                                        "receive_time", "time_of_death"])),
+])
+
 
 def timenow():
     """A string representing the current date and time."""
     return datetime.now()
 
 
+def _with_contents(query, load_contents):
+    """Load the contents of the infos a query returns, if asked to.
+
+    The contents of infos are not loaded until they are used, as they can be
+    large and are often not needed.
+
+    """
+    if load_contents:
+        return query.options(undefer("_contents"))
+    return query
+
+
+def _dialect():
+    """The name of the database the session is connected to."""
+    return Info.query.session.get_bind(Info.__mapper__).dialect.name
+
+
+def _recursive_queries():
+    """Whether lineage can be traced with recursive queries.
+
+    SQLite may be too old to support WITH RECURSIVE, so lineages are traced
+    in memory instead.
+
+    """
+    return _dialect() != "sqlite"
+
+
+class _JSON(UserDefinedType):
+    """The postgres json type, which SQLAlchemy does not yet provide."""
+
+    def get_col_spec(self):
+        return "JSON"
+
+
+#: the value of :attr:`~wallace.models.Info._parsed_contents` before the
+#: contents have been parsed.
+_UNPARSED = object()
+
+
+def _lineage_edges(network_id):
+    """The (info_in_id, info_out_id) pairs of a network's transformations."""
+    return Transformation.query\
+        .with_entities(Transformation.info_in_id, Transformation.info_out_id)\
+        .filter_by(network_id=network_id, failed=False)\
+        .all()
+
+
 class SharedMixin(object):
     """Create shared columns."""
 
@@ -62,6 +142,12 @@ class Participant(Base, SharedMixin):
 
     __tablename__ = "participant"
 
+    #: the clock process looks for working participants created before a
+    #: cutoff, so index on both.
+    __table_args__ = (
+        Index("participant_status_creation_time", "status", "creation_time"),
+    )
+
     #: a String giving the name of the class. Defaults to
     #: "participant". This allows subclassing.
     type = Column(String(50))
@@ -149,6 +235,7 @@ class Participant(Base, SharedMixin):
             "property5": self.property5
         }
 
+    @memoized("node")
     def nodes(self, type=None, failed=False):
         """Get nodes associated with this participant.
 
@@ -196,7 +283,7 @@ class Participant(Base, SharedMixin):
             .filter_by(participant_id=self.id)\
             .all()
 
-    def infos(self, type=None, failed=False):
+    def infos(self, type=None, failed=False, load_contents=False):
         """Get all infos created by the participants nodes.
 
         Return a list of infos produced by nodes associated with the
@@ -204,15 +291,63 @@ class Participant(Base, SharedMixin):
         infos are excluded, to include only failed nodes use ``failed=True``,
         for all nodes use ``failed=all``. Note that failed filters the infos,
         not the nodes - infos from all nodes (whether failed or not) can be
-        returned.
+        returned. Contents are loaded when first used unless
+        ``load_contents`` is True.
 
         """
         nodes = self.nodes(failed="all")
         infos = []
         for n in nodes:
-            infos.extend(n.infos(type=type, failed=failed))
+            infos.extend(n.infos(type=type, failed=failed,
+                                 load_contents=load_contents))
         return infos
 
+    def aggregate(self, property, function="mean", type=None,
+                  network_role=None, failed=False):
+        """Aggregate a property of the participant's nodes.
+
+        ``property`` is the name of a column or hybrid property of ``type``
+        (which defaults to Node), and ``function`` is one of "mean", "min",
+        "max", "sum" or "count". If specified, ``network_role`` only includes
+        nodes in networks with that role. ``failed`` works as it does in
+        :func:`~wallace.models.Participant.nodes`. The aggregate is worked out
+        by the database in a single query, so hybrid properties need an
+        expression that casts to the right type. Returns None if there are no
+        nodes to aggregate, except for "count".
+
+        """
+        if type is None:
+            type = Node
+
+        if not issubclass(type, Node):
+            raise(TypeError("{} is not a valid node type.".format(type)))
+
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid node failed".format(failed))
+
+        if function not in AGGREGATES:
+            raise ValueError("{} is not a valid aggregate function"
+                             .format(function))
+
+        query = type.query\
+            .with_entities(AGGREGATES[function](getattr(type, property)))\
+            .filter(type.participant_id == self.id)
+
+        if type is not Node:
+            query = query.filter(type.type.in_(
+                [m.polymorphic_identity
+                 for m in type.__mapper__.self_and_descendants]))
+
+        if failed != "all":
+            query = query.filter(type.failed == failed)
+
+        if network_role is not None:
+            query = query\
+                .join(Network, Network.id == type.network_id)\
+                .filter(Network.role == network_role)
+
+        return query.scalar()
+
     def fail(self):
         """Fail a participant.
 
@@ -367,6 +502,7 @@ class Network(Base, SharedMixin):
     Methods that get things about a Network
     ################################### """
 
+    @memoized("node")
     def nodes(self, type=None, failed=False, participant_id=None):
         """Get nodes in the network.
 
@@ -417,14 +553,27 @@ class Network(Base, SharedMixin):
         """
         return len(self.nodes(type=type, failed=failed))
 
-    def infos(self, type=None, failed=False):
+    def open_slots(self):
+        """How many more nodes the network has room for right now.
+
+        Experiments use this to work out how many participants to recruit.
+        Networks that only take some of their nodes at a time (for instance,
+        one generation at a time) override it.
+        """
+        if self.full:
+            return 0
+        return max(self.max_size - self.size(), 0)
+
+    @memoized("info")
+    def infos(self, type=None, failed=False, load_contents=False):
         """
         Get infos in the network.
 
         type specifies the type of info (defaults to Info). failed { False,
         True, "all" } specifies the failed state of the infos. To get infos
         from a specific node, see the infos() method in class
-        :class:`~wallace.models.Node`.
+        :class:`~wallace.models.Node`. Contents are loaded when first used
+        unless load_contents is True.
 
         """
         if type is None:
@@ -432,14 +581,94 @@ class Network(Base, SharedMixin):
         if failed not in ["all", False, True]:
             raise ValueError("{} is not a valid failed".format(failed))
 
+        query = _with_contents(type.query, load_contents)
         if failed == "all":
-            return type.query\
+            return query\
                 .filter_by(network_id=self.id)\
                 .all()
         else:
-            return type.query.filter_by(
+            return query.filter_by(
                 network_id=self.id, failed=failed).all()
 
+    def lineage_forest(self):
+        """Get the lineage of every info in the network.
+
+        Return an OrderedDict mapping the id of every info involved in the
+        network's transformations to the ids of the infos it was transformed
+        from; infos with no parents are the roots of the forest.
+        Infos are ordered by depth, roots first, so every info comes after its
+        parents. Failed transformations are ignored. This takes a single query
+        however deep the forest is.
+
+        """
+        if not _recursive_queries():
+            return self._lineage_forest_in_memory()
+
+        t = Transformation.__table__
+        live = t.c.failed == False
+
+        children = t.alias("children")
+
+        lineage = select([t.c.info_in_id.label("info_id"),
+                          literal(0).label("depth")])\
+            .where(and_(live,
+                        t.c.network_id == self.id,
+                        ~t.c.info_in_id.in_(
+                            select([children.c.info_out_id])
+                            .where(and_(children.c.failed == False,
+                                        children.c.network_id == self.id,
+                                        children.c.info_out_id != None)))))\
+            .distinct()\
+            .cte("lineage", recursive=True)
+        lineage = lineage.union(
+            select([t.c.info_out_id, lineage.c.depth + 1])
+            .where(and_(live, t.c.info_in_id == lineage.c.info_id)))
+
+        deepest = select([lineage.c.info_id,
+                          func.max(lineage.c.depth).label("depth")])\
+            .group_by(lineage.c.info_id)\
+            .alias("deepest")
+
+        rows = Info.query.session.execute(
+            select([deepest.c.info_id, t.c.info_in_id])
+            .select_from(deepest.outerjoin(
+                t, and_(live, t.c.info_out_id == deepest.c.info_id)))
+            .order_by(deepest.c.depth, deepest.c.info_id, t.c.info_in_id))
+
+        forest = OrderedDict()
+        for info_id, parent_id in rows:
+            parents = forest.setdefault(info_id, [])
+            if parent_id is not None:
+                parents.append(parent_id)
+        return forest
+
+    def _lineage_forest_in_memory(self):
+        """Work out :func:`lineage_forest` in Python."""
+        parents = defaultdict(list)
+        children = defaultdict(list)
+        for info_in_id, info_out_id in _lineage_edges(self.id):
+            parents[info_out_id].append(info_in_id)
+            children[info_in_id].append(info_out_id)
+
+        depth = dict((i, 0) for i in children if i not in parents)
+        waiting = dict((i, len(p)) for i, p in parents.items())
+        frontier = sorted(depth)
+        while frontier:
+            next_frontier = []
+            for info_id in frontier:
+                for child in children[info_id]:
+                    depth[child] = max(depth.get(child, 0),
+                                       depth[info_id] + 1)
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        next_frontier.append(child)
+            frontier = next_frontier
+
+        return OrderedDict(
+            (i, sorted(parents[i]))
+            for i in sorted(depth, key=lambda i: (depth[i], i)))
+
+    @memoized("transmission")
     def transmissions(self, status="all", failed=False):
         """Get transmissions in the network.
 
@@ -475,6 +704,75 @@ class Network(Base, SharedMixin):
                         network_id=self.id, status=status, failed=failed)\
                     .all()
 
+    def snapshot(self, failed=False, load_contents=False):
+        """Get the nodes, vectors, infos and transmissions of the network.
+
+        Return a dict with an entry for each, holding their columns as lists
+        with one value per row, in order of id: ids, types, endpoints,
+        statuses and timestamps (see ``SNAPSHOT_COLUMNS``). This takes one
+        query per table and is much smaller than a description of every
+        object. failed { False, True, "all" }. The contents of the infos are
+        included only if load_contents is True.
+
+        """
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid failed".format(failed))
+
+        snapshot = OrderedDict()
+        for name, (table, columns) in SNAPSHOT_COLUMNS.items():
+            t = Base.metadata.tables[table]
+            selected = [t.c[c] for c in columns]
+            if name == "infos" and load_contents:
+                selected += [t.c.contents, t.c.contents_hash]
+
+            query = select(selected).where(t.c.network_id == self.id)
+            if failed != "all":
+                query = query.where(t.c.failed == failed)
+            rows = Info.query.session.execute(query.order_by(t.c.id))\
+                .fetchall()
+
+            snapshot[name] = OrderedDict(
+                (column, [row[i] for row in rows])
+                for i, column in enumerate(columns))
+
+            if name == "infos" and load_contents:
+                blobs = {}
+                contents = []
+                for row in rows:
+                    if row.contents is None and row.contents_hash is not None:
+                        if row.contents_hash not in blobs:
+                            blobs[row.contents_hash] = \
+                                Blob.load(row.contents_hash)
+                        contents.append(blobs[row.contents_hash])
+                    else:
+                        contents.append(row.contents)
+                snapshot[name]["contents"] = contents
+        return snapshot
+
+    def version(self):
+        """A string that changes whenever the network's snapshot changes.
+
+        Rows are only ever added to the snapshot's tables, failed, or (for
+        transmissions) received, so counting them, their failures and their
+        receipts, with the highest id, is enough to notice any change. This
+        takes a single query and reads no rows, so clients can be told
+        cheaply that the snapshot they have is still current.
+
+        """
+        counts = []
+        for table, _ in SNAPSHOT_COLUMNS.values():
+            t = Base.metadata.tables[table]
+            aggregates = [func.count(t.c.id), func.max(t.c.id),
+                          func.count(t.c.time_of_death)]
+            if table == "transmission":
+                aggregates.append(func.count(t.c.receive_time))
+            counts += [select([a]).where(t.c.network_id == self.id)
+                       .as_scalar() for a in aggregates]
+
+        row = Info.query.session.execute(select(counts)).fetchone()
+        return "{}-{}".format(self.id, hashlib.sha1(
+            ",".join(str(value) for value in row)).hexdigest()[:16])
+
     def transformations(self, type=None, failed=False):
         """Get transformations in the network.
 
@@ -513,6 +811,7 @@ class Network(Base, SharedMixin):
         else:
             return None
 
+    @memoized("vector")
     def vectors(self, failed=False):
         """
         Get vectors in the network.
@@ -652,6 +951,7 @@ class Node(Base, SharedMixin):
     Methods that get things about a node
     ################################### """
 
+    @memoized("vector")
     def vectors(self, direction="all", failed=False):
         """Get vectors that connect at this node.
 
@@ -702,6 +1002,7 @@ class Node(Base, SharedMixin):
                     .filter_by(origin_id=self.id, failed=failed)\
                     .all()
 
+    @memoized("vector", "node")
     def neighbors(self, type=None, direction="to", failed=None):
         """Get a node's neighbors - nodes that are directly connected to it.
 
@@ -847,11 +1148,13 @@ class Node(Base, SharedMixin):
         else:
             return connected[0]
 
-    def infos(self, type=None, failed=False):
+    @memoized("info")
+    def infos(self, type=None, failed=False, load_contents=False):
         """Get infos that originate from this node.
 
         Type must be a subclass of :class:`~wallace.models.Info`, the default is
-        ``Info``. Failed can be True, False or "all".
+        ``Info``. Failed can be True, False or "all". Contents are loaded when
+        first used unless load_contents is True.
 
         """
         if type is None:
@@ -865,21 +1168,22 @@ class Node(Base, SharedMixin):
         if failed not in ["all", False, True]:
             raise ValueError("{} is not a valid vector failed".format(failed))
 
+        query = _with_contents(type.query, load_contents)
         if failed == "all":
-            return type\
-                .query\
+            return query\
                 .filter_by(origin_id=self.id)\
                 .all()
         else:
-            return type\
-                .query\
+            return query\
                 .filter_by(origin_id=self.id, failed=failed)\
                 .all()
 
-    def received_infos(self, type=None, failed=None):
+    @memoized("transmission", "info")
+    def received_infos(self, type=None, failed=None, load_contents=False):
         """Get infos that have been sent to this node.
 
-        Type must be a subclass of info, the default is Info.
+        Type must be a subclass of info, the default is Info. Contents are
+        loaded when first used unless load_contents is True.
         """
         if failed is not None:
             raise ValueError(
@@ -908,10 +1212,12 @@ class Node(Base, SharedMixin):
 
         info_ids = [t.info_id for t in transmissions]
         if info_ids:
-            return type.query.filter(type.id.in_(info_ids)).all()
+            return _with_contents(type.query, load_contents)\
+                .filter(type.id.in_(info_ids)).all()
         else:
             return []
 
+    @memoized("transmission")
     def transmissions(self, direction="outgoing", status="all", failed=False):
         """Get transmissions sent to or from this node.
 
@@ -1396,6 +1702,59 @@ class Vector(Base, SharedMixin):
                 t.fail()
 
 
+class Blob(Base):
+    """The compressed contents of one or more infos.
+
+    Infos store their contents as a blob if they are at least
+    :attr:`~wallace.models.Info.blob_threshold` characters long. Blobs are
+    found by the hash of their contents, so identical contents, such as
+    those copied by replication, are only stored once.
+    """
+
+    __tablename__ = "blob"
+
+    #: a unique number for every blob.
+    id = Column(Integer, primary_key=True)
+
+    #: the SHA-256 hash of the uncompressed contents. This is not unique: two
+    #: transactions storing the same contents at once will both add a blob,
+    #: which is harmless.
+    hash = Column(String(64), nullable=False, index=True)
+
+    #: the contents, compressed with zlib.
+    data = Column(LargeBinary, nullable=False)
+
+    @classmethod
+    def store(cls, contents):
+        """Store contents as a blob unless they already are, return the hash."""
+        if isinstance(contents, unicode):
+            contents = contents.encode("utf-8")
+        digest = hashlib.sha256(contents).hexdigest()
+        session = cls.query.session
+        # The info storing these contents may be pending, and can't be
+        # flushed before its contents_hash is set, so look for blobs that
+        # are pending too rather than flushing them.
+        pending = any(isinstance(obj, cls) and obj.hash == digest
+                      for obj in session.new)
+        if not pending:
+            with session.no_autoflush:
+                stored = cls.query.filter_by(hash=digest).count()
+            if not stored:
+                session.add(cls(hash=digest, data=zlib.compress(contents)))
+        return digest
+
+    @classmethod
+    def load(cls, digest):
+        """Get the contents with the given hash.
+
+        Raises a ValueError if there is no blob with that hash.
+        """
+        blob = cls.query.filter_by(hash=digest).first()
+        if blob is None:
+            raise ValueError("There is no blob with hash {}.".format(digest))
+        return zlib.decompress(blob.data)
+
+
 class Info(Base, SharedMixin):
     """A unit of information."""
 
@@ -1421,8 +1780,29 @@ class Info(Base, SharedMixin):
     #: the network the info is in
     network = relationship(Network, backref="all_infos")
 
-    #: the contents of the info. Must be stored as a String.
-    contents = Column(Text(), default=None)
+    #: the contents of the info, unless they are stored as a blob. These are
+    #: only loaded when they are used, see
+    #: :func:`~wallace.models.Node.infos`.
+    _contents = deferred(Column("contents", Text(), default=None))
+
+    #: the hash of the info's contents if they are stored as a
+    #: :class:`~wallace.models.Blob`.
+    contents_hash = Column(String(64), default=None, index=True)
+
+    #: contents at least this long are compressed and stored in the blob
+    #: table, so that identical contents are only stored once. ``None`` (the
+    #: default) stores all contents in the info table. Subclasses with large
+    #: contents can set this.
+    blob_threshold = None
+
+    _blob_contents = None
+
+    #: if True the contents are JSON. They can be set to any value that can
+    #: be serialized as JSON and read back, parsed, from
+    #: :attr:`~wallace.models.Info.parsed_contents`. Default is False.
+    json_contents = False
+
+    _parsed_contents = _UNPARSED
 
     def __init__(self, origin, contents=None):
         """Create an info."""
@@ -1437,10 +1817,88 @@ class Info(Base, SharedMixin):
         self.network_id = origin.network_id
         self.network = origin.network
 
-    @validates("contents")
+    @hybrid_property
+    def contents(self):
+        """The contents of the info. Must be stored as a String."""
+        if self._contents is None and self.contents_hash is not None:
+            if self._blob_contents is None:
+                self._blob_contents = Blob.load(self.contents_hash)
+            return self._blob_contents
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents):
+        """Set the contents, as a blob if they are long enough."""
+        if self.contents is not None:
+            raise ValueError("The contents of an info is write-once.")
+        if (self.json_contents and contents is not None and
+                not isinstance(contents, basestring)):
+            self._parsed_contents = contents
+            contents = json.dumps(contents, sort_keys=True)
+        if (contents is not None and self.blob_threshold is not None and
+                len(contents) >= self.blob_threshold):
+            self.contents_hash = Blob.store(contents)
+            self._blob_contents = contents
+        else:
+            self._contents = contents
+
+    @contents.expression
+    def contents(self):
+        """Query the contents column. Blob contents are NULL."""
+        return self._contents
+
+    @property
+    def parsed_contents(self):
+        """The contents parsed as JSON.
+
+        Only for infos with :attr:`~wallace.models.Info.json_contents`. The
+        contents are parsed once and the result is kept, so it should not be
+        modified.
+        """
+        if not self.json_contents:
+            raise AttributeError(
+                "{} does not have JSON contents.".format(type(self)))
+        if self._parsed_contents is _UNPARSED:
+            contents = self.contents
+            self._parsed_contents = (
+                None if contents is None else json.loads(contents))
+        return self._parsed_contents
+
+    @classmethod
+    def json_field(cls, *path):
+        """A SQL expression for a field inside JSON contents.
+
+        ``path`` is the sequence of keys leading to the field. The field is
+        text, so cast it to compare it as anything else, e.g.
+        ``cast(AnimalInfo.json_field("head_angle"), Float) > 40``. This lets
+        infos be filtered or selected by their contents without loading and
+        parsing them. Works on PostgreSQL and on SQLite with JSON support.
+
+        Only the contents of this class and its subclasses with
+        :attr:`~wallace.models.Info.json_contents` are parsed, so other
+        infos in the same query can hold contents that are not JSON; for
+        them the field is NULL. Contents stored as blobs are not visible to
+        the database, so for those infos it is NULL too.
+        """
+        types = [mapper.polymorphic_identity
+                 for mapper in cls.__mapper__.self_and_descendants
+                 if mapper.class_.json_contents]
+        if not types:
+            raise ValueError(
+                "{} does not have JSON contents.".format(cls.__name__))
+
+        if _dialect() == "sqlite":
+            field = func.json_extract(
+                cls._contents,
+                "$" + "".join('."{}"'.format(key) for key in path))
+        else:
+            field = func.json_extract_path_text(
+                cast(cls._contents, _JSON()), *path)
+        return case([(cls.type.in_(types), field)])
+
+    @validates("_contents", "contents_hash")
     def _write_once(self, key, value):
-        existing = getattr(self, key)
-        if existing is not None:
+        if self.contents is not None:
             raise ValueError("The contents of an info is write-once.")
         return value
 
@@ -1448,9 +1906,12 @@ class Info(Base, SharedMixin):
         """The string representation of an info."""
         return "Info-{}-{}".format(self.id, self.type)
 
-    def __json__(self):
-        """The json representation of an info."""
-        return {
+    def __json__(self, contents=True):
+        """The json representation of an info.
+
+        If contents is False the contents are left out.
+        """
+        json = {
             "id": self.id,
             "type": self.type,
             "origin_id": self.origin_id,
@@ -1458,13 +1919,15 @@ class Info(Base, SharedMixin):
             "creation_time": self.creation_time,
             "failed": self.failed,
             "time_of_death": self.time_of_death,
-            "contents": self.contents,
             "property1": self.property1,
             "property2": self.property2,
             "property3": self.property3,
             "property4": self.property4,
             "property5": self.property5
         }
+        if contents:
+            json["contents"] = self.contents
+        return json
 
     def fail(self):
         """Fail an info.
@@ -1508,6 +1971,79 @@ class Info(Base, SharedMixin):
                           failed=False)\
                 .all()
 
+    def ancestors(self):
+        """Get the infos this info was transformed from, however indirectly.
+
+        Return a list of the infos found by following (not failed)
+        transformations back from this info, nearest first. For an info at
+        the end of a chain of replications this is every earlier info in the
+        chain. This takes a single query however long the lineage is.
+
+        """
+        return self._lineage("info_out_id", "info_in_id")
+
+    def descendants(self):
+        """Get the infos transformed from this info, however indirectly.
+
+        Return a list of the infos found by following (not failed)
+        transformations on from this info, nearest first. This takes a single
+        query however long the lineage is.
+
+        """
+        return self._lineage("info_in_id", "info_out_id")
+
+    def _lineage(self, near, far):
+        """Follow transformations from the near end to the far end."""
+        if not _recursive_queries():
+            return self._lineage_in_memory(near, far)
+
+        t = Transformation.__table__
+        live = t.c.failed == False
+
+        lineage = select([t.c[far].label("info_id"), literal(1).label("depth")])\
+            .where(and_(live, t.c[near] == self.id))\
+            .cte("lineage", recursive=True)
+        lineage = lineage.union(
+            select([t.c[far], lineage.c.depth + 1])
+            .where(and_(live, t.c[near] == lineage.c.info_id)))
+
+        nearest = select([lineage.c.info_id,
+                          func.min(lineage.c.depth).label("depth")])\
+            .group_by(lineage.c.info_id)\
+            .alias("nearest")
+
+        return Info.query\
+            .join(nearest, Info.id == nearest.c.info_id)\
+            .order_by(nearest.c.depth, Info.id)\
+            .all()
+
+    def _lineage_in_memory(self, near, far):
+        """Work out :func:`_lineage` in Python."""
+        edges = defaultdict(list)
+        for info_in_id, info_out_id in _lineage_edges(self.network_id):
+            if near == "info_in_id":
+                edges[info_in_id].append(info_out_id)
+            else:
+                edges[info_out_id].append(info_in_id)
+
+        depth = {}
+        frontier = [self.id]
+        generation = 0
+        while frontier:
+            generation += 1
+            next_frontier = []
+            for info_id in frontier:
+                for other in edges[info_id]:
+                    if other not in depth and other != self.id:
+                        depth[other] = generation
+                        next_frontier.append(other)
+            frontier = next_frontier
+
+        if not depth:
+            return []
+        infos = Info.query.filter(Info.id.in_(depth.keys())).all()
+        return sorted(infos, key=lambda i: (depth[i.id], i.id))
+
     def transformations(self, relationship="all"):
         """Get all the transformations of this info.
 
@@ -1777,9 +2313,25 @@ class Notification(Base, SharedMixin):
     """A notification from AWS."""
 
     __tablename__ = "notification"
+    __table_args__ = (
+        Index("notification_assignment_id_event_type",
+              "assignment_id", "event_type"),
+    )
 
     # the assignment is from AWS the notification pertains to
     assignment_id = Column(String, nullable=False)
 
     # the type of notification
     event_type = Column(String, nullable=False)
+
+
+@event.listens_for(mapper, "after_configured")
+def _define_types():
+    """Define Wallace's own types once the models are first used.
+
+    Rows are loaded as the type they were saved as, which SQLAlchemy only
+    knows once its class has been defined, so importing the models alone
+    must be enough to load any of them.
+    """
+    for name in ("information", "nodes", "networks", "transformations"):
+        importlib.import_module("wallace." + name)
@@ -1,6 +1,6 @@
 """Network structures commonly used in simulations of evolution."""
 
-from .models import Network, Node
+from .models import Network, Node, Participant
 from .nodes import Source
 import random
 from operator import attrgetter
@@ -135,6 +135,32 @@ class DiscreteGenerational(Network):
         """The source that seeds the first generation."""
         return bool(self.property3)
 
+    def open_slots(self):
+        """How many places are open in the current generation.
+
+        The next generation only opens once everyone in the current one has
+        finished, as they are who its members will learn from.
+        """
+        space = super(DiscreteGenerational, self).open_slots()
+        if not space:
+            return 0
+
+        num_agents = len([n for n in self.nodes()
+                          if not isinstance(n, Source)])
+        filled = num_agents % self.generation_size
+        if filled:
+            return min(self.generation_size - filled, space)
+
+        still_working = Participant.query\
+            .join(Node, Node.participant_id == Participant.id)\
+            .filter(Node.network_id == self.id,
+                    Node.failed == False,
+                    Participant.status == "working")\
+            .count()
+        if still_working:
+            return 0
+        return min(self.generation_size, space)
+
     def add_node(self, node):
         """Link the agent to a random member of the previous generation."""
         nodes = [n for n in self.nodes() if not isinstance(n, Source)]
@@ -3,7 +3,6 @@
 import os
 from psiturk.psiturk_config import PsiturkConfig
 from psiturk.models import Participant
-from boto.mturk.connection import MTurkConnection
 
 
 class Recruiter(object):
@@ -21,6 +20,14 @@ class Recruiter(object):
         """Throw an error."""
         raise NotImplementedError
 
+    def outstanding(self):
+        """Throw an error."""
+        raise NotImplementedError
+
+    def cancel_recruitment(self, n=1):
+        """Throw an error."""
+        raise NotImplementedError
+
     def close_recruitment(self):
         """Throw an error."""
         raise NotImplementedError
@@ -44,6 +51,14 @@ class HotAirRecruiter(object):
         """Talk about recruiting participants."""
         print "Recruiting a new participant."
 
+    def outstanding(self):
+        """Nobody was really recruited, so nobody is on their way."""
+        return 0
+
+    def cancel_recruitment(self, n=1):
+        """Talk about cancelling recruitment."""
+        print "Cancelling {} places.".format(n)
+
     def close_recruitment(self):
         """Talk about closing recruitment."""
         print "Close recruitment."
@@ -66,6 +81,14 @@ class SimulatedRecruiter(object):
             newcomer = exp.agent_type()
             exp.newcomer_arrival_trigger(newcomer)
 
+    def outstanding(self):
+        """Simulated participants arrive immediately."""
+        return 0
+
+    def cancel_recruitment(self, n=1):
+        """Do nothing."""
+        pass
+
     def close_recruitment(self):
         """Do nothing."""
         pass
@@ -99,6 +122,9 @@ class PsiTurkRecruiter(Recruiter):
             "aws_region",
             self.config.get("AWS Access", "aws_region"))
 
+        self.mtc = None
+        self._hit = None
+
     def open_recruitment(self, n=1):
         """Open recruitment for the first HIT, unless it's already open."""
         from psiturk.amt_services import MTurkServices, RDSServices
@@ -157,26 +183,10 @@ class PsiTurkRecruiter(Recruiter):
 
             print "Starting Wallace's recruit_participants."
 
-            hit_id = str(
-                Participant.query.
-                with_entities(Participant.hitid).first().hitid)
-
+            hit_id = self.hit_id()
             print "hit_id is {}.".format(hit_id)
 
-            is_sandbox = self.config.getboolean(
-                'Shell Parameters', 'launch_in_sandbox_mode')
-
-            if is_sandbox:
-                host = 'mechanicalturk.sandbox.amazonaws.com'
-            else:
-                host = 'mechanicalturk.amazonaws.com'
-
-            mturkparams = dict(
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                host=host)
-
-            self.mtc = MTurkConnection(**mturkparams)
+            self.mtc = self.mturk_connection()
 
             self.mtc.extend_hit(
                 hit_id,
@@ -189,10 +199,73 @@ class PsiTurkRecruiter(Recruiter):
                 hit_id,
                 expiration_increment=int(
                     float(expiration_increment or 0) * 3600))
+            self._hit = None
         else:
             print(">>>> auto_recruit set to {}: recruitment suppressed"
                   .format(auto_recruit))
 
+    def hit_id(self):
+        """The id of the experiment's HIT."""
+        return str(
+            Participant.query.
+            with_entities(Participant.hitid).first().hitid)
+
+    def mturk_connection(self):
+        """Connect to MTurk, or reuse the connection already open."""
+        from boto.mturk.connection import MTurkConnection
+
+        if self.mtc is not None:
+            return self.mtc
+
+        is_sandbox = self.config.getboolean(
+            'Shell Parameters', 'launch_in_sandbox_mode')
+
+        if is_sandbox:
+            host = 'mechanicalturk.sandbox.amazonaws.com'
+        else:
+            host = 'mechanicalturk.amazonaws.com'
+
+        self.mtc = MTurkConnection(
+            aws_access_key_id=self.aws_access_key_id,
+            aws_secret_access_key=self.aws_secret_access_key,
+            host=host)
+        return self.mtc
+
+    def hit(self):
+        """The experiment's HIT, as MTurk last reported it.
+
+        MTurk is only asked once, until the HIT is changed, so working out
+        how many places are outstanding and then cancelling them makes a
+        single request.
+
+        """
+        if self._hit is None:
+            self._hit = self.mturk_connection().get_hit(self.hit_id())[0]
+        return self._hit
+
+    def outstanding(self):
+        """How many assignments of the HIT are yet to be accepted."""
+        return int(self.hit().NumberOfAssignmentsAvailable)
+
+    def cancel_recruitment(self, n=1):
+        """Withdraw n of the assignments that are yet to be accepted.
+
+        MTurk cannot take assignments back off a HIT, so this can only
+        withdraw all of them, by expiring the HIT; recruiting again extends
+        the HIT and so reopens it. If fewer than all of them are to be
+        withdrawn they stay open, and the participants who take them are
+        turned away when they arrive, as there is no open slot for them (see
+        :func:`~wallace.experiments.Experiment.get_network_for_participant`).
+
+        """
+        available = self.outstanding()
+        if n >= available:
+            self.mturk_connection().expire_hit(self.hit_id())
+            self._hit = None
+        else:
+            print("Cannot withdraw {} of {} available assignments, surplus "
+                  "participants will be turned away.".format(n, available))
+
     def approve_hit(self, assignment_id):
         """Approve the HIT."""
         from psiturk.amt_services import MTurkServices